@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks for pypgen.
+
+Micro-benchmarks time the per site functions on the example data
+(pypgen/data/example.vcf.gz). Macro-benchmarks run vcfWindowedFstats
+and vcfSNVfstats over generated VCFs at different sample counts,
+population counts and --cores. Results are written as JSON so runs
+from different commits can be compared:
+
+    python -m benchmarks -o before.json
+    git checkout <other commit>
+    python -m benchmarks -o after.json
+    python -m benchmarks compare before.json after.json
+"""
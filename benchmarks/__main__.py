@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import sys
+import json
+import argparse
+from benchmarks import common, micro, macro, startup
+
+
+def compare(before_path, after_path):
+    """Print the change in throughput between two result files."""
+
+    before = json.load(open(before_path))
+    after = json.load(open(after_path))
+
+    print "{:<45} {:>14} {:>14} {:>8}".format('benchmark', 'before', 'after', 'ratio')
+
+    for name in sorted(set(before.get('micro', {})) & set(after.get('micro', {}))):
+        b, a = before['micro'][name]['sites_per_second'], after['micro'][name]['sites_per_second']
+        print "{:<45} {:>14.1f} {:>14.1f} {:>8.2f}".format(name, b, a, a / b)
+
+    def key(result):
+        return (result['script'], result['samples'], result['populations'], result['cores'])
+
+    after_macro = dict((key(r), r) for r in after.get('macro', []))
+    for result in before.get('macro', []):
+        if key(result) in after_macro:
+            b, a = result['sites_per_second'], after_macro[key(result)]['sites_per_second']
+            name = "{} samples={} pops={} cores={}".format(*key(result))
+            print "{:<45} {:>14.1f} {:>14.1f} {:>8.2f}".format(name, b, a, a / b)
+
+    after_startup = dict(((r['script'], r['job']), r) for r in after.get('startup', []))
+    for result in before.get('startup', []):
+        key = (result['script'], result['job'])
+        if key in after_startup:
+            b, a = result['seconds'], after_startup[key]['seconds']
+            name = "{} {} (s, budget {})".format(key[0], key[1], result['budget_seconds'])
+            print "{:<45} {:>14.3f} {:>14.3f} {:>8.2f}".format(name, b, a, a / b)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        parser = argparse.ArgumentParser(prog='python -m benchmarks compare')
+        parser.add_argument('before')
+        parser.add_argument('after')
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.before, args.after)
+        return
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Run the pypgen benchmarks and write the results as JSON.')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results (default STDOUT).')
+    parser.add_argument('--skip-micro', action='store_true', default=False)
+    parser.add_argument('--skip-macro', action='store_true', default=False)
+    parser.add_argument('--skip-startup', action='store_true', default=False)
+    parser.add_argument('--repeat', type=int, default=3, help='Repeats of each micro-benchmark (best is kept).')
+    parser.add_argument('--samples', type=int, nargs='+', default=[20, 100])
+    parser.add_argument('--populations', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--contigs', type=int, default=2)
+    parser.add_argument('--contig-length', type=int, default=1000000)
+    parser.add_argument('--sites-per-contig', type=int, default=5000)
+    parser.add_argument('--window-size', type=int, default=50000)
+    parser.add_argument('--backend', default='auto')
+    parser.add_argument('--tmp-dir', default=None, help='Directory for the generated VCFs.')
+    args = parser.parse_args()
+
+    results = {'metadata': common.metadata()}
+
+    if not args.skip_micro:
+        results['micro'] = micro.run(args.repeat)
+
+    if not args.skip_macro:
+        results['macro'] = macro.run(args.samples, args.populations, args.cores, args.contigs,
+                                     args.contig_length, args.sites_per_contig, args.window_size,
+                                     args.backend, tmp_dir=args.tmp_dir)
+
+    if not args.skip_startup:
+        results['startup'] = startup.run(tmp_dir=args.tmp_dir)
+        for result in results['startup']:
+            if not result['within_budget']:
+                sys.stderr.write("{script} {job}: {seconds:.3f}s is over the budget of {budget_seconds}s\n"
+                                 .format(**result))
+
+    common.write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import datetime
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best_time(function, repeat=3, number=1):
+    """Best wall clock time (seconds) of `number` calls to function,
+    out of `repeat` runs."""
+
+    times = []
+    for r in range(repeat):
+        start = time.time()
+        for n in range(number):
+            function()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def run_command(command, env=None):
+    """Run a command, discarding its output. Returns the wall clock
+    time and the largest single-process peak resident set size (MB)
+    of the command and its children (ru_maxrss is a maximum, not a sum
+    over the worker pool)."""
+
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    process = subprocess.Popen(command, stdout=devnull, stderr=subprocess.PIPE, env=env)
+
+    stderr = process.stderr.read()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    devnull.close()
+
+    if status != 0:
+        raise RuntimeError("{} failed:\n{}".format(' '.join(command), stderr))
+
+    return elapsed, rusage.ru_maxrss / 1024.0   # ru_maxrss is in KB on Linux
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata():
+    import numpy
+
+    return {'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN')}
+
+
+def write_results(path, results):
+    if path is None:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(path, 'w') as fout:
+            json.dump(results, fout, indent=1, sort_keys=True)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Generated VCFs for the macro-benchmarks (see pypgen.misc.simulate)."""
+
+from pypgen.misc import simulate
+
+
+def population_args(samples, populations):
+    """Sample names and the -p arguments for `samples` samples split
+    evenly between `populations` populations."""
+
+    return simulate.sample_names(samples), simulate.population_args(samples, populations)
+
+
+def write_vcf(path, samples, populations, contigs=2, contig_length=1000000,
+              sites_per_contig=5000, missing=0.1, seed=1):
+    """Write a bgzipped and tabix indexed VCF (path + '.gz') with about
+    `sites_per_contig` sites on each contig. Returns the path of the
+    compressed file."""
+
+    return simulate.simulate_vcf(path, samples, populations, contigs, contig_length,
+                                 snp_density=float(sites_per_contig) / contig_length,
+                                 missing=missing, seed=seed)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Macro-benchmarks: the scripts end to end over generated inputs."""
+
+import os
+import sys
+import shutil
+import tempfile
+from benchmarks.common import ROOT, run_command
+from benchmarks.inputs import population_args, write_vcf
+
+
+SCRIPTS = os.path.join(ROOT, 'scripts')
+
+
+def script_command(script, vcf, pop_args, cores, window_size, backend):
+    command = [sys.executable, os.path.join(SCRIPTS, script), '-i', vcf, '-p'] + pop_args \
+              + ['-c', str(cores), '--backend', backend]
+
+    if script == 'vcfWindowedFstats':
+        command += ['-w', str(window_size)]
+    else:
+        command += ['-f', 'PASS']
+
+    return command
+
+
+def run(samples=(20, 100), populations=(2, 4), cores=(1, 2, 4), contigs=2, contig_length=1000000,
+        sites_per_contig=5000, window_size=50000, backend='auto', repeat=1, tmp_dir=None):
+    """Time both scripts for every combination of sample count,
+    population count and cores. Scaling efficiency is relative to the
+    run with the fewest cores: t(min) * min / (t(cores) * cores)."""
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+
+    workdir = tempfile.mkdtemp(dir=tmp_dir)
+    sites = contigs * sites_per_contig
+    windows = contigs * ((contig_length + window_size - 1) // window_size)
+    results = []
+
+    try:
+        for n_samples in samples:
+            for n_populations in populations:
+                vcf = write_vcf(os.path.join(workdir, 'bench_{}_{}.vcf'.format(n_samples, n_populations)),
+                                n_samples, n_populations, contigs, contig_length, sites_per_contig)
+                names, pop_args = population_args(n_samples, n_populations)
+
+                for script in ('vcfWindowedFstats', 'vcfSNVfstats'):
+                    baseline = None
+
+                    for n_cores in sorted(cores):
+                        command = script_command(script, vcf, pop_args, n_cores, window_size, backend)
+                        timings = [run_command(command, env) for r in range(repeat)]
+                        seconds = min(t for t, rss in timings)
+                        peak_rss = max(rss for t, rss in timings)
+
+                        if baseline is None:
+                            baseline = (seconds, n_cores)
+
+                        result = {'script': script,
+                                  'samples': n_samples,
+                                  'populations': n_populations,
+                                  'cores': n_cores,
+                                  'backend': backend,
+                                  'sites': sites,
+                                  'seconds': seconds,
+                                  'sites_per_second': sites / seconds,
+                                  'peak_rss_mb': peak_rss,
+                                  'scaling_efficiency': (baseline[0] * baseline[1]) / (seconds * n_cores)}
+
+                        if script == 'vcfWindowedFstats':
+                            result['windows'] = windows
+                            result['windows_per_second'] = windows / seconds
+
+                        results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
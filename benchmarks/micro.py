@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Micro-benchmarks of the per site functions on the example data."""
+
+import os
+from benchmarks.common import ROOT, best_time
+from pypgen.parser import VCF
+from pypgen.parser import BCF
+from pypgen.fstats import backends
+
+
+EXAMPLE = os.path.join(ROOT, 'pypgen', 'data', 'example.vcf.gz')
+
+POPULATIONS = ["cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640",
+               "outgroups:h665,i02-210",
+               "melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689",
+               "pachi:p516,p517,p518,p519,p520,p591,p596,p690,p694,p696"]
+
+
+def rate(seconds, count, unit='sites'):
+    return {'seconds': seconds, unit: count, unit + '_per_second': count / seconds}
+
+
+def run(repeat=3):
+    header = VCF.make_empty_vcf_ordered_dict(EXAMPLE)
+    populations = VCF.parse_populations_list(POPULATIONS)
+    lines = [line for line in VCF.iter_vcf_slice(EXAMPLE, 'Chr01', 1, 10000000)]
+
+    parsed = [dict(VCF.parse_vcf_line(line, header)) for line in lines]
+    parsed = [line for line in parsed if line['FILTER'] == 'PASS']
+    allele_counts = [VCF.calc_allele_counts(populations, line) for line in parsed]
+    f_statistics = [VCF.calc_fstats(counts) for counts in allele_counts]
+
+    Hs_est_dict, Ht_est_dict = {}, {}
+    for f in f_statistics:
+        VCF.update_Hs_and_Ht_dicts(f, Hs_est_dict, Ht_est_dict)
+
+    results = {}
+    results['parse_vcf_line'] = rate(best_time(lambda: [VCF.parse_vcf_line(line, header) for line in lines], repeat),
+                                     len(lines))
+
+    # the same sites decoded by htslib (--reader pysam), for the samples of the populations
+    reader = BCF.SiteReader(EXAMPLE, [sample for pop in VCF.population_order(populations)
+                                      for sample in populations[pop]])
+    records = list(reader.fetch('Chr01', 1, 10000000))
+    results['SiteReader.site'] = rate(best_time(lambda: [reader.site(record) for record in records], repeat),
+                                      len(records))
+    results['calc_allele_counts'] = rate(best_time(lambda: [VCF.calc_allele_counts(populations, line) for line in parsed],
+                                                   repeat), len(parsed))
+
+    for backend in backends.BACKENDS[1:]:
+        if backend == 'numba' and not backends.numba_available():
+            continue
+
+        results['calc_fstats.' + backend] = rate(best_time(lambda: [VCF.calc_fstats(counts, backend=backend)
+                                                                    for counts in allele_counts], repeat), len(parsed))
+
+        args = VCF.chunk_args(EXAMPLE, backend=backend)
+        VCF.calc_slice_stats(['Chr01', 1, 10000000, populations, header, args])   # warm up (e.g., JIT)
+        results['calc_slice_stats.' + backend] = rate(
+            best_time(lambda: VCF.calc_slice_stats(['Chr01', 1, 10000000, populations, header, args]), repeat),
+            len(parsed))
+
+    results['calc_multilocus_f_statistics'] = rate(
+        best_time(lambda: VCF.calc_multilocus_f_statistics(Hs_est_dict, Ht_est_dict), repeat), len(parsed))
+
+    return results
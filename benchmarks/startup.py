@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Start up benchmarks: `--help` and a small region run, the jobs that
+workflow managers launch by the thousand, checked against a budget."""
+
+import os
+import sys
+import shutil
+import tempfile
+from benchmarks.common import ROOT, run_command
+from benchmarks.inputs import population_args, write_vcf
+
+
+SCRIPTS = os.path.join(ROOT, 'scripts')
+
+# seconds (best of `repeat` runs) that each job should stay within
+BUDGETS = {'help': 0.15,
+           'small_region': 0.5}
+
+
+def startup_commands(vcf, pop_args, backend=None):
+    """(script, job, command) for every job that is timed. Without a
+    backend the jobs run with the default one, as users would."""
+
+    commands = []
+    for script in ('vcfWindowedFstats', 'vcfSNVfstats'):
+        commands.append((script, 'help', [sys.executable, os.path.join(SCRIPTS, script), '--help']))
+
+    commands.append(('vcfWindowedFstats', 'small_region',
+                     [sys.executable, os.path.join(SCRIPTS, 'vcfWindowedFstats'), '-i', vcf, '-p'] + pop_args
+                     + ['-r', 'chr1:1-10001', '-w', '5000', '-c', '2']
+                     + (['--backend', backend] if backend is not None else [])))
+    return commands
+
+
+def run(repeat=5, backend=None, tmp_dir=None):
+    """Time each job and compare it with its budget."""
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+
+    workdir = tempfile.mkdtemp(dir=tmp_dir)
+    results = []
+
+    try:
+        vcf = write_vcf(os.path.join(workdir, 'startup.vcf'), 20, 2, contigs=1,
+                        contig_length=100000, sites_per_contig=500)
+        names, pop_args = population_args(20, 2)
+
+        for script, job, command in startup_commands(vcf, pop_args, backend):
+            seconds = min(run_command(command, env)[0] for r in range(repeat))
+            results.append({'script': script,
+                            'job': job,
+                            'backend': backend or 'default',
+                            'seconds': seconds,
+                            'budget_seconds': BUDGETS[job],
+                            'within_budget': seconds <= BUDGETS[job]})
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
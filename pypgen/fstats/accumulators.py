@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Mergeable sufficient statistics for the multilocus estimators.
+
+Instead of keeping every site's Hs and Ht in a list, a window keeps
+counts, plain sums and RunningStats (running means and variances).
+These take constant memory and can be merged, so windows can be
+combined into chromosomes or genomes, and partial windows computed by
+different workers can be joined exactly.
+"""
+
+import math
+from collections import OrderedDict
+from pypgen.fstats import fstats
+from pypgen.fstats import resampling
+from pypgen.misc.helpers import lazy_import
+
+
+numpy = lazy_import('numpy')
+
+
+STATS = resampling.ESTIMATORS
+
+
+class HsHtAccumulator(object):
+    """Sufficient statistics of the per site Hs_est and Ht_est of one
+    population pair (or the global estimators over n populations).
+
+    Holds the number of sites, the sums of Hs and Ht (for the
+    multilocus Gst, G'st and G''st), and the running mean and variance
+    of each per site estimator (for the '.stdev' values and Chao's
+    harmonic mean of D used by the multilocus Dest).
+
+    If keep_values is True the per site values are also kept, which
+    is needed to bootstrap the window.
+    """
+
+    def __init__(self, n=2, keep_values=False):
+        self.n = n
+        self.sites = 0
+        self.nan_sites = 0
+        self.sum_Hs = 0.0
+        self.sum_Ht = 0.0
+        self.stats = dict((stat, fstats.RunningStats()) for stat in STATS)
+
+        self.Hs_values = [] if keep_values else None
+        self.Ht_values = [] if keep_values else None
+
+    def update(self, Hs_est, Ht_est):
+
+        if math.isnan(Hs_est) or math.isnan(Ht_est):
+            self.nan_sites += 1
+            return
+
+        n = self.n
+        self.sites += 1
+        self.sum_Hs += Hs_est
+        self.sum_Ht += Ht_est
+
+        Gst_est = fstats.Gst_est(Ht_est, Hs_est)
+        self.stats['Gst_est'].update(Gst_est)
+        self.stats['G_prime_st_est'].update(fstats.G_prime_st_est(Ht_est, Hs_est, Gst_est, n))
+        self.stats['G_double_prime_st_est'].update(fstats.G_double_prime_st_est(Ht_est, Hs_est, n))
+        self.stats['D_est'].update(fstats.D_est(Ht_est, Hs_est, n))
+
+        if self.Hs_values is not None:
+            self.Hs_values.append(Hs_est)
+            self.Ht_values.append(Ht_est)
+
+    def update_many(self, Hs_est, Ht_est, estimates):
+        """Add a block of sites: arrays of Hs_est and Ht_est and a dict
+        of arrays of the per site estimators (see
+        pypgen.fstats.backends)."""
+
+        Hs_est = numpy.asarray(Hs_est, dtype=float)
+        Ht_est = numpy.asarray(Ht_est, dtype=float)
+        keep = ~(numpy.isnan(Hs_est) | numpy.isnan(Ht_est))
+
+        self.nan_sites += int(len(keep) - keep.sum())
+        self.sites += int(keep.sum())
+        self.sum_Hs += Hs_est[keep].sum()
+        self.sum_Ht += Ht_est[keep].sum()
+
+        for stat in STATS:
+            self.stats[stat].update_array(numpy.asarray(estimates[stat])[keep])
+
+        if self.Hs_values is not None:
+            self.Hs_values.extend(Hs_est[keep].tolist())
+            self.Ht_values.extend(Ht_est[keep].tolist())
+
+    def merge(self, other):
+        """Add the sites of `other` to this accumulator."""
+
+        self.sites += other.sites
+        self.nan_sites += other.nan_sites
+        self.sum_Hs += other.sum_Hs
+        self.sum_Ht += other.sum_Ht
+
+        for stat in STATS:
+            self.stats[stat].merge(other.stats[stat])
+
+        if self.Hs_values is not None and other.Hs_values is not None:
+            self.Hs_values.extend(other.Hs_values)
+            self.Ht_values.extend(other.Ht_values)
+        else:
+            self.Hs_values = self.Ht_values = None
+
+        return self
+
+    def sums(self):
+        """[sites, sum(Ht), sum(Hs), sum(D), sum(D**2)] as used by
+        pypgen.fstats.resampling.block_jackknife."""
+
+        D = self.stats['D_est']
+        return [self.sites, self.sum_Ht, self.sum_Hs, D.total(), D.total_sq()]
+
+    def estimates(self, strict_D=True):
+        """Multilocus estimators and the standard deviations of the per
+        site values (see calc_multilocus_f_statistics). Returns None if
+        no site had data for both populations.
+
+        If strict_D is True Dest is NaN when any site is NaN, as with
+        multilocus_D_est. Otherwise NaN sites are skipped, as they are
+        for the other estimators."""
+
+        if self.sites == 0:
+            return None
+
+        D = self.stats['D_est']
+        estimates = resampling.multilocus_estimates_from_means(self.sum_Ht / self.sites,
+                                                               self.sum_Hs / self.sites,
+                                                               D.mean(), D.variance(), self.n)
+        values_dict = dict((stat, float(value)) for stat, value in estimates.iteritems())
+
+        # Like multilocus_D_est, Dest is NaN if any site is NaN
+        if strict_D and self.nan_sites > 0:
+            values_dict['D_est'] = float('NaN')
+
+        for stat in STATS:
+            values_dict[stat + '.stdev'] = self.stats[stat].stdev()
+
+        return values_dict
+
+
+def merge_accumulators(total, accumulators):
+    """Merge a dict of accumulators (keyed by population pair) into
+    the dict `total`, adding keys that are not in it yet."""
+
+    for key, accumulator in accumulators.iteritems():
+        if key not in total:
+            total[key] = HsHtAccumulator(accumulator.n)
+        total[key].merge(accumulator)
+
+    return total
+
+
+class MultilocusSummary(object):
+    """Reduce window accumulators to chromosome and genome totals.
+
+    Windows are added as they are finished; each is merged into the
+    total of its chromosome, and the genome total is the merge of the
+    chromosome totals. The estimates are exactly those of a single
+    window spanning the chromosome (or genome)."""
+
+    def __init__(self):
+        self.chromosomes = OrderedDict()
+
+    def add(self, chrm, accumulators):
+        merge_accumulators(self.chromosomes.setdefault(chrm, {}), accumulators)
+
+    def genome(self):
+        total = {}
+        for accumulators in self.chromosomes.itervalues():
+            merge_accumulators(total, accumulators)
+        return total
+
+    def levels(self):
+        """Yield (level, chromosome, accumulators) for each chromosome
+        and then the genome."""
+
+        for chrm, accumulators in self.chromosomes.iteritems():
+            yield ('chromosome', chrm, accumulators)
+        yield ('genome', 'all', self.genome())
+
+
+def distance_matrices(accumulators, populations):
+    """K x K matrices (a dict of numpy arrays by estimator) of the
+    multilocus estimates of each population pair (NaN sites skipped).
+    The diagonal is 0.0 and pairs without data are NaN."""
+
+    index = dict((pop, count) for count, pop in enumerate(populations))
+    matrices = dict((stat, numpy.zeros((len(populations), len(populations)))) for stat in STATS)
+
+    for matrix in matrices.itervalues():
+        matrix[~numpy.eye(len(populations), dtype=bool)] = float('NaN')
+
+    for key, accumulator in accumulators.iteritems():
+        if len(key) != 2 or key[0] not in index or key[1] not in index:
+            continue
+
+        estimates = accumulator.estimates(strict_D=False)
+        if estimates is None:
+            continue
+
+        i, j = index[key[0]], index[key[1]]
+        for stat in STATS:
+            matrices[stat][i, j] = matrices[stat][j, i] = estimates[stat]
+
+    return matrices
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Compute backends for the per site kernels.
+
+Counting alleles and calculating Hs, Ht and the per site estimators are
+done by a backend working on blocks of sites held in arrays:
+
+    genotypes : int array (sites, samples, ploidy) of allele indices,
+        -1 where an allele is missing.
+    counts : float array (sites, populations, 4) of allele counts.
+    Hs_est, Ht_est : float arrays (sites, keys) with a column for each
+        population pair and, optionally, one for the global estimators.
+        Columns are NaN where a population has no data.
+
+'python' is the reference implementation built on the scalar functions
+in pypgen.fstats.fstats. 'numpy' vectorizes each kernel over the whole
+block. 'numba' compiles the pairwise loops with numba, if it is
+installed. All backends must agree with the golden values in the tests
+(see TestBackends in tests/tests.py), and all refuse allele indices
+above 3 with a ValueError (see check_alleles).
+
+'auto' runs single sites and small batches with 'python', where setting
+up the arrays costs more than it saves, and blocks of sites with
+'numba' if it is installed and 'numpy' otherwise (or 'numpy' for
+small runs, see run_backend).
+"""
+
+import imp
+import itertools
+from pypgen.fstats import fstats
+from pypgen.fstats.resampling import ESTIMATORS, _divide
+from pypgen.misc.helpers import lazy_import
+
+
+numpy = lazy_import('numpy')
+
+
+BACKENDS = ('auto', 'python', 'numpy', 'numba')
+AUTO_BLOCK_SITES = 8   # 'auto' uses 'python' for fewer sites than this
+AUTO_NUMBA_BP = 10 ** 8   # and numba only for runs over at least this many base pairs
+
+ALLELES_ERROR = "allele index {} is not supported: at most four alleles (0 to 3) are counted at a site"
+
+
+def check_alleles(genotypes):
+    """Raise a ValueError if any allele index of genotypes is above 3.
+    The estimators count four alleles, and dropping the others would
+    change the sample sizes."""
+
+    genotypes = numpy.asarray(genotypes)
+    if genotypes.size != 0 and genotypes.max() >= 4:
+        raise ValueError(ALLELES_ERROR.format(int(genotypes.max())))
+
+
+def population_keys(n_populations, global_stats=False):
+    """Population indices of each column: every pair (i, j) with i < j
+    and, if global_stats is True and there are more than two
+    populations, a last column for all of them."""
+
+    keys = list(itertools.combinations(range(n_populations), 2))
+    if global_stats == True and n_populations > 2:
+        keys.append(tuple(range(n_populations)))
+    return keys
+
+
+class PythonBackend(object):
+    """Reference backend: plain loops over the scalar estimators."""
+
+    name = 'python'
+
+    def count_alleles(self, genotypes, sample_populations, n_populations):
+        """Count alleles 0 to 3 of each population. sample_populations
+        gives the population index of each sample (-1 to ignore it)."""
+
+        check_alleles(genotypes)
+
+        counts = []
+        for site in numpy.asarray(genotypes).tolist():
+            site_counts = [[0.0] * 4 for i in range(n_populations)]
+
+            for pop, alleles in zip(sample_populations, site):
+                if pop < 0:
+                    continue
+                for allele in alleles:
+                    if allele >= 0:
+                        site_counts[pop][allele] += 1.0
+
+            counts.append(site_counts)
+
+        return numpy.array(counts, dtype=float).reshape(len(counts), n_populations, 4)
+
+    def frequencies(self, counts):
+        """Allele frequencies and sample sizes (sites, populations) from
+        allele counts. Populations without data have frequencies of 0."""
+
+        allele_freqs, sizes = [], []
+        for site in numpy.asarray(counts, dtype=float).tolist():
+            Ns = [sum(pop) for pop in site]
+            allele_freqs.append([[count / N for count in pop] if N != 0.0 else [0.0] * 4
+                                 for pop, N in zip(site, Ns)])
+            sizes.append(Ns)
+
+        return numpy.array(allele_freqs).reshape(numpy.shape(counts)), numpy.array(sizes).reshape(numpy.shape(counts)[:2])
+
+    def hs_ht_prime(self, counts, global_stats=False):
+        """Uncorrected Hs' and Ht' of each column and the harmonic mean
+        sample size of its populations. Returns (keys, Hs', Ht', N)."""
+
+        allele_freqs, Ns = self.frequencies(counts)
+        return self.hs_ht_prime_from_frequencies(allele_freqs, Ns, global_stats)
+
+    def hs_ht_prime_from_frequencies(self, allele_freqs, Ns, global_stats=False):
+        """As hs_ht_prime, from allele frequencies (sites, populations, 4)
+        and sample sizes (sites, populations)."""
+
+        allele_freqs = numpy.asarray(allele_freqs, dtype=float)
+        keys = population_keys(allele_freqs.shape[1], global_stats)
+        Hs_prime, Ht_prime, Ns_harm = [], [], []
+
+        for site, Ns in zip(allele_freqs.tolist(), numpy.asarray(Ns, dtype=float).tolist()):
+            J = fstats.homozygosity_matrix(site)
+
+            rows = ([], [], [])
+            for key in keys:
+                if 0.0 in [Ns[i] for i in key]:
+                    values = [float('NaN')] * 3
+
+                elif len(key) == 2:
+                    i, j = key
+                    values = [fstats.pairwise_Hs_prime_est(J, i, j),
+                              fstats.pairwise_Ht_prime_est(J, i, j),
+                              2 / (1.0 / Ns[i] + 1.0 / Ns[j])]
+                else:
+                    values = [fstats.global_Hs_prime_est(J),
+                              fstats.global_Ht_prime_est(J),
+                              fstats.harmonic_mean(Ns)]
+
+                for row, value in zip(rows, values):
+                    row.append(value)
+
+            Hs_prime.append(rows[0])
+            Ht_prime.append(rows[1])
+            Ns_harm.append(rows[2])
+
+        shape = (len(allele_freqs), len(keys))
+        return (keys, numpy.array(Hs_prime).reshape(shape), numpy.array(Ht_prime).reshape(shape),
+                numpy.array(Ns_harm).reshape(shape))
+
+    def hs_ht(self, counts, global_stats=False):
+        """Hs_est and Ht_est of each column. Returns (keys, Hs_est, Ht_est)."""
+
+        keys, Hs_prime, Ht_prime, Ns_harm = self.hs_ht_prime(counts, global_stats)
+        n = [len(key) for key in keys]
+
+        Hs_est, Ht_est = [], []
+        for Hs_row, Ht_row, N_row in zip(Hs_prime.tolist(), Ht_prime.tolist(), Ns_harm.tolist()):
+            Hs_row = [fstats.Hs_est(Hs, N) for Hs, N in zip(Hs_row, N_row)]
+            Ht_row = [fstats.Ht_est(Ht, Hs, N, n_) for Ht, Hs, N, n_ in zip(Ht_row, Hs_row, N_row, n)]
+            Hs_est.append(Hs_row)
+            Ht_est.append(Ht_row)
+
+        return keys, numpy.array(Hs_est).reshape(Hs_prime.shape), numpy.array(Ht_est).reshape(Ht_prime.shape)
+
+    def estimators(self, Hs_est, Ht_est, n):
+        """Per site Gst, G'st, G''st and Dest as a dict of arrays. n is
+        the number of populations of each column."""
+
+        results = dict((stat, []) for stat in ESTIMATORS)
+        for Hs_row, Ht_row in zip(numpy.asarray(Hs_est).tolist(), numpy.asarray(Ht_est).tolist()):
+            rows = dict((stat, []) for stat in ESTIMATORS)
+
+            for Hs, Ht, n_ in zip(Hs_row, Ht_row, n):
+                Gst = fstats.Gst_est(Ht, Hs)
+                rows['Gst_est'].append(Gst)
+                rows['G_prime_st_est'].append(fstats.G_prime_st_est(Ht, Hs, Gst, n_))
+                rows['G_double_prime_st_est'].append(fstats.G_double_prime_st_est(Ht, Hs, n_))
+                rows['D_est'].append(fstats.D_est(Ht, Hs, n_))
+
+            for stat in ESTIMATORS:
+                results[stat].append(rows[stat])
+
+        shape = numpy.shape(Hs_est)
+        return dict((stat, numpy.array(values, dtype=float).reshape(shape))
+                    for stat, values in results.iteritems())
+
+
+class NumpyBackend(PythonBackend):
+    """Every kernel is an array operation over the whole block."""
+
+    name = 'numpy'
+
+    def count_alleles(self, genotypes, sample_populations, n_populations):
+        genotypes = numpy.asarray(genotypes, dtype=int)
+        check_alleles(genotypes)
+        sites = genotypes.shape[0]
+        populations = numpy.broadcast_to(numpy.asarray(sample_populations, dtype=int)[None, :, None],
+                                         genotypes.shape)
+        site_index = numpy.broadcast_to(numpy.arange(sites)[:, None, None], genotypes.shape)
+
+        keep = (genotypes >= 0) & (populations >= 0)
+        index = (site_index[keep] * n_populations + populations[keep]) * 4 + genotypes[keep]
+        counts = numpy.bincount(index, minlength=sites * n_populations * 4)
+        return counts.reshape(sites, n_populations, 4).astype(float)
+
+    def frequencies(self, counts):
+        counts = numpy.asarray(counts, dtype=float)
+        Ns = counts.sum(axis=2)
+        return _divide(counts, Ns[:, :, None]), Ns
+
+    def _pairwise(self, Ns, J, first, second):
+        """Hs', Ht' and harmonic mean sample sizes of the pairs
+        (first[c], second[c])."""
+
+        Jii = J[:, first, first]
+        Jjj = J[:, second, second]
+        Hs_prime = ((1.0 - Jii) + (1.0 - Jjj)) / 2.0
+        Ht_prime = Hs_prime + (Jii - 2.0 * J[:, first, second] + Jjj) / 4.0
+        Ns_harm = 2.0 / (_divide(1.0, Ns[:, first]) + _divide(1.0, Ns[:, second]))
+        return Hs_prime, Ht_prime, Ns_harm
+
+    def hs_ht_prime_from_frequencies(self, allele_freqs, Ns, global_stats=False):
+        allele_freqs = numpy.asarray(allele_freqs, dtype=float)
+        Ns = numpy.asarray(Ns, dtype=float)
+        n_populations = allele_freqs.shape[1]
+        keys = population_keys(n_populations, global_stats)
+        pairs = [key for key in keys if len(key) == 2]
+
+        J = numpy.einsum('sia,sja->sij', allele_freqs, allele_freqs)
+        first = numpy.array([i for i, j in pairs], dtype=int)
+        second = numpy.array([j for i, j in pairs], dtype=int)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            columns = self._pairwise(Ns, J, first, second)
+            missing = (Ns[:, first] == 0.0) | (Ns[:, second] == 0.0)
+
+            if len(keys) > len(pairs):
+                n = float(n_populations)
+                diagonal = numpy.einsum('sii->si', J)
+                divergence = (J[:, first, first] - 2.0 * J[:, first, second] + J[:, second, second]).sum(axis=1)
+                Hs_prime = (1.0 - diagonal).sum(axis=1) / n
+                Ht_prime = Hs_prime + divergence / (n ** 2)
+                Ns_harm = n / _divide(1.0, Ns).sum(axis=1)
+
+                columns = [numpy.column_stack((c, g)) for c, g in zip(columns, (Hs_prime, Ht_prime, Ns_harm))]
+                missing = numpy.column_stack((missing, (Ns == 0.0).any(axis=1)))
+
+        Hs_prime, Ht_prime, Ns_harm = [numpy.where(missing, float('NaN'), c) for c in columns]
+        return keys, Hs_prime, Ht_prime, Ns_harm
+
+    def hs_ht(self, counts, global_stats=False):
+        keys, Hs_prime, Ht_prime, Ns_harm = self.hs_ht_prime(counts, global_stats)
+        n = numpy.array([len(key) for key in keys], dtype=float)
+
+        Hs_est = ((2.0 * Ns_harm) / (2.0 * Ns_harm - 1.0)) * Hs_prime
+        Ht_est = Ht_prime + Hs_est / (2.0 * Ns_harm * n)
+        return keys, Hs_est, Ht_est
+
+    def estimators(self, Hs_est, Ht_est, n):
+        Hs_est = numpy.asarray(Hs_est, dtype=float)
+        Ht_est = numpy.asarray(Ht_est, dtype=float)
+        n = numpy.asarray(n, dtype=float)
+
+        Gst = _divide(Ht_est - Hs_est, Ht_est)
+        return {'Gst_est': Gst,
+                'G_prime_st_est': _divide(Gst * (n - 1.0 + Hs_est), (n - 1.0) * (1.0 - Hs_est)),
+                'G_double_prime_st_est': _divide(n * (Ht_est - Hs_est), (n * Ht_est - Hs_est) * (1.0 - Hs_est)),
+                'D_est': _divide(Ht_est - Hs_est, 1.0 - Hs_est) * (n / (n - 1.0))}
+
+
+def run_backend(name, bp):
+    """The backend to analyse `bp` base pairs with. 'auto' becomes
+    'numpy' for runs shorter than AUTO_NUMBA_BP: every worker imports
+    numba and loads its compiled loops (about half a second), which only
+    pays off over hundreds of thousands of sites a worker."""
+
+    if name == 'auto' and bp < AUTO_NUMBA_BP:
+        return 'numpy'
+    return name
+
+
+def numba_available():
+    """True if numba can be imported. Checked without importing it,
+    which takes longer than the rest of the start up."""
+
+    try:
+        imp.find_module('numba')
+    except ImportError:
+        return False
+    return True
+
+
+# Loops compiled by numba the first time a NumbaBackend is created
+
+def _count_alleles_loop(genotypes, sample_populations, counts):
+    for s in range(genotypes.shape[0]):
+        for sample in range(genotypes.shape[1]):
+            pop = sample_populations[sample]
+            if pop < 0:
+                continue
+            for a in range(genotypes.shape[2]):
+                allele = genotypes[s, sample, a]
+                if allele >= 0:
+                    counts[s, pop, allele] += 1.0
+
+
+def _pairwise_loop(Ns, J, first, second, Hs_prime, Ht_prime, Ns_harm):
+    for s in range(J.shape[0]):
+        for c in range(first.shape[0]):
+            i = first[c]
+            j = second[c]
+            Hs_prime[s, c] = ((1.0 - J[s, i, i]) + (1.0 - J[s, j, j])) / 2.0
+            Ht_prime[s, c] = Hs_prime[s, c] + (J[s, i, i] - 2.0 * J[s, i, j] + J[s, j, j]) / 4.0
+            if Ns[s, i] != 0.0 and Ns[s, j] != 0.0:
+                Ns_harm[s, c] = 2.0 / (1.0 / Ns[s, i] + 1.0 / Ns[s, j])
+
+
+class NumbaBackend(NumpyBackend):
+    """NumPy backend with the allele counting and pairwise loops
+    compiled by numba."""
+
+    name = 'numba'
+
+    def __init__(self):
+        try:
+            import numba
+        except ImportError:
+            raise ImportError("The numba backend requires numba (pip install numba).")
+
+        self._count_alleles_loop = numba.njit(cache=True)(_count_alleles_loop)
+        self._pairwise_loop = numba.njit(cache=True)(_pairwise_loop)
+
+    def count_alleles(self, genotypes, sample_populations, n_populations):
+        genotypes = numpy.ascontiguousarray(genotypes, dtype=numpy.int64)
+        check_alleles(genotypes)
+        counts = numpy.zeros((genotypes.shape[0], n_populations, 4))
+        self._count_alleles_loop(genotypes, numpy.asarray(sample_populations, dtype=numpy.int64), counts)
+        return counts
+
+    def _pairwise(self, Ns, J, first, second):
+        shape = (J.shape[0], len(first))
+        Hs_prime, Ht_prime, Ns_harm = numpy.zeros(shape), numpy.zeros(shape), numpy.zeros(shape)
+        self._pairwise_loop(Ns, numpy.ascontiguousarray(J), first.astype(numpy.int64), second.astype(numpy.int64),
+                            Hs_prime, Ht_prime, Ns_harm)
+        return Hs_prime, Ht_prime, Ns_harm
+
+
+_backends = {}
+
+
+def get_backend(name='auto', sites=None):
+    """Return the backend called `name`. For 'auto', `sites` is the
+    number of sites of each call: 'python' is picked for fewer than
+    AUTO_BLOCK_SITES, and numba (if installed, numpy otherwise) for
+    blocks or when `sites` is None. Backend instances are passed
+    through."""
+
+    if isinstance(name, PythonBackend):
+        return name
+
+    if name == 'auto':
+        if sites is not None and sites < AUTO_BLOCK_SITES:
+            name = 'python'
+        else:
+            name = 'numba' if numba_available() else 'numpy'
+
+    if name not in _backends:
+        classes = {'python': PythonBackend, 'numpy': NumpyBackend, 'numba': NumbaBackend}
+        if name not in classes:
+            raise ValueError("Unknown backend: {}".format(name))
+        _backends[name] = classes[name]()
+
+    return _backends[name]
@@ -3,6 +3,10 @@
 
 
 import math
+from pypgen.misc.helpers import lazy_import
+
+
+numpy = lazy_import('numpy')
 
 ## UTIlITY STATS:
 def de_NaN_list(l):
@@ -128,6 +132,93 @@ def harmonic_mean_chao(l):
         return harmonic_mean_chao
 
 
+class RunningStats(object):
+    """Streaming mean and variance of a series of values.
+
+    Values are added one at a time with update() and two series can be
+    combined with merge(), so the data is read once and never stored.
+    The mean and variance use Welford's algorithm (and Chan et al.'s
+    formula for merging), which is stable for long series. NaNs are
+    skipped (and counted) like de_NaN_list.
+
+    Parameters
+
+        values : array_like, optional
+            Initial values."""
+
+    def __init__(self, values=()):
+        self.count = 0
+        self.nan_count = 0
+        self._mean = 0.0
+        self._M2 = 0.0  # sum of squared deviations from the mean
+
+        for value in values:
+            self.update(value)
+
+    def update(self, value):
+        if math.isnan(value):
+            self.nan_count += 1
+            return
+
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._M2 += delta * (value - self._mean)
+
+    def update_array(self, values):
+        """Add an array of values (in one vectorized step)."""
+
+        values = numpy.asarray(values, dtype=float)
+        nan = numpy.isnan(values)
+        values = values[~nan]
+
+        other = RunningStats()
+        other.nan_count = int(nan.sum())
+        other.count = len(values)
+
+        if other.count != 0:
+            other._mean = values.mean()
+            other._M2 = ((values - other._mean) ** 2).sum()
+
+        return self.merge(other)
+
+    def merge(self, other):
+        """Add the values of `other` to these statistics."""
+
+        count = self.count + other.count
+        if count != 0:
+            delta = other._mean - self._mean
+            self._M2 += other._M2 + delta * delta * self.count * other.count / count
+            self._mean += delta * other.count / count
+
+        self.count = count
+        self.nan_count += other.nan_count
+        return self
+
+    def total(self):
+        """Sum of the values."""
+        return self._mean * self.count
+
+    def total_sq(self):
+        """Sum of the squared values."""
+        return self._M2 + self._mean * self._mean * self.count
+
+    def mean(self):
+        if self.count == 0:
+            return float('NaN')
+        return self._mean
+
+    def variance(self):
+        """Population variance, as _mean_variance_."""
+
+        if self.count == 0:
+            return float('NaN')
+        return self._M2 / self.count
+
+    def stdev(self):
+        return math.sqrt(self.variance())
+
+
 def Hs_prime_est(allele_freqs, n):
     """Calculate corrected Hs: the mean within-subpopulation
     heterozygosity (Nei and Chesser 1983).
@@ -168,6 +259,71 @@ def Ht_prime_est(allele_freqs, n):
     return Ht_prime_est
 
 
+def homozygosity_matrix(allele_freqs):
+    """Calculate the matrix of allele frequency products P.P' where
+    P has one row of allele frequencies per population.
+
+    The diagonal holds each population's sum of squared allele
+    frequencies (its homozygosity) and the off diagonal terms the
+    probability that alleles drawn from two populations are identical.
+    Computing this once per site provides Hs' and Ht' for every pair
+    of populations, so the cost grows with the number of populations
+    rather than the number of pairs.
+
+    Parameters
+
+        allele_freqs : array_like
+            One row of allele frequencies per population.
+
+    Returns
+
+        J : list of lists"""
+
+    P = numpy.asarray(allele_freqs, dtype=float)[:, :4]
+    return P.dot(P.T).tolist()
+
+
+def pairwise_Hs_prime_est(J, i, j):
+    """Hs' for populations i and j from the homozygosity matrix J.
+    Equivalent to Hs_prime_est([p_i, p_j], 2)."""
+
+    return ((1.0 - J[i][i]) + (1.0 - J[j][j])) / 2.0
+
+
+def pairwise_Ht_prime_est(J, i, j):
+    """Ht' for populations i and j from the homozygosity matrix J.
+    Equivalent to Ht_prime_est([p_i, p_j], 2) since the pooled
+    frequencies are (p_i + p_j) / 2:
+
+        Ht' = Hs' + |p_i - p_j|**2 / 4
+
+    Written this way Ht' is exactly Hs' when the two populations
+    have the same allele frequencies."""
+
+    return pairwise_Hs_prime_est(J, i, j) + (J[i][i] - 2.0 * J[i][j] + J[j][j]) / 4.0
+
+
+def global_Hs_prime_est(J):
+    """Hs' across all populations from the homozygosity matrix J.
+    Equivalent to Hs_prime_est(allele_freqs, len(J))."""
+
+    n = float(len(J))
+    Hj = [1.0 - J[i][i] for i in range(len(J))]
+    return (1 / n) * sum(Hj)
+
+
+def global_Ht_prime_est(J):
+    """Ht' across all populations from the homozygosity matrix J.
+    Equivalent to Ht_prime_est(allele_freqs, len(J)):
+
+        Ht' = Hs' + sum(|p_i - p_j|**2 for i < j) / n**2"""
+
+    n = float(len(J))
+    divergence = sum([J[i][i] - 2.0 * J[i][j] + J[j][j]
+                      for i in range(len(J)) for j in range(i + 1, len(J))])
+    return global_Hs_prime_est(J) + divergence / (n ** 2)
+
+
 def Ht_est(Ht_p_est, Hs_est, harm_mean, n):
     """Basic Equation: Ht+Hs_est/(2*N_harmonic*n)"""
 
@@ -283,7 +439,7 @@ def multilocus_D_est(Ht_est, Hs_est, n):
     """Calculate Dest values using Anne Chao's harmonic mean."""
 
     pairs = zip(Ht_est, Hs_est)
-    Dest_values = [D_est(pair[0], pair[1], 2) for pair in pairs]
+    Dest_values = [D_est(pair[0], pair[1], n) for pair in pairs]
     ml_D_est = harmonic_mean_chao(Dest_values)
     stdev = _stdev_(Dest_values)
     return (ml_D_est, stdev)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Confidence intervals and significance tests for the multilocus estimators.
+
+Bootstrap CIs resample the loci (sites) within a window. The block
+jackknife treats each window as a block and gives the uncertainty of
+genome-wide (or chromosome-wide) multilocus estimates. Permutation
+tests shuffle samples between a pair of populations.
+
+All estimators are vectorized over replicates: each row of the Ht and
+Hs arrays is one replicate and each column a locus.
+"""
+
+import math
+from pypgen.misc.helpers import lazy_import
+
+
+numpy = lazy_import('numpy')
+
+
+ESTIMATORS = ('Gst_est', 'G_prime_st_est', 'G_double_prime_st_est', 'D_est')
+
+
+def _divide(numerator, denominator):
+    """Elementwise division returning 0.0 where the denominator is 0.0,
+    matching the scalar estimators in pypgen.fstats.fstats."""
+
+    numerator, denominator = numpy.broadcast_arrays(numerator, denominator)
+    result = numpy.zeros(numerator.shape)
+    nonzero = denominator != 0.0
+    result[nonzero] = numerator[nonzero] / denominator[nonzero]
+    return result
+
+
+def chao_harmonic_mean(A, varD):
+    """Chao's harmonic mean, 1/[(1/A)+var(D)(1/A)**3], from the mean
+    and variance of D. Vectorized version of fstats.harmonic_mean_chao."""
+
+    A = numpy.asarray(A, dtype=float)
+    inverse_A = _divide(1.0, A)
+    return _divide(1.0, inverse_A + varD * inverse_A ** 3)
+
+
+def multilocus_estimates_from_means(Ht_mean, Hs_mean, D_mean, D_var, n):
+    """Multilocus Gst, G'st, G''st and Dest from the mean Ht and Hs
+    across loci and the mean and variance of the per locus D values."""
+
+    n = float(n)
+    Gst = _divide(Ht_mean - Hs_mean, Ht_mean)
+    G_prime = _divide(Gst * (n - 1.0 + Hs_mean), (n - 1.0) * (1.0 - Hs_mean))
+    G_double_prime = _divide(n * (Ht_mean - Hs_mean), (n * Ht_mean - Hs_mean) * (1.0 - Hs_mean))
+    Dest = chao_harmonic_mean(D_mean, D_var)
+
+    return dict(zip(ESTIMATORS, (Gst, G_prime, G_double_prime, Dest)))
+
+
+def per_locus_D(Ht_est, Hs_est, n):
+    """Vectorized fstats.D_est."""
+
+    n = float(n)
+    return _divide(Ht_est - Hs_est, 1.0 - Hs_est) * (n / (n - 1.0))
+
+
+def multilocus_estimates(Ht_est, Hs_est, n):
+    """Multilocus estimators for each row (replicate) of the 2D
+    arrays Ht_est and Hs_est (replicates x loci)."""
+
+    Ht_est = numpy.atleast_2d(Ht_est)
+    Hs_est = numpy.atleast_2d(Hs_est)
+    D = per_locus_D(Ht_est, Hs_est, n)
+
+    return multilocus_estimates_from_means(Ht_est.mean(axis=1), Hs_est.mean(axis=1),
+                                           D.mean(axis=1), D.var(axis=1), n)
+
+
+def clean_loci(Ht_est, Hs_est):
+    """Return Ht and Hs as arrays with the NaN loci removed."""
+
+    Ht_est = numpy.asarray(Ht_est, dtype=float)
+    Hs_est = numpy.asarray(Hs_est, dtype=float)
+    keep = ~(numpy.isnan(Ht_est) | numpy.isnan(Hs_est))
+    return Ht_est[keep], Hs_est[keep]
+
+
+def bootstrap_ci(Ht_est, Hs_est, n, replicates=1000, confidence=0.95, seed=None, batch_size=None):
+    """Percentile bootstrap confidence intervals for the multilocus
+    estimators, resampling loci with replacement.
+
+    Replicates are generated as a (batch x loci) index array so each
+    batch is a handful of array operations. `batch_size` bounds the
+    memory used (default: about 4 million resampled values per batch).
+
+    Returns
+
+        {estimator: (low, high)}"""
+
+    Ht_est, Hs_est = clean_loci(Ht_est, Hs_est)
+    loci = len(Ht_est)
+
+    if loci == 0 or replicates == 0:
+        return dict((stat, (float('NaN'), float('NaN'))) for stat in ESTIMATORS)
+
+    if batch_size is None:
+        batch_size = max(1, 4000000 // loci)
+
+    random_state = numpy.random.RandomState(seed)
+    D = per_locus_D(Ht_est, Hs_est, n)
+
+    estimates = dict((stat, []) for stat in ESTIMATORS)
+    for first in xrange(0, replicates, batch_size):
+        size = min(batch_size, replicates - first)
+        index = random_state.randint(0, loci, size=(size, loci))
+
+        D_sample = D[index]
+        batch = multilocus_estimates_from_means(Ht_est[index].mean(axis=1), Hs_est[index].mean(axis=1),
+                                                D_sample.mean(axis=1), D_sample.var(axis=1), n)
+        for stat in ESTIMATORS:
+            estimates[stat].append(batch[stat])
+
+    tail = (1.0 - confidence) / 2.0 * 100
+    intervals = {}
+    for stat in ESTIMATORS:
+        values = numpy.concatenate(estimates[stat])
+        low, high = numpy.percentile(values, [tail, 100 - tail])
+        intervals[stat] = (float(low), float(high))
+
+    return intervals
+
+
+def window_sums(Ht_est, Hs_est, n):
+    """Sufficient statistics of a window for the block jackknife:
+    [loci, sum(Ht), sum(Hs), sum(D), sum(D**2)]."""
+
+    Ht_est, Hs_est = clean_loci(Ht_est, Hs_est)
+    D = per_locus_D(Ht_est, Hs_est, n)
+    return numpy.array([len(Ht_est), Ht_est.sum(), Hs_est.sum(), D.sum(), (D ** 2).sum()])
+
+
+def estimates_from_sums(sums, n):
+    """Multilocus estimators from (an array of) window_sums."""
+
+    sums = numpy.atleast_2d(sums)
+    loci = sums[:, 0]
+    D_mean = _divide(sums[:, 3], loci)
+    D_var = _divide(sums[:, 4], loci) - D_mean ** 2
+
+    return multilocus_estimates_from_means(_divide(sums[:, 1], loci), _divide(sums[:, 2], loci),
+                                           D_mean, numpy.maximum(D_var, 0.0), n)
+
+
+def normal_quantile(p):
+    """Quantile of the standard normal distribution (by bisection on erf)."""
+
+    low, high = -40.0, 40.0
+    for i in range(100):
+        middle = (low + high) / 2.0
+        if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2.0
+
+
+def block_jackknife(sums, n, confidence=0.95):
+    """Delete-one-block jackknife over windows.
+
+    Parameters
+
+        sums : array_like
+            One row of window_sums per window (block).
+
+        n : int
+            The number of populations.
+
+    Returns
+
+        {estimator: (estimate, standard error, low, high)}"""
+
+    sums = numpy.atleast_2d(numpy.asarray(sums, dtype=float))
+    sums = sums[sums[:, 0] > 0]
+    blocks = len(sums)
+
+    total = sums.sum(axis=0)
+    estimates = estimates_from_sums(total, n)
+
+    if blocks < 2:
+        return dict((stat, (float(estimates[stat][0]), float('NaN'), float('NaN'), float('NaN')))
+                    for stat in ESTIMATORS)
+
+    leave_one_out = estimates_from_sums(total - sums, n)
+    z = normal_quantile(1.0 - (1.0 - confidence) / 2.0)
+
+    results = {}
+    for stat in ESTIMATORS:
+        estimate = float(estimates[stat][0])
+        replicates = leave_one_out[stat]
+        se = math.sqrt((blocks - 1.0) / blocks * ((replicates - replicates.mean()) ** 2).sum())
+        results[stat] = (estimate, se, estimate - z * se, estimate + z * se)
+
+    return results
+
+
+def _permuted_Hs_and_Ht(counts_A, counts_B, n=2):
+    """Per locus Hs_est and Ht_est for batches of allele counts.
+
+    counts_A and counts_B are (replicates x loci x alleles) arrays.
+    Loci where either population has no alleles are NaN."""
+
+    N_A = counts_A.sum(axis=2)
+    N_B = counts_B.sum(axis=2)
+    valid = (N_A > 0) & (N_B > 0)
+
+    p_A = counts_A / numpy.where(N_A > 0, N_A, 1.0)[:, :, None]
+    p_B = counts_B / numpy.where(N_B > 0, N_B, 1.0)[:, :, None]
+
+    J_AA = (p_A * p_A).sum(axis=2)
+    J_BB = (p_B * p_B).sum(axis=2)
+    J_AB = (p_A * p_B).sum(axis=2)
+
+    Hs_prime = ((1.0 - J_AA) + (1.0 - J_BB)) / 2.0
+    Ht_prime = Hs_prime + (J_AA - 2.0 * J_AB + J_BB) / 4.0
+
+    harm_mean = n / (1.0 / numpy.where(valid, N_A, 1.0) + 1.0 / numpy.where(valid, N_B, 1.0))
+    Hs_est = ((2.0 * harm_mean) / (2.0 * harm_mean - 1.0)) * Hs_prime
+    Ht_est = Ht_prime + Hs_est / (2.0 * harm_mean * n)
+
+    Hs_est[~valid] = float('NaN')
+    Ht_est[~valid] = float('NaN')
+    return Ht_est, Hs_est
+
+
+def _masked_multilocus_estimates(Ht_est, Hs_est, n=2):
+    """multilocus_estimates for each row ignoring the NaN loci of that row."""
+
+    valid = ~(numpy.isnan(Ht_est) | numpy.isnan(Hs_est))
+    loci = valid.sum(axis=1).astype(float)
+
+    Ht_est = numpy.where(valid, Ht_est, 0.0)
+    Hs_est = numpy.where(valid, Hs_est, 0.0)
+    D = numpy.where(valid, per_locus_D(Ht_est, Hs_est, n), 0.0)
+
+    D_mean = _divide(D.sum(axis=1), loci)
+    D_var = _divide((D ** 2).sum(axis=1), loci) - D_mean ** 2
+
+    return multilocus_estimates_from_means(_divide(Ht_est.sum(axis=1), loci), _divide(Hs_est.sum(axis=1), loci),
+                                           D_mean, numpy.maximum(D_var, 0.0), n)
+
+
+def permutation_test(genotypes, size_A, permutations=1000, seed=None, batch_size=100, threads=1):
+    """Permutation test of differentiation between two populations.
+
+    Sample to population labels are shuffled and the multilocus Gst
+    and Dest recalculated from the window's genotypes. Each batch of
+    permutations is a (batch x samples) membership matrix, so the
+    allele counts of every permutation in the batch come from a single
+    matrix product. With threads > 1 batches run in a thread pool
+    (numpy releases the GIL for the heavy array operations).
+
+    Parameters
+
+        genotypes : array_like
+            Allele counts per site, sample and allele (loci x samples x
+            alleles). The first size_A samples belong to population A
+            and the rest to population B.
+
+        size_A : int
+            Number of samples in population A.
+
+    Returns
+
+        {estimator: (observed value, p-value)} for Gst_est and D_est.
+        p-values are (1 + #permutations >= observed) / (1 + permutations)."""
+
+    genotypes = numpy.asarray(genotypes, dtype=float)
+    loci, samples, alleles = genotypes.shape
+
+    flat = genotypes.transpose(1, 0, 2).reshape(samples, loci * alleles)
+    total = flat.sum(axis=0).reshape(1, loci, alleles)
+
+    def estimates(membership):
+        counts_A = membership.dot(flat).reshape(len(membership), loci, alleles)
+        Ht_est, Hs_est = _permuted_Hs_and_Ht(counts_A, total - counts_A)
+        return _masked_multilocus_estimates(Ht_est, Hs_est)
+
+    observed_membership = numpy.zeros((1, samples))
+    observed_membership[0, :size_A] = 1.0
+    observed = estimates(observed_membership)
+
+    stats = ('Gst_est', 'D_est')
+    if loci == 0 or permutations == 0:
+        return dict((stat, (float(observed[stat][0]), float('NaN'))) for stat in stats)
+
+    # DRAW EVERY BATCH'S LABELS UP FRONT SO RESULTS DON'T DEPEND ON THREADS
+    random_state = numpy.random.RandomState(seed)
+    batches = []
+    for first in xrange(0, permutations, batch_size):
+        size = min(batch_size, permutations - first)
+        ranks = random_state.rand(size, samples).argsort(axis=1)
+        batches.append((ranks < size_A).astype(float))
+
+    def exceedances(membership):
+        permuted = estimates(membership)
+        return dict((stat, int((permuted[stat] >= observed[stat][0] - 1e-12).sum())) for stat in stats)
+
+    if threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        counts = pool.map(exceedances, batches)
+        pool.close()
+        pool.join()
+    else:
+        counts = map(exceedances, batches)
+
+    results = {}
+    for stat in stats:
+        exceeded = sum(count[stat] for count in counts)
+        results[stat] = (float(observed[stat][0]), (1.0 + exceeded) / (1.0 + permutations))
+
+    return results
@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Reading and writing BGZF (blocked gzip) files and their tabix indexes.
+
+BGZF files are a series of independent gzip members, each holding at
+most 64 KB of data, so they can be decompressed in parallel and
+randomly accessed with 'virtual offsets': (compressed block offset << 16)
+| offset within the uncompressed block. BgzfReader streams a whole file,
+decompressing the blocks in a pool of threads. split_ranges cuts a file
+into ranges of lines that can be read in parallel without an index.
+"""
+
+import os
+import gzip
+import zlib
+import Queue
+import struct
+import cStringIO
+import threading
+import collections
+
+
+BLOCK_SIZE = 0xff00   # uncompressed bytes per block, same as bgzip
+MAX_BLOCK_SIZE = 0x10000
+
+# empty block that marks the end of a BGZF file
+EOF_BLOCK = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+             "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+TBX_GENERIC = 0
+TBX_SAM = 1
+TBX_VCF = 2
+TBX_UCSC = 0x10000
+
+LINEAR_SHIFT = 14    # size of linear index windows (16 kb)
+
+READ_THREADS = 4       # threads decompressing ahead of a BgzfReader
+BLOCKS_PER_TASK = 16   # blocks decompressed by a thread at once (~1 MB)
+
+
+def compress_block(data, level=6):
+    """Compress `data` (<= BLOCK_SIZE bytes) into a single BGZF block."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    bsize = len(cdata) + 25   # total block size minus one
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize)
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+
+class BgzfWriter(object):
+    """Write a BGZF file.
+
+    Data is cut into BLOCK_SIZE blocks. When `threaded` is True the
+    blocks are compressed and written by a background thread so that
+    the caller is not held up by deflate. zlib releases the GIL so
+    this really does run concurrently with the caller.
+
+    Because every block except the last is exactly BLOCK_SIZE bytes
+    an uncompressed offset `u` maps to the virtual offset
+    (block_offsets[u / BLOCK_SIZE] << 16) | (u % BLOCK_SIZE) once the
+    file is closed. See virtual_offset.
+    """
+
+    def __init__(self, path, threaded=True, level=6, queue_size=64):
+        self.fileobj = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.tell = 0            # uncompressed bytes written
+        self.block_offsets = []  # compressed offset of each block
+        self.threaded = threaded
+        self.error = None
+        self.closed = False
+
+        if threaded:
+            self.queue = Queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._compress_blocks)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _write_block(self, data):
+        self.block_offsets.append(self.fileobj.tell())
+        self.fileobj.write(compress_block(data, self.level))
+
+    def _compress_blocks(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is not None:
+                continue      # keep draining so the producer never blocks
+            try:
+                self._write_block(data)
+            except Exception as e:
+                self.error = e
+
+    def _emit(self, data):
+        if self.threaded:
+            if self.error is not None:
+                raise self.error
+            self.queue.put(data)
+        else:
+            self._write_block(data)
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.tell += len(data)
+
+        if len(self.buffer) >= BLOCK_SIZE:
+            full = (len(self.buffer) // BLOCK_SIZE) * BLOCK_SIZE
+            for start in xrange(0, full, BLOCK_SIZE):
+                self._emit(bytes(self.buffer[start:start + BLOCK_SIZE]))
+            del self.buffer[:full]
+
+    def close(self):
+        if self.closed:
+            return
+
+        if len(self.buffer) > 0:
+            self._emit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        if self.threaded:
+            self.queue.put(None)
+            self.thread.join()
+
+        self.block_offsets.append(self.fileobj.tell())  # the EOF block
+        self.fileobj.write(EOF_BLOCK)
+        self.fileobj.close()
+        self.closed = True
+
+        if self.error is not None:
+            raise self.error
+
+    def virtual_offset(self, u):
+        """Convert an uncompressed offset to a BGZF virtual offset.
+        Only valid after close()."""
+
+        return (self.block_offsets[u // BLOCK_SIZE] << 16) | (u % BLOCK_SIZE)
+
+
+def read_block(fileobj):
+    """Read the BGZF block at the current position of fileobj.
+
+    Returns (cdata, crc, isize): the raw deflate data and the CRC32
+    and length of the uncompressed data, or None at the end of the
+    file. Raises IOError if the block is not a BGZF block."""
+
+    header = fileobj.read(12)
+    if len(header) == 0:
+        return None
+
+    if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+        raise IOError("Not a BGZF block (compress the file with bgzip)")
+
+    xlen = struct.unpack("<H", header[10:12])[0]
+    bsize = bgzf_block_size(fileobj.read(xlen))
+    if bsize is None:
+        raise IOError("Not a BGZF block (compress the file with bgzip)")
+
+    cdata = fileobj.read(bsize - xlen - 20)
+    footer = fileobj.read(8)
+    if len(footer) < 8:
+        raise IOError("Truncated BGZF block")
+
+    crc, isize = struct.unpack("<II", footer)
+    return cdata, crc, isize
+
+
+def bgzf_block_size(extra):
+    """Total size of a block from the extra field of its header (the
+    BC subfield), or None if there is none."""
+
+    position = 0
+    while position + 4 <= len(extra):
+        si1, si2, slen = struct.unpack("<BBH", extra[position:position + 4])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return struct.unpack("<H", extra[position + 4:position + 6])[0] + 1
+        position += 4 + slen
+    return None
+
+
+def is_bgzf(path):
+    """True if path starts with a BGZF block."""
+
+    with open(path, 'rb') as fileobj:
+        header = fileobj.read(12)
+        if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+            return False
+        return bgzf_block_size(fileobj.read(struct.unpack("<H", header[10:12])[0])) is not None
+
+
+def inflate_blocks(blocks):
+    """Decompress and check a list of read_block blocks, joined. Each
+    block is followed by the (begin, end) slice of its data to keep
+    (None for all of it)."""
+
+    data = []
+    for cdata, crc, isize, begin, end in blocks:
+        block = zlib.decompressobj(-15).decompress(cdata)
+        if len(block) != isize or zlib.crc32(block) & 0xffffffff != crc:
+            raise IOError("Corrupt BGZF block (CRC or length mismatch)")
+        if begin or end is not None:
+            block = block[begin:end]
+        data.append(block)
+    return "".join(data)
+
+
+def _inflate_tasks(tasks):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        batch, result = task
+        try:
+            result.put((True, inflate_blocks(batch)))
+        except Exception as e:
+            result.put((False, e))
+
+
+def _result(result):
+    ok, value = result.get()
+    if not ok:
+        raise value
+    return value
+
+
+class BgzfReader(object):
+    """Lines of a BGZF file, decompressed by a pool of threads.
+
+    The consumer's thread reads the compressed blocks and hands
+    batches of blocks_per_task of them to the pool, keeping up to
+    tasks_ahead batches in flight; zlib releases the GIL while it
+    inflates, so the blocks are decompressed concurrently with the
+    consumer (e.g., parsing lines). Lines come out in file order, the
+    same as iterating over gzip.open(path, 'rb').
+
+    start and stop are virtual offsets to read only part of the file,
+    such as a range of split_ranges (stop None for the end).
+
+        for line in BgzfReader('example.vcf.gz'):
+            ..."""
+
+    def __init__(self, path, threads=READ_THREADS, blocks_per_task=BLOCKS_PER_TASK, tasks_ahead=None,
+                 start=0, stop=None):
+        self.fileobj = open(path, 'rb')
+        self.start = start
+        self.stop = stop
+        self.threads = threads
+        self.blocks_per_task = blocks_per_task
+        self.tasks_ahead = tasks_ahead if tasks_ahead is not None else 2 * threads
+        self.lines = self._lines()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.lines.next()
+
+    def _blocks(self):
+        """The blocks from start to stop, each with its slice to keep."""
+
+        begin = self.start & 0xffff
+        stop_block, stop_within = None, None
+        if self.stop is not None:
+            stop_block, stop_within = self.stop >> 16, self.stop & 0xffff
+
+        self.fileobj.seek(self.start >> 16)
+        while True:
+            offset = self.fileobj.tell()
+            if stop_block is not None and (offset > stop_block or (offset == stop_block and stop_within == 0)):
+                break
+
+            block = read_block(self.fileobj)
+            if block is None:
+                break
+
+            yield block + (begin, stop_within if offset == stop_block else None)
+            begin = 0
+
+    def _batches(self):
+        batch = []
+        for block in self._blocks():
+            batch.append(block)
+            if len(batch) == self.blocks_per_task:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _data(self):
+        """Decompressed data of each batch of blocks, in order."""
+
+        if self.threads < 2:
+            for batch in self._batches():
+                yield inflate_blocks(batch)
+            return
+
+        tasks = Queue.Queue()
+        threads = [threading.Thread(target=_inflate_tasks, args=(tasks,)) for count in xrange(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # each batch gets its own result queue, so they are read in order
+        pending = collections.deque()
+        try:
+            for batch in self._batches():
+                result = Queue.Queue(maxsize=1)
+                tasks.put((batch, result))
+                pending.append(result)
+                if len(pending) >= self.tasks_ahead:
+                    yield _result(pending.popleft())
+
+            while pending:
+                yield _result(pending.popleft())
+        finally:
+            # drop the batches not started yet (if the lines weren't
+            # all read) and wait for the threads
+            try:
+                while True:
+                    tasks.get_nowait()
+            except Queue.Empty:
+                pass
+
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _lines(self):
+        rest = ""
+        for data in self._data():
+            end = data.rfind("\n") + 1
+            if end == 0:
+                rest += data
+                continue
+
+            for line in cStringIO.StringIO(rest + data[:end]):
+                yield line
+            rest = data[end:]
+
+        if rest:
+            yield rest
+
+    def close(self):
+        self.lines.close()   # stops the pool if the lines weren't all read
+        self.fileobj.close()
+
+
+def block_size_at(fileobj, offset):
+    """Size of the BGZF block starting at offset, or None if there is
+    no block header there."""
+
+    fileobj.seek(offset)
+    header = fileobj.read(12)
+    if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+        return None
+    return bgzf_block_size(fileobj.read(struct.unpack("<H", header[10:12])[0]))
+
+
+def next_block(fileobj, offset, size):
+    """Offset of the first BGZF block that starts at or after offset
+    (size, the size of the file, if there is none).
+
+    Blocks are found without an index by looking for the gzip magic
+    in the next MAX_BLOCK_SIZE bytes. A match only counts if it
+    parses as a block header and is followed by another block (or the
+    end of the file), which rules out the magic turning up in
+    compressed data."""
+
+    fileobj.seek(offset)
+    window = fileobj.read(MAX_BLOCK_SIZE + 18)
+
+    position = window.find("\x1f\x8b\x08\x04")
+    while position != -1:
+        candidate = offset + position
+        bsize = block_size_at(fileobj, candidate)
+        if bsize is not None and (candidate + bsize == size or block_size_at(fileobj, candidate + bsize) is not None):
+            return candidate
+        position = window.find("\x1f\x8b\x08\x04", position + 1)
+
+    return size
+
+
+def line_start(fileobj, offset):
+    """Virtual offset just after the first newline at or after the
+    start of the BGZF block at offset, or None if there is none.
+
+    Ranges are cut there (a line that starts exactly at the block goes
+    to the range before), so every line is in exactly one range."""
+
+    fileobj.seek(offset)
+    while True:
+        block_offset = fileobj.tell()
+        block = read_block(fileobj)
+        if block is None:
+            return None
+
+        newline = inflate_blocks([block + (0, None)]).find("\n")
+        if newline != -1:
+            return (block_offset << 16) | (newline + 1)
+
+
+def split_ranges(path, parts):
+    """Split a BGZF file into up to `parts` (start, stop) ranges of
+    virtual offsets of about the same compressed size, for BgzfReader.
+    Ranges start and stop at the start of a line; the last stops at
+    None (the end). No index is needed: only a few blocks around each
+    cut are read."""
+
+    size = os.path.getsize(path)
+    cuts = [0]
+
+    with open(path, 'rb') as fileobj:
+        for part in xrange(1, parts):
+            block = next_block(fileobj, size * part // parts, size)
+            if block >= size:
+                break
+
+            cut = line_start(fileobj, block)
+            if cut is None:
+                break
+            if cut > cuts[-1]:
+                cuts.append(cut)
+
+    return zip(cuts, cuts[1:] + [None])
+
+
+def open_bgzf(path, threads=READ_THREADS):
+    """Iterable of the lines of a gzipped file with a close() method:
+    a BgzfReader if it is BGZF, otherwise a gzip file."""
+
+    if is_bgzf(path):
+        return BgzfReader(path, threads)
+    return gzip.open(path, 'rb')
+
+
+def reg2bin(beg, end):
+    """UCSC binning scheme: smallest bin containing [beg, end)."""
+
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class TabixIndexBuilder(object):
+    """Build a tabix (.tbi) index while a BGZF file is written.
+
+    Records are added in file order with the uncompressed offsets of
+    the start and end of their line. Only the bins and the linear
+    index are kept in memory, so the cost does not grow with the
+    number of records. The offsets are translated into virtual offsets
+    by write() once the BGZF file has been closed.
+
+    Columns are 1-based as in tabix; `end_col` of 0 means records are
+    one base long (e.g., per SNP output).
+    """
+
+    def __init__(self, seq_col=1, beg_col=2, end_col=3, preset=TBX_GENERIC,
+                 meta_char='#', skip=0, zero_based=False):
+        self.seq_col = seq_col
+        self.beg_col = beg_col
+        self.end_col = end_col
+        self.preset = preset | (TBX_UCSC if zero_based else 0)
+        self.zero_based = zero_based
+        self.meta_char = meta_char
+        self.skip = skip
+
+        self.names = []
+        self.bins = []      # per sequence: {bin: [[u_beg, u_end], ...]}
+        self.linear = []    # per sequence: {window: u_beg}
+        self.last = None    # start of the previous record
+
+    def interval(self, fields):
+        """Return the 0-based, half-open interval of a record the
+        same way tabix parses it."""
+
+        beg = int(fields[self.beg_col - 1])
+        if self.zero_based is False:
+            beg -= 1
+
+        if self.end_col:
+            end = int(fields[self.end_col - 1])
+        elif self.preset & 0xffff == TBX_VCF:
+            end = beg + len(fields[3])
+        else:
+            end = beg + 1
+
+        if end <= beg:
+            end = beg + 1
+
+        return beg, end
+
+    def add(self, fields, u_beg, u_end):
+        """Add a record (a list of column values) found between the
+        uncompressed offsets u_beg and u_end."""
+
+        name = fields[self.seq_col - 1]
+        beg, end = self.interval(fields)
+
+        if len(self.names) == 0 or self.names[-1] != name:
+            if name in self.names:
+                raise ValueError("Output is not sorted: {} appears in more than one block. "
+                                 "Submit regions in coordinate order.".format(name))
+            self.names.append(name)
+            self.bins.append({})
+            self.linear.append({})
+
+        elif beg < self.last:
+            raise ValueError("Output is not sorted: {}:{} follows {}:{}".format(name, beg + 1, name, self.last + 1))
+
+        self.last = beg
+
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        if len(chunks) != 0 and chunks[-1][1] == u_beg:
+            chunks[-1][1] = u_end
+        else:
+            chunks.append([u_beg, u_end])
+
+        linear = self.linear[-1]
+        for window in xrange(beg >> LINEAR_SHIFT, ((end - 1) >> LINEAR_SHIFT) + 1):
+            if window not in linear:
+                linear[window] = u_beg
+
+    def write(self, path, virtual_offset):
+        """Write the index to `path`. `virtual_offset` converts
+        uncompressed offsets to virtual offsets (BgzfWriter.virtual_offset)."""
+
+        names = "".join(name + "\0" for name in self.names)
+        data = [struct.pack("<4si", "TBI\1", len(self.names)),
+                struct.pack("<6i", self.preset, self.seq_col, self.beg_col, self.end_col,
+                            ord(self.meta_char), self.skip),
+                struct.pack("<i", len(names)), names]
+
+        for bins, linear in zip(self.bins, self.linear):
+            data.append(struct.pack("<i", len(bins)))
+            for bin_id in sorted(bins):
+                chunks = bins[bin_id]
+                data.append(struct.pack("<Ii", bin_id, len(chunks)))
+                for u_beg, u_end in chunks:
+                    data.append(struct.pack("<QQ", virtual_offset(u_beg), virtual_offset(u_end)))
+
+            # windows without records point at the previous record
+            # (or the first one) so queries never start too late.
+            n_windows = max(linear) + 1 if linear else 0
+            offsets = []
+            previous = linear[min(linear)] if linear else 0
+            for window in xrange(n_windows):
+                previous = linear.get(window, previous)
+                offsets.append(virtual_offset(previous))
+
+            data.append(struct.pack("<i", n_windows))
+            data.append(struct.pack("<{}Q".format(n_windows), *offsets))
+
+        index = BgzfWriter(path, threaded=False)
+        index.write("".join(data))
+        index.close()
+
+
+class IndexedBgzfWriter(object):
+    """Write coordinate sorted, tab delimited text as BGZF and build
+    its tabix index on the fly (written to `path` + '.tbi' by close())."""
+
+    def __init__(self, path, index, threaded=True):
+        self.path = path
+        self.index = index
+        self.bgzf = BgzfWriter(path, threaded=threaded)
+
+    def write_header(self, line):
+        self.bgzf.write(line)
+
+    def write_record(self, fields):
+        line = "\t".join(fields) + "\n"
+        u_beg = self.bgzf.tell
+        self.bgzf.write(line)
+        self.index.add(fields, u_beg, self.bgzf.tell)
+
+    def close(self):
+        self.bgzf.close()
+        self.index.write(self.path + '.tbi', self.bgzf.virtual_offset)
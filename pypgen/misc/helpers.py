@@ -1,18 +1,47 @@
 import os
 import sys
-import gzip
-import datetime
-import numpy
+import types
+import importlib
 
 
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute
+    access. Its attributes are then copied over, so later lookups cost
+    the same as on the module itself."""
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Return module `name`, or a LazyModule for it if it has not been
+    imported yet. Used for heavy modules (numpy, pysam) so that
+    `--help` and argument errors don't pay for importing them."""
+
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def is_float(value):
+    """True for Python floats and numpy floating point scalars (without
+    importing numpy: if it isn't imported, value can't be a numpy float)."""
+
+    if isinstance(value, float):    # includes numpy.float64
+        return True
+
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(value, numpy.floating)
+
 
 def float_2_string(value, places):
     """Convert value to string truncting the number
         of decimals at the number of places given by
         the places arguement. """
 
-    float_types = [float, numpy.float, numpy.float128, numpy.float16, numpy.float32, numpy.float64]
-    if type(value) in float_types:
+    if is_float(value):
         value = str(round(value, places))
 
     else:
@@ -44,30 +73,24 @@ def float_2_string(value, places):
 #         return getattr(self.stream, attr)
 
 
-def open_vcf(args):
-    if args.input.endswith('.gz') == True:  # To Do: This is hacky.
-        fin = gzip.open(args.input, 'rb')
+def open_text(path, read_ahead=True):
+    """Open a text file, which is decompressed if its name ends with
+    .gz (by several threads if it is BGZF, see bgzf.BgzfReader). Pass
+    read_ahead=False to read only a few lines, such as the header:
+    gzip then decompresses them in this thread, which costs less than
+    starting the reader's threads."""
+    import gzip
+    from pypgen.misc import bgzf
+
+    if path.endswith('.gz') == True and read_ahead == False:
+        fin = gzip.open(path, 'rb')
+    elif path.endswith('.gz') == True:  # To Do: This is hacky.
+        fin = bgzf.open_bgzf(path)
     else:
-        fin = open(args.input, 'rU')
+        fin = open(path, 'rU')
 
     return fin
 
 
-def progress_meter(starting_time, chrm, pos, bp_processed, total_bp_in_dataset):
-
-    #sys.stdout=Unbuffered(sys.stdout) # make sure writing to std out isn't buffered
-
-    ct = datetime.datetime.now()
-    elapsed = (datetime.datetime.now() - starting_time)
-
-    proportion_processed = bp_processed / float(total_bp_in_dataset)
-
-    if elapsed.seconds % 30 == 0 and elapsed.seconds > 10:
-
-        "INFO  19:29:31,683 ProgressMeter - GL343193.1:820101\t1.79e+09\t2.3 h\t4.6 s\t99.2%\t2.3 h\t62.5 s "
-        status = "INFO  {} ProgressMeter - {}:{:,} {:.3} {:.2%}\n".format(ct.time(), chrm, pos, elapsed, proportion_processed)
-        sys.stdout.write(status)
-        return ct
-
-    else:
-        return starting_time
+def open_vcf(args):
+    return open_text(args.input)
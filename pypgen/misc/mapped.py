@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Reading uncompressed text files (e.g., plain .vcf) through a shared,
+read-only memory map.
+
+newline_index finds the offset of every newline, scanning the mapping
+INDEX_CHUNK_BYTES at a time with numpy, and split_lines uses it to cut
+the file into ranges holding about the same number of lines. Each
+worker then reads the lines of its own range straight from the mapping
+(mapped_lines). The file is mapped before the workers are forked, so
+they share the mapping and its pages; no line is read by the parent
+and sent on to a worker.
+"""
+
+import os
+import mmap
+import cStringIO
+from pypgen.misc.helpers import lazy_import
+
+numpy = lazy_import('numpy')
+
+
+INDEX_CHUNK_BYTES = 1 << 24   # bytes searched for newlines at once
+READ_CHUNK_BYTES = 1 << 20    # bytes of lines copied out of the mapping at once
+
+
+_mappings = {}   # mappings of this process (and the workers it forks), by path
+
+
+def open_mapping(path):
+    """Read-only mmap of path, mapped once per process. Empty files
+    (which can not be mapped) give an empty string."""
+
+    mapping = _mappings.get(path)
+    if mapping is None:
+        with open(path, 'rb') as fileobj:
+            if os.fstat(fileobj.fileno()).st_size == 0:
+                mapping = ""
+            else:
+                mapping = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        _mappings[path] = mapping
+    return mapping
+
+
+def newline_index(path, chunk_bytes=INDEX_CHUNK_BYTES):
+    """int64 array of the offset of each newline of path."""
+
+    mapping = open_mapping(path)
+    if len(mapping) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    data = numpy.frombuffer(mapping, dtype=numpy.uint8)
+    offsets = [numpy.flatnonzero(data[start:start + chunk_bytes] == ord('\n')) + start
+               for start in xrange(0, len(data), chunk_bytes)]
+    return numpy.concatenate(offsets).astype(numpy.int64)
+
+
+def split_lines(path, parts):
+    """Split path into up to `parts` (start, stop) byte ranges, each
+    holding whole lines, about the same number of them."""
+
+    size = len(open_mapping(path))
+    line_ends = newline_index(path) + 1
+    if size > 0 and (len(line_ends) == 0 or line_ends[-1] != size):
+        line_ends = numpy.append(line_ends, size)   # the last line has no newline
+
+    cuts = [0]
+    for part in xrange(1, parts):
+        lines = len(line_ends) * part // parts
+        if lines > 0 and line_ends[lines - 1] > cuts[-1]:
+            cuts.append(int(line_ends[lines - 1]))
+
+    if size > cuts[-1] or size == 0:
+        cuts.append(size)
+    return zip(cuts[:-1], cuts[1:])
+
+
+def mapped_lines(path, start=0, stop=None):
+    """Yield the lines of path between the byte offsets start and stop
+    (None for the end of the file), which must be the starts of lines.
+    Line endings are converted as by open(path, 'rU') ('\\r\\n' to '\\n')."""
+
+    mapping = open_mapping(path)
+    if stop is None:
+        stop = len(mapping)
+
+    position = start
+    while position < stop:
+        end = min(stop, position + READ_CHUNK_BYTES)
+        if end < stop:
+            # copy whole lines only
+            newline = mapping.rfind('\n', position, end)
+            if newline == -1:
+                end = mapping.find('\n', end, stop) + 1 or stop
+            else:
+                end = newline + 1
+
+        data = mapping[position:end]
+        if '\r' in data:
+            data = data.replace('\r\n', '\n')
+
+        for line in cStringIO.StringIO(data):
+            yield line
+        position = end
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Profiling the worker pool (--profile PREFIX).
+
+Each worker runs its tasks under cProfile and a sampling profiler
+that records the call stack every `SAMPLE_SECONDS` of CPU time. When
+the worker exits (the pool is closed and joined) it dumps both to a
+shared temporary directory, and the parent merges them into:
+
+    PREFIX.pstats       cProfile stats of all workers (pstats, snakeviz, ...)
+    PREFIX.txt          the same sorted by cumulative time
+    PREFIX.collapsed    sampled stacks, one 'frame;frame;frame count' per
+                        line, for flamegraph.pl or speedscope
+    PREFIX.parent.pstats  cProfile stats of the parent process
+
+Tasks are wrapped with ProfiledTask so that time spent waiting for
+work in the pool is not recorded.
+"""
+
+import os
+import sys
+import glob
+import shutil
+import signal
+from collections import defaultdict
+from multiprocessing import util
+from pypgen.misc.helpers import lazy_import
+
+
+# only needed once profiling is asked for
+pstats = lazy_import('pstats')
+cProfile = lazy_import('cProfile')
+tempfile = lazy_import('tempfile')
+
+
+SAMPLE_SECONDS = 0.005
+
+_worker = None   # the WorkerProfiler of this worker process
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(object):
+    """Count the call stacks seen at a SIGPROF timer (CPU time, so
+    idle processes are not sampled). Stacks start below `root`, the
+    frame that runs the task, rather than at the pool's machinery."""
+
+    def __init__(self, interval=SAMPLE_SECONDS):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.root = None
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def sample(self, signum, frame):
+        if self.root is None:
+            return
+
+        stack = []
+        while frame is not None and frame is not self.root:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+
+        if stack:
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def write(self, path):
+        fout = open(path, 'w')
+        for stack, count in sorted(self.stacks.iteritems()):
+            fout.write("{} {}\n".format(stack, count))
+        fout.close()
+
+
+class WorkerProfiler(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler()
+
+    def run(self, function, data):
+        self.sampler.root = sys._getframe()
+        self.profile.enable()
+        try:
+            return function(data)
+        finally:
+            self.profile.disable()
+            self.sampler.root = None
+
+    def dump(self, name=None):
+        """Write the profiles as worker.<name>.* (name defaults to the pid)."""
+
+        self.sampler.stop()
+        name = os.getpid() if name is None else name
+        self.profile.dump_stats(os.path.join(self.directory, "worker.{}.pstats".format(name)))
+        self.sampler.write(os.path.join(self.directory, "worker.{}.collapsed".format(name)))
+
+
+def init_worker(directory, initializer=None, initargs=()):
+    """Pool initializer: profile the tasks of this worker, after
+    running the pool's other `initializer`."""
+
+    global _worker
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    _worker = WorkerProfiler(directory)
+
+    # run when the worker exits after the pool is closed
+    util.Finalize(_worker, _worker.dump, exitpriority=10)
+
+
+class ProfiledTask(object):
+    """Picklable wrapper that runs a (module level) task function under
+    the worker's profilers, or just runs it if profiling is off."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, data):
+        if _worker is None:
+            return self.function(data)
+        return _worker.run(self.function, data)
+
+
+class PoolProfiler(object):
+    """Profile the parent and collect the profiles of its pool.
+
+        profiler = PoolProfiler(prefix)
+        initializer, initargs = profiler.initializer(initializer, initargs)
+        pool = multiprocessing.Pool(cores, initializer=initializer, initargs=initargs)
+        for result in pool.imap(ProfiledTask(function), tasks): ...
+        pool.close(); pool.join()
+        profiler.write()
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.directory = tempfile.mkdtemp(prefix='pypgen-profile-')
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def initializer(self, initializer=None, initargs=()):
+        return init_worker, (self.directory, initializer, initargs)
+
+    def write(self):
+        """Merge the worker profiles and write the reports (see the
+        module docstring). Returns the number of workers merged."""
+
+        self.profile.disable()
+        self.profile.dump_stats(self.prefix + '.parent.pstats')
+
+        worker_stats = sorted(glob.glob(os.path.join(self.directory, 'worker.*.pstats')))
+        if worker_stats:
+            stats = pstats.Stats(*worker_stats)
+            stats.dump_stats(self.prefix + '.pstats')
+
+            fout = open(self.prefix + '.txt', 'w')
+            fout.write("Merged profile of {} worker(s)\n\n".format(len(worker_stats)))
+            pstats.Stats(*worker_stats, stream=fout).sort_stats('cumulative').print_stats(60)
+            fout.close()
+
+        stacks = defaultdict(int)
+        for path in glob.glob(os.path.join(self.directory, 'worker.*.collapsed')):
+            for line in open(path):
+                stack, count = line.rsplit(' ', 1)
+                stacks[stack] += int(count)
+
+        fout = open(self.prefix + '.collapsed', 'w')
+        for stack, count in sorted(stacks.iteritems()):
+            fout.write("{} {}\n".format(stack, count))
+        fout.close()
+
+        shutil.rmtree(self.directory)
+        return len(worker_stats)
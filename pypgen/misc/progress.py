@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Progress reporting from the worker pool.
+
+Workers add the sites, windows and base pairs they have finished with
+report(). Updates are batched and put on a queue (shared with the
+pool through init_worker) at most every `FLUSH_SECONDS`, so reporting
+costs little even once per site. A ProgressMonitor thread in the
+parent reads the queue and every `interval` seconds writes sites/s,
+windows/s, the percentage of the genome done and an ETA to STDERR
+(never STDOUT, which may hold the results), and optionally as JSON
+to a file that monitoring can read.
+
+    queue = multiprocessing.Queue()
+    monitor = ProgressMonitor(queue, total_bp, resolve_interval(args.progress_interval))
+    pool = multiprocessing.Pool(cores, initializer=init_worker, initargs=(queue,))
+    ...
+    monitor.close()
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import threading
+
+
+FLUSH_SECONDS = 0.5
+DEFAULT_INTERVAL = 30.0
+
+_reporter = None   # the Reporter of this worker process
+
+
+class Reporter(object):
+    """Batch progress updates of a worker and put them on the queue."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.reset()
+
+    def reset(self):
+        self.sites = 0
+        self.windows = 0
+        self.bp = 0
+        self.positions = {}   # furthest position reached on each chromosome
+        self.last_flush = time.time()
+
+    def add(self, sites=0, windows=0, bp=0, chrm=None, pos=None):
+        self.sites += sites
+        self.windows += windows
+        self.bp += bp
+        if chrm is not None:
+            self.positions[chrm] = max(pos, self.positions.get(chrm, 0))
+
+        if time.time() - self.last_flush >= FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        try:
+            self.queue.put_nowait((self.sites, self.windows, self.bp, self.positions))
+        except Queue.Full:
+            return   # try again with the next update
+        self.reset()
+
+
+def init_worker(queue):
+    """Pool initializer: report() puts this worker's updates on `queue`
+    (or does nothing if queue is None)."""
+
+    global _reporter
+    _reporter = None
+
+    if queue is not None:
+        queue.cancel_join_thread()   # never wait for the parent to read when exiting
+        _reporter = Reporter(queue)
+
+
+def report(sites=0, windows=0, bp=0, chrm=None, pos=None):
+    """Record finished work. Does nothing outside a pool started with
+    init_worker (e.g., in tests or a serial map)."""
+
+    if _reporter is not None:
+        _reporter.add(sites, windows, bp, chrm, pos)
+
+
+def resolve_interval(interval, path=None, stream=sys.stderr):
+    """The reporting interval: `interval` if one was given, otherwise
+    DEFAULT_INTERVAL when someone can read the reports (STDERR is a
+    terminal or a progress file is written) and 0 (off) for batch jobs,
+    which then start no queue or monitor thread."""
+
+    if interval is not None:
+        return interval
+    if path is not None or stream.isatty():
+        return DEFAULT_INTERVAL
+    return 0.0
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+class ProgressMonitor(threading.Thread):
+    """Read worker updates from `queue` and report progress every
+    `interval` seconds. total_bp (the summed length of the contigs
+    or regions analysed) is used for the percentage done and ETA."""
+
+    def __init__(self, queue, total_bp, interval=30.0, path=None, stream=sys.stderr):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.queue = queue
+        self.total_bp = total_bp
+        self.interval = interval
+        self.path = path
+        self.stream = stream
+
+        self.sites = 0
+        self.windows = 0
+        self.bp = 0
+        self.positions = {}
+        self.started = time.time()
+        self.stopping = threading.Event()
+
+        if interval > 0:
+            self.start()
+
+    def update(self, sites, windows, bp, positions):
+        self.sites += sites
+        self.windows += windows
+        self.bp += bp
+        for chrm, pos in positions.iteritems():
+            self.positions[chrm] = max(pos, self.positions.get(chrm, 0))
+
+    def metrics(self):
+        elapsed = time.time() - self.started
+        done = self.bp + sum(self.positions.itervalues())
+        fraction = min(1.0, done / float(self.total_bp)) if self.total_bp else None
+
+        eta = None
+        if fraction:
+            eta = elapsed * (1.0 - fraction) / fraction
+
+        return {'elapsed_seconds': elapsed,
+                'sites': self.sites,
+                'windows': self.windows,
+                'sites_per_second': self.sites / elapsed if elapsed > 0 else 0.0,
+                'windows_per_second': self.windows / elapsed if elapsed > 0 else 0.0,
+                'percent_done': 100.0 * fraction if fraction is not None else None,
+                'eta_seconds': eta}
+
+    def write(self):
+        metrics = self.metrics()
+
+        percent = metrics['percent_done']
+        self.stream.write("INFO  {} ProgressMeter - {:,} sites ({:.1f}/s), {:,} windows ({:.1f}/s), "
+                          "{} done, elapsed {}, ETA {}\n".format(
+                              time.strftime("%H:%M:%S"), metrics['sites'], metrics['sites_per_second'],
+                              metrics['windows'], metrics['windows_per_second'],
+                              '?' if percent is None else "{:.2f}%".format(percent),
+                              format_seconds(metrics['elapsed_seconds']),
+                              format_seconds(metrics['eta_seconds'])))
+        self.stream.flush()
+
+        if self.path is not None:
+            # replace the file at once so readers never see half of it
+            tmp_path = self.path + '.tmp'
+            fout = open(tmp_path, 'w')
+            json.dump(metrics, fout, sort_keys=True)
+            fout.write("\n")
+            fout.close()
+            os.rename(tmp_path, self.path)
+
+    def drain(self, timeout=0):
+        """Read every update on the queue, waiting up to `timeout`
+        seconds for the first one. Returns False once the None put by
+        close() has been read."""
+
+        try:
+            update = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            while update is not None:
+                self.update(*update)
+                update = self.queue.get_nowait()
+            return False
+        except Queue.Empty:
+            return True
+
+    def run(self):
+        next_report = self.started + self.interval
+        while not self.stopping.is_set():
+            if not self.drain(timeout=max(0.01, min(1.0, next_report - time.time()))):
+                break
+
+            if time.time() >= next_report:
+                self.write()
+                next_report += self.interval
+
+    def close(self, sites=None, windows=None):
+        """Stop the thread and, if a report was due at least once,
+        write a final one. The parent's own totals (sites, windows)
+        replace the worker updates, which may not all be flushed."""
+
+        if self.interval <= 0:
+            return
+
+        self.stopping.set()
+        self.queue.put(None)   # wakes the thread now rather than at its next timeout
+        self.join()
+        self.drain()
+
+        if sites is not None:
+            self.sites = sites
+        if windows is not None:
+            self.windows = windows
+        self.bp = self.total_bp
+        self.positions = {}
+
+        if time.time() - self.started >= self.interval or self.path is not None:
+            self.write()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Stage timers and counters for a run.
+
+Each worker keeps a RunStats for the work it does (a window, a block
+of sites) and hands it back with its results. The parent merges them,
+adds its own stages (waiting for results, writing output) and writes
+the totals as JSON with write_report().
+
+Timing a stage costs one clock read and one dict update, so the
+timers stay on for every run:
+
+    stats = RunStats()
+    stats.start()
+    for line in lines:
+        stats.lap('fetch')        # time since the previous lap
+        parse(line)
+        stats.lap('parse')
+"""
+
+import os
+import sys
+import json
+import time
+from collections import defaultdict
+from pypgen.misc.helpers import lazy_import
+
+
+platform = lazy_import('platform')
+
+
+class RunStats(object):
+    """Seconds spent in each stage, the number of laps of each stage,
+    and named counters (sites seen, sites skipped by reason, ...)."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.laps = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.last = None
+
+    def start(self):
+        self.last = time.time()
+
+    def lap(self, stage):
+        """Add the time since the previous lap (or start()) to `stage`."""
+
+        now = time.time()
+        self.seconds[stage] += now - self.last
+        self.laps[stage] += 1
+        self.last = now
+
+    def add_time(self, stage, seconds, laps=1):
+        self.seconds[stage] += seconds
+        self.laps[stage] += laps
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def merge(self, other):
+        """Add the stages and counters of `other` (e.g., a worker's) to
+        this one. Returns self."""
+
+        for stage, seconds in other.seconds.iteritems():
+            self.seconds[stage] += seconds
+        for stage, laps in other.laps.iteritems():
+            self.laps[stage] += laps
+        for name, n in other.counters.iteritems():
+            self.counters[name] += n
+        return self
+
+    def as_dict(self):
+        stages = dict((stage, {'seconds': self.seconds[stage], 'laps': self.laps[stage]})
+                      for stage in self.seconds)
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its finished
+    children (the pool workers), in MB."""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0   # bytes on OS X, KB on Linux
+    return {'parent': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+def write_report(path, stats, args, wall_seconds):
+    """Write the merged RunStats of a run as JSON. Worker stages are
+    summed over the workers, so they can add up to more than
+    wall_seconds when more than one core is used."""
+
+    report = stats.as_dict()
+    report.update({'script': os.path.basename(sys.argv[0]),
+                   'argv': sys.argv[1:],
+                   'input': args.input,
+                   'input_bytes': os.path.getsize(args.input) if os.path.exists(args.input) else None,
+                   'cores': int(args.cores),
+                   'backend': getattr(args, 'backend', None),
+                   'wall_seconds': wall_seconds,
+                   'peak_rss_mb': peak_rss_mb(),
+                   'python': platform.python_version()})
+
+    sites = stats.counters.get('sites_seen', 0)
+    report['sites_per_second'] = sites / wall_seconds if wall_seconds > 0 else None
+
+    fout = open(path, 'w')
+    json.dump(report, fout, indent=1, sort_keys=True)
+    fout.write("\n")
+    fout.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Passing result arrays from the pool's workers to the parent through
+shared memory rather than pickling them.
+
+An Arena is an anonymous shared memory map, made by the parent before
+the pool is forked and cut into buffers of the same size. A worker
+copies an array into a free buffer and returns only its descriptor,
+(buffer, dtype, shape); the parent reads the array in place and
+releases the buffer, which a later result reuses. Python 2.7 has no
+multiprocessing.shared_memory, but an anonymous mmap is MAP_SHARED
+and inherited through fork, and a multiprocessing.RawArray of flags
+(guarded by a Lock) keeps track of the buffers in use.
+
+Workers never wait for a buffer, since the parent may itself be
+waiting for an earlier result: if every buffer is in use, or the
+array does not fit, it is pickled as usual.
+
+pack_rows and unpack_rows use this for rows of per site output, which
+are otherwise pickled as a dict (or list) of Python objects per site.
+"""
+
+import mmap
+import multiprocessing
+from pypgen.misc.helpers import lazy_import
+
+numpy = lazy_import('numpy')
+
+
+BUFFERS_PER_CORE = 2       # results that can wait for the parent in shared memory
+BUFFER_BYTES = 1 << 24     # bytes of each buffer of an Arena
+
+INTEGER_TYPES = frozenset([int, long])
+FLOAT_TYPES = frozenset([float])
+
+
+class Arena(object):
+    """`buffers` shared memory buffers of buffer_bytes each.
+
+        arena = Arena(4)
+        descriptor = arena.put(array)    # in a worker
+        array = arena.view(descriptor)   # in the parent
+        ...
+        arena.release(descriptor)"""
+
+    def __init__(self, buffers, buffer_bytes=BUFFER_BYTES):
+        self.buffer_bytes = buffer_bytes
+        self.mapping = mmap.mmap(-1, buffers * buffer_bytes)
+        self.used = multiprocessing.RawArray('b', buffers)
+        self.lock = multiprocessing.Lock()
+
+    def acquire(self):
+        """Index of a free buffer, now in use, or None if there is none."""
+
+        with self.lock:
+            for buffer, used in enumerate(self.used):
+                if not used:
+                    self.used[buffer] = 1
+                    return buffer
+        return None
+
+    def release(self, descriptor):
+        with self.lock:
+            self.used[descriptor[0]] = 0
+
+    def view(self, descriptor):
+        """The array of a descriptor, in place (valid until released)."""
+
+        buffer, dtype, shape = descriptor
+        count = 1
+        for size in shape:
+            count *= size
+
+        return numpy.frombuffer(self.mapping, dtype=dtype, count=count,
+                                offset=buffer * self.buffer_bytes).reshape(shape)
+
+    def put(self, array):
+        """Copy array into a free buffer and return its descriptor, or
+        None if it is empty, does not fit, or every buffer is in use."""
+
+        array = numpy.ascontiguousarray(array)
+        if array.size == 0 or array.nbytes > self.buffer_bytes:
+            return None
+
+        buffer = self.acquire()
+        if buffer is None:
+            return None
+
+        descriptor = (buffer, array.dtype.str, array.shape)
+        self.view(descriptor)[...] = array
+        return descriptor
+
+
+_arena = None   # Arena of this process and of the workers it forks
+
+
+def create_arena(cores, buffer_bytes=BUFFER_BYTES):
+    """Make the Arena used by pack_rows, with BUFFERS_PER_CORE buffers
+    per core. Call it before the pool is made, so the workers share it."""
+
+    global _arena
+    _arena = Arena(cores * BUFFERS_PER_CORE, buffer_bytes)
+    return _arena
+
+
+def pack_rows(rows):
+    """Rows (lists of ints and floats, of the same length) to return
+    to the parent: ('shared', descriptor, integer_columns) if they
+    were copied into the arena as float64, or ('rows', rows) if there
+    is no arena or free buffer, or a column mixes types."""
+
+    if _arena is None or len(rows) == 0:
+        return ('rows', rows)
+
+    integer_columns = []
+    for column, values in enumerate(zip(*rows)):
+        types = set(map(type, values))
+        if types <= INTEGER_TYPES:
+            integer_columns.append(column)
+        elif not types <= FLOAT_TYPES:
+            return ('rows', rows)
+
+    descriptor = _arena.put(numpy.array(rows, dtype=numpy.float64))
+    if descriptor is None:
+        return ('rows', rows)
+    return ('shared', descriptor, integer_columns)
+
+
+def unpack_rows(packed):
+    """The rows of pack_rows, with the same Python types, releasing
+    their buffer."""
+
+    if packed[0] == 'rows':
+        return packed[1]
+
+    kind, descriptor, integer_columns = packed
+    values = _arena.view(descriptor)
+
+    rows = numpy.empty(values.shape, dtype=object)
+    rows[:] = values
+    if integer_columns:
+        rows[:, integer_columns] = values[:, integer_columns].astype(numpy.int64)
+    rows = rows.tolist()
+
+    _arena.release(descriptor)
+    return rows
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Synthetic VCFs for scale and regression testing.
+
+simulate_vcf() writes a bgzipped, tabix indexed VCF with GATK style
+genotypes (GT:AD:DP:GQ:PL) like those in pypgen/data/example.vcf.gz.
+Each population draws its allele frequencies around a shared ancestral
+frequency (Balding-Nichols, with differentiation `fst`), so the
+F-statistics are not all zero.
+
+Sites are generated in blocks with numpy. The sample columns are looked
+up from a table of every (alleles, genotype, phase, depth) string,
+so writing a site costs one join rather than one format per sample.
+
+    python -m pypgen.misc.simulate -o sim.vcf --samples 1000 \\
+        --populations 4 --contigs 10 --contig-length 10000000
+"""
+
+import argparse
+import numpy
+from pypgen.misc import bgzf
+
+
+BASES = numpy.array(list('ACGT'))
+MAX_DEPTH = 40
+
+
+def population_sizes(samples, populations):
+    """Split `samples` samples as evenly as possible between
+    `populations` populations."""
+
+    return [len(group) for group in numpy.array_split(numpy.arange(samples), populations)]
+
+
+def sample_names(samples):
+    return ["s{}".format(i) for i in range(samples)]
+
+
+def population_args(samples, populations):
+    """The -p arguments of the scripts (pop0:s0,s1,... pop1:...) for
+    the samples of simulate_vcf()."""
+
+    names = sample_names(samples)
+    args = []
+    start = 0
+    for count, size in enumerate(population_sizes(samples, populations)):
+        args.append("pop{}:{}".format(count, ','.join(names[start:start + size])))
+        start += size
+    return args
+
+
+def genotype_table(max_depth=MAX_DEPTH):
+    """Sample column strings indexed by [n_alleles - 2, a, b, phased, depth].
+
+    Unphased genotypes are written in allele order (1/0 as 0/1). AD
+    splits the depth between the called alleles, GQ grows with
+    depth and PL is 0 for the called genotype and 3 * depth per
+    mismatched allele otherwise."""
+
+    table = numpy.empty((2, 3, 3, 2, max_depth + 1), dtype=object)
+
+    for n_alleles in (2, 3):
+        genotypes = [(j, k) for k in range(n_alleles) for j in range(k + 1)]   # VCF PL order
+
+        for a in range(3):
+            for b in range(3):
+                for phased in (0, 1):
+                    for depth in range(max_depth + 1):
+                        if a >= n_alleles or b >= n_alleles:
+                            continue
+
+                        ad = [0] * n_alleles
+                        ad[a] += depth - depth // 2
+                        ad[b] += depth // 2
+
+                        called = sorted((a, b))
+                        pl = []
+                        for genotype in genotypes:
+                            mismatches = 2 - sum(min(list(genotype).count(i), called.count(i)) for i in set(genotype))
+                            pl.append(min(255, 3 * depth * mismatches))
+
+                        gt = "{}|{}".format(a, b) if phased else "{}/{}".format(*called)
+                        table[n_alleles - 2, a, b, phased, depth] = "{}:{}:{}:{:.2f}:{}".format(
+                            gt, ','.join(map(str, ad)), depth,
+                            min(99.0, 3.0 * depth), ','.join(map(str, pl)))
+
+    return table
+
+
+def header(contigs, contig_length, names):
+    lines = ["##fileformat=VCFv4.1",
+             '##FILTER=<ID=LowQual,Description="Low quality">',
+             '##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">',
+             '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+             '##FORMAT=<ID=GQ,Number=1,Type=Float,Description="Genotype Quality">',
+             '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+             '##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Normalized, Phred-scaled likelihoods for genotypes">',
+             '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in genotypes, for each ALT allele">',
+             '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency, for each ALT allele">',
+             '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles in called genotypes">',
+             '##INFO=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">']
+
+    for count, length in enumerate(contig_length):
+        lines.append("##contig=<ID=chr{},length={}>".format(count + 1, length))
+
+    lines.append("#" + "\t".join(["CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                                  "INFO", "FORMAT"] + names))
+    return "\n".join(lines) + "\n"
+
+
+def simulate_block(random, positions, pop_of_sample, n_populations, fst, missing,
+                   multiallelic, phased, indels, filtered, mean_depth):
+    """Return the genotypes and site values of a block of sites as
+    arrays (see simulate_vcf)."""
+
+    n_sites, n_samples = len(positions), len(pop_of_sample)
+
+    # population allele frequencies around an ancestral frequency
+    ancestral = random.uniform(0.05, 0.95, size=(n_sites, 1))
+    scale = (1.0 - fst) / fst
+    freqs = random.beta(ancestral * scale, (1.0 - ancestral) * scale, size=(n_sites, n_populations))
+
+    alleles = (random.uniform(size=(n_sites, n_samples, 2)) < freqs[:, pop_of_sample, None]).astype(numpy.int8)
+
+    # at multiallelic sites (SNPs only) some of the alternate alleles become allele 2
+    is_indel = random.uniform(size=n_sites) < indels
+    n_alleles = numpy.where((random.uniform(size=n_sites) < multiallelic) & ~is_indel, 3, 2)
+    second = random.uniform(size=(n_sites, 1, 1)) * random.uniform(size=(n_sites, n_populations))[:, pop_of_sample, None]
+    alleles += ((n_alleles[:, None, None] == 3) & (alleles == 1)
+                & (random.uniform(size=alleles.shape) < second)).astype(numpy.int8)
+
+    depth = numpy.clip(random.poisson(mean_depth, size=(n_sites, n_samples)), 1, MAX_DEPTH)
+    is_missing = random.uniform(size=(n_sites, n_samples)) < missing
+    is_phased = random.uniform(size=n_sites) < phased
+    is_filtered = random.uniform(size=n_sites) < filtered
+
+    return {'alleles': alleles, 'n_alleles': n_alleles, 'depth': depth, 'missing': is_missing,
+            'phased': is_phased, 'indel': is_indel, 'filtered': is_filtered}
+
+
+def site_alleles(random, n_alleles, indel):
+    """REF and ALT strings of each site."""
+
+    ref = random.randint(0, 4, size=len(n_alleles))
+    shift = random.randint(1, 4, size=len(n_alleles))
+    alt1 = (ref + shift) % 4
+    alt2 = (ref + shift % 3 + 1) % 4
+    lengths = random.randint(1, 6, size=len(n_alleles))
+
+    refs, alts = [], []
+    for count in xrange(len(n_alleles)):
+        r = BASES[ref[count]]
+        if indel[count]:
+            inserted = "".join(BASES[(ref[count] + numpy.arange(1, lengths[count] + 1)) % 4])
+            if count % 2:
+                refs.append(r)
+                alts.append(r + inserted)         # insertion
+            else:
+                refs.append(r + inserted)
+                alts.append(r)                    # deletion
+        else:
+            refs.append(r)
+            alts.append(BASES[alt1[count]] if n_alleles[count] == 2
+                        else BASES[alt1[count]] + ',' + BASES[alt2[count]])
+
+    return refs, alts
+
+
+def simulate_vcf(path, samples=40, populations=4, contigs=2, contig_length=1000000,
+                 snp_density=0.005, missing=0.1, multiallelic=0.02, phased=0.0,
+                 indels=0.0, filtered=0.05, fst=0.1, mean_depth=8.0, block_size=10000,
+                 seed=None, threaded=True):
+    """Write a bgzipped VCF to path + '.gz' (or path, if it ends with
+    '.gz') and its tabix index. Returns the path of the VCF.
+
+    contig_length is one length for every contig or a list with one
+    length per contig. snp_density is the fraction of positions that
+    are variable. missing is the fraction of missing genotypes;
+    multiallelic, phased, indels and filtered are the fractions of
+    sites with a second alternate allele, phased genotypes, an indel
+    instead of a SNP and a FILTER other than PASS."""
+
+    if not path.endswith('.gz'):
+        path += '.gz'
+
+    if isinstance(contig_length, (int, long)):
+        contig_length = [contig_length] * contigs
+
+    if not 0.0 < fst < 1.0:
+        raise ValueError("fst must be between 0 and 1, not {}".format(fst))
+
+    random = numpy.random.RandomState(seed)
+    names = sample_names(samples)
+    pop_of_sample = numpy.repeat(numpy.arange(populations), population_sizes(samples, populations))
+    table = genotype_table()
+    missing_call = "./."
+
+    writer = bgzf.IndexedBgzfWriter(path, bgzf.TabixIndexBuilder(1, 2, 0, preset=bgzf.TBX_VCF),
+                                    threaded=threaded)
+    writer.write_header(header(contigs, contig_length, names))
+
+    for count, length in enumerate(contig_length):
+        chrm = "chr{}".format(count + 1)
+
+        # each segment of the contig holds about block_size sites
+        segment = max(1, int(block_size / snp_density))
+        for seg_start in xrange(1, length + 1, segment):
+            seg_stop = min(length, seg_start + segment - 1)
+            n_sites = random.binomial(seg_stop - seg_start + 1, snp_density)
+            positions = numpy.unique(random.randint(seg_start, seg_stop + 1, size=n_sites))
+            if len(positions) == 0:
+                continue
+
+            block = simulate_block(random, positions, pop_of_sample, populations, fst, missing,
+                                   multiallelic, phased, indels, filtered, mean_depth)
+            alleles = block['alleles']
+
+            calls = table[block['n_alleles'][:, None] - 2, alleles[:, :, 0], alleles[:, :, 1],
+                          block['phased'][:, None].astype(int), block['depth']]
+            calls[block['missing']] = missing_call
+
+            called = ~block['missing']
+            an = 2 * called.sum(axis=1)
+            ac1 = ((alleles == 1) & called[:, :, None]).sum(axis=(1, 2))
+            ac2 = ((alleles == 2) & called[:, :, None]).sum(axis=(1, 2))
+            dp = (block['depth'] * called).sum(axis=1)
+            qual = random.uniform(30, 3000, size=len(positions))
+            refs, alts = site_alleles(random, block['n_alleles'], block['indel'])
+
+            for site in xrange(len(positions)):
+                denominator = float(max(an[site], 1))
+                if block['n_alleles'][site] == 2:
+                    info = "AC={};AF={:.3f};AN={};DP={}".format(ac1[site], ac1[site] / denominator, an[site], dp[site])
+                else:
+                    info = "AC={},{};AF={:.3f},{:.3f};AN={};DP={}".format(
+                        ac1[site], ac2[site], ac1[site] / denominator, ac2[site] / denominator, an[site], dp[site])
+
+                fields = [chrm, str(positions[site]), '.', refs[site], alts[site], "{:.2f}".format(qual[site]),
+                          'LowQual' if block['filtered'][site] else 'PASS', info, 'GT:AD:DP:GQ:PL']
+                writer.write_record(fields + calls[site].tolist())
+
+    writer.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic bgzipped and tabix indexed VCF.')
+    parser.add_argument('-o', '--output', required=True, help='Path of the VCF (.gz is added).')
+    parser.add_argument('--samples', type=int, default=40)
+    parser.add_argument('--populations', type=int, default=4)
+    parser.add_argument('--contigs', type=int, default=2)
+    parser.add_argument('--contig-length', type=int, nargs='+', default=[1000000],
+                        help='One length for all contigs or one per contig.')
+    parser.add_argument('--snp-density', type=float, default=0.005)
+    parser.add_argument('--missing', type=float, default=0.1)
+    parser.add_argument('--multiallelic', type=float, default=0.02)
+    parser.add_argument('--phased', type=float, default=0.0)
+    parser.add_argument('--indels', type=float, default=0.0)
+    parser.add_argument('--filtered', type=float, default=0.05)
+    parser.add_argument('--fst', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    contig_length = args.contig_length[0] if len(args.contig_length) == 1 else args.contig_length
+    contigs = args.contigs if len(args.contig_length) == 1 else len(args.contig_length)
+
+    path = simulate_vcf(args.output, args.samples, args.populations, contigs, contig_length,
+                        args.snp_density, args.missing, args.multiallelic, args.phased,
+                        args.indels, args.filtered, args.fst, seed=args.seed)
+
+    print path
+    print "-p " + " ".join(population_args(args.samples, args.populations))
+
+
+if __name__ == '__main__':
+    main()
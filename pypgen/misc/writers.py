@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import json
+from collections import OrderedDict
+from pypgen.misc import bgzf
+from pypgen.misc.helpers import float_2_string, lazy_import
+
+
+numpy = lazy_import('numpy')
+
+
+OUTPUT_FORMATS = ('csv', 'columnar', 'bgzip')
+
+
+class CSVWriter(object):
+    """Write results as delimited text (the default output).
+
+    Floats are truncated with float_2_string and every row is
+    written as soon as it arrives."""
+
+    def __init__(self, fileobj, sep=',', places=4):
+        self.fileobj = fileobj
+        self.sep = sep
+        self.places = places
+
+    def write_header(self, columns):
+        self.fileobj.write(self.sep.join(map(str, columns)) + "\n")
+
+    def write_row(self, row):
+        row = [float_2_string(value, self.places) for value in row]
+        self.fileobj.write(self.sep.join(row) + "\n")
+
+    def close(self):
+        if self.fileobj is not sys.stdout:
+            self.fileobj.close()
+
+
+class ColumnarWriter(object):
+    """Write results as one typed binary array per column.
+
+    The output is a directory holding a little-endian array file for
+    each column and a ``schema.json`` describing them. Column types
+    are taken from the first row: strings are stored as int32 codes
+    into a list of categories (e.g., chromosome names), ints as
+    int64 and everything else as float64. An int64 column is promoted
+    to float64 (rewriting what was already written) when a later row
+    holds a float or None in it. Rows are buffered and
+    appended to the column files every `buffer_size` rows so
+    partially written results can still be loaded with load_columnar.
+    """
+
+    def __init__(self, path, buffer_size=4096):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.columns = None
+        self.dtypes = None
+        self.categories = None
+        self.nrows = 0
+        self.buffer = []
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def write_header(self, columns):
+        self.columns = list(columns)
+
+    def _set_dtypes(self, row):
+        self.dtypes = []
+        self.categories = {}
+        for count, value in enumerate(row):
+            if isinstance(value, basestring):
+                self.dtypes.append('<i4')
+                self.categories[count] = OrderedDict()
+            elif isinstance(value, (int, long, numpy.integer)) and not isinstance(value, bool):
+                self.dtypes.append('<i8')
+            else:
+                self.dtypes.append('<f8')
+
+        # remove stale columns from a previous run
+        for count in range(len(self.dtypes)):
+            column_path = self._column_path(count)
+            if os.path.exists(column_path):
+                os.remove(column_path)
+
+    def _column_path(self, index):
+        return os.path.join(self.path, "col{:05d}.bin".format(index))
+
+    def _promote(self, index):
+        """Make an int64 column float64, converting the values already written."""
+
+        column_path = self._column_path(index)
+        if os.path.exists(column_path):
+            numpy.fromfile(column_path, dtype='<i8').astype('<f8').tofile(column_path)
+
+        self.dtypes[index] = '<f8'
+        return '<f8'
+
+    def _encode(self, index, value):
+        categories = self.categories[index]
+        if value not in categories:
+            categories[value] = len(categories)
+        return categories[value]
+
+    def write_row(self, row):
+        if self.dtypes is None:
+            self._set_dtypes(row)
+
+        if len(row) != len(self.dtypes):
+            raise ValueError("Row has {} values but the output has {} columns.".format(len(row), len(self.dtypes)))
+
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0 or self.dtypes is None:
+            return
+
+        for count, dtype in enumerate(self.dtypes):
+            values = [row[count] for row in self.buffer]
+
+            if count in self.categories:
+                values = [self._encode(count, value) for value in values]
+
+            elif dtype == '<i8' and not all(isinstance(value, (int, long, numpy.integer)) for value in values):
+                dtype = self._promote(count)
+
+            if dtype == '<f8':
+                values = [float('NaN') if value is None else value for value in values]
+
+            with open(self._column_path(count), 'ab') as column_file:
+                numpy.asarray(values, dtype=dtype).tofile(column_file)
+
+        self.nrows += len(self.buffer)
+        self.buffer = []
+        self.write_schema()
+
+    def schema(self):
+        columns = []
+        for count, dtype in enumerate(self.dtypes):
+            column = OrderedDict([('name', self.columns[count] if self.columns else str(count)),
+                                  ('dtype', dtype),
+                                  ('file', os.path.basename(self._column_path(count)))])
+
+            if count in self.categories:
+                column['categories'] = list(self.categories[count].keys())
+
+            columns.append(column)
+
+        return OrderedDict([('format', 'pypgen-columnar'),
+                            ('version', 1),
+                            ('nrows', self.nrows),
+                            ('columns', columns)])
+
+    def write_schema(self):
+        schema_path = os.path.join(self.path, 'schema.json')
+        tmp_path = schema_path + '.tmp'
+        with open(tmp_path, 'w') as schema_file:
+            json.dump(self.schema(), schema_file, indent=1)
+        os.rename(tmp_path, schema_path)  # never leave a half written schema
+
+    def close(self):
+        if self.dtypes is None:
+            return
+        self.flush()
+        self.write_schema()
+
+
+class TabixWriter(object):
+    """Write results as tab delimited, BGZF compressed text with a
+    tabix index built as the rows are written.
+
+    Compression runs in a background thread. Rows must arrive sorted
+    by coordinate (they do when regions are given in order). The
+    header line, if one is written, is recorded in the index as a line
+    to skip, so the output can be queried with `tabix output.gz
+    Chr01:1-10000` or pysam.Tabixfile.
+
+    tabix_columns : (sequence, start, end) 1-based column numbers,
+        end is 0 if rows describe single positions.
+    """
+
+    def __init__(self, path, tabix_columns=(1, 2, 3), zero_based=False, places=4):
+        seq_col, beg_col, end_col = tabix_columns
+        self.places = places
+        self.index = bgzf.TabixIndexBuilder(seq_col, beg_col, end_col, zero_based=zero_based)
+        self.bgzf = bgzf.IndexedBgzfWriter(path, self.index)
+
+    def write_header(self, columns):
+        self.index.skip = 1
+        self.bgzf.write_header("\t".join(map(str, columns)) + "\n")
+
+    def write_row(self, row):
+        self.bgzf.write_record([float_2_string(value, self.places) for value in row])
+
+    def close(self):
+        self.bgzf.close()
+
+
+def load_columnar(path):
+    """Load a directory written by ColumnarWriter.
+
+    Returns an OrderedDict mapping column names to numpy arrays.
+    Numeric columns are memory mapped (read only); categorical
+    columns are decoded to arrays of strings."""
+
+    with open(os.path.join(path, 'schema.json')) as schema_file:
+        schema = json.load(schema_file)
+
+    nrows = schema['nrows']
+    columns = OrderedDict()
+    for column in schema['columns']:
+        column_path = os.path.join(path, column['file'])
+
+        if nrows == 0:
+            values = numpy.zeros(0, dtype=column['dtype'])
+        else:
+            values = numpy.memmap(column_path, dtype=column['dtype'], mode='r', shape=(nrows,))
+
+        if 'categories' in column:
+            values = numpy.array(column['categories'])[values]
+
+        columns[column['name']] = values
+
+    return columns
+
+
+def open_writer(path, output_format='csv', sep=',', tabix_columns=(1, 2, 3), zero_based=False):
+    """Return the writer for `output_format`. If `path` is None
+    text output goes to STDOUT."""
+
+    if output_format == 'csv':
+        if path is None:
+            fileobj = sys.stdout
+        else:
+            fileobj = open(path, 'w')
+        return CSVWriter(fileobj, sep=sep)
+
+    elif output_format == 'columnar':
+        if path is None:
+            raise ValueError("Columnar output requires an output directory (-o/--output).")
+        return ColumnarWriter(path)
+
+    elif output_format == 'bgzip':
+        if path is None:
+            raise ValueError("bgzip output requires an output path (-o/--output).")
+        return TabixWriter(path, tabix_columns, zero_based)
+
+    else:
+        raise ValueError("Unknown output format: {}".format(output_format))
+
+
+def suffixed_path(path, suffix):
+    """Add `suffix` to an output path before its extension (and a
+    trailing .gz), e.g. ('scan.csv', 'w5000') -> 'scan.w5000.csv', so
+    a run can write several outputs from one -o/--output."""
+
+    root, ext = os.path.splitext(path.rstrip(os.sep))
+    if ext == '.gz':
+        root, inner_ext = os.path.splitext(root)
+        ext = inner_ext + ext
+
+    return "{}.{}{}".format(root, suffix, ext)
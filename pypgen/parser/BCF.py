@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Reading sites with pysam's VariantFile (htslib) rather than by
+splitting VCF text in Python. BCF files are always read this way, and
+bgzipped VCFs with --reader pysam.
+
+Only the samples of the populations are decoded
+(VariantFile.subset_samples). Each record becomes the dict that
+VCF.parse_vcf_line makes of a line (CHROM, POS, FILTER, INFO, ... and
+{'GT': ...} or None for each sample), so the statistics are the same
+whichever reader is used, plus the allele indices of the samples as
+integers under GENOTYPES for the backends that work on blocks of
+sites (see VCF.sample_genotypes).
+"""
+
+import gzip
+from collections import OrderedDict
+from pypgen.misc.helpers import lazy_import
+
+pysam = lazy_import('pysam')
+
+
+READERS = ('auto', 'text', 'pysam')
+
+GENOTYPES = '.genotypes'   # key of the integer allele indices in a site
+
+
+_bcf_paths = {}   # is_bcf of each path seen by this process
+
+
+def is_bcf(path):
+    """True if path is a BCF file (compressed or not)."""
+
+    if path not in _bcf_paths:
+        try:
+            fin = gzip.open(path, 'rb')
+            magic = fin.read(3)
+        except IOError:
+            fin = open(path, 'rb')
+            magic = fin.read(3)
+        fin.close()
+
+        _bcf_paths[path] = magic == 'BCF'
+
+    return _bcf_paths[path]
+
+
+def uses_variant_file(path, reader='auto'):
+    """True if the sites of path are read with pysam's VariantFile
+    (reader is one of READERS). The text reader remains the default
+    for VCFs; BCFs can not be read as text."""
+
+    if reader == 'pysam':
+        return True
+
+    bcf = is_bcf(path)
+    if bcf and reader == 'text':
+        raise ValueError("{} is a BCF file, which can only be read with pysam".format(path))
+    return bcf
+
+
+def header_lines(path):
+    """Lines of the header of a VCF or BCF file (as Tabixfile.header)."""
+
+    return str(pysam.VariantFile(path).header).splitlines()
+
+
+def empty_vcf_ordered_dict(path):
+    """The columns of the file as VCF.make_empty_vcf_ordered_dict."""
+
+    columns = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+    return OrderedDict((column, None) for column in columns + list(pysam.VariantFile(path).header.samples))
+
+
+def info_value(value):
+    if isinstance(value, tuple):
+        return ','.join(info_value(item) for item in value)
+    return str(value)
+
+
+def record_position(record):
+    return (record.chrom, record.pos)
+
+
+class SiteReader(object):
+    """Sites of a VariantFile, decoding only `samples`. GENOTYPES of a
+    site holds the (ploidy) allele indices of each of samples, in the
+    order given, with -1 for missing alleles."""
+
+    def __init__(self, path, samples, ploidy=2):
+        self.path = path
+        self.variant_file = pysam.VariantFile(path)
+        self.variant_file.subset_samples(samples)   # before any record is read
+
+        # the subset is decoded in the order of the file
+        self.samples = list(self.variant_file.header.samples)
+        index = dict((sample, count) for count, sample in enumerate(self.samples))
+        self.order = [index[sample] for sample in samples]
+        self.ploidy = ploidy
+        self.calls = {}   # (sample dict, allele indices) of each genotype, made once
+
+    def call(self, indices):
+        """The sample dict (as made by parse_vcf_line) and the ploidy
+        allele indices of a genotype. Sites share them, so they must
+        not be changed."""
+
+        call = self.calls.get(indices)
+        if call is None:
+            if all(allele is None for allele in indices):
+                sample = None
+            else:
+                sample = {'GT': '/'.join('.' if allele is None else str(allele) for allele in indices)}
+
+            genotype = [-1 if allele is None else allele for allele in indices[:self.ploidy]]
+            call = self.calls[indices] = (sample, genotype + [-1] * (self.ploidy - len(genotype)))
+        return call
+
+    def records(self):
+        return iter(self.variant_file)
+
+    def fetch(self, chrm, start, stop):
+        """Records between start and stop (1-based, inclusive); see
+        VCF.iter_vcf_slice. There are none on contigs missing from the
+        index, but the index itself must exist."""
+
+        index = self.variant_file.index
+        if index is None:
+            raise IOError("index of `{}` not found (BCFs need a .csi, VCFs a .tbi or .csi)".format(self.path))
+
+        if chrm not in index:
+            return iter([])
+        return self.variant_file.fetch(chrm, start - 1, stop)
+
+    def fetch_ranges(self, chrm, ranges):
+        """Records of each of the sorted, disjoint ranges, without the
+        records that start before their range; see VCF.iter_vcf_ranges."""
+
+        for start, stop in ranges:
+            for record in self.fetch(chrm, start, stop):
+                if record.pos >= start:
+                    yield record
+
+    def site(self, record):
+        """The parse_vcf_line dict of a record (samples only have GT)."""
+
+        calls = [self.call(sample.allele_indices) for sample in record.samples.itervalues()]
+
+        filters = record.filter.keys()
+        site = {'CHROM': record.chrom,
+                'POS': record.pos,
+                'ID': record.id or '.',
+                'REF': record.ref,
+                'ALT': ','.join(record.alts or ('.',)),
+                'QUAL': record.qual if record.qual is not None else float('nan'),
+                'FILTER': ';'.join(filters) if filters else '.',
+                'INFO': dict((key, info_value(value)) for key, value in record.info.iteritems()
+                             if value is not True),   # flags have no value, as in parse_info_field
+                'FORMAT': ':'.join(record.format.keys())}
+
+        site.update(zip(self.samples, [call[0] for call in calls]))
+        site[GENOTYPES] = [calls[count][1] for count in self.order]
+        return site
+
+
+_site_readers = {}   # SiteReaders of this process, by path and samples
+
+
+def open_site_reader(path, samples):
+    """SiteReader of path for samples, opened once per process."""
+
+    key = (path, tuple(samples))
+    reader = _site_readers.get(key)
+    if reader is None:
+        reader = SiteReader(path, samples)
+        _site_readers[key] = reader
+    return reader
@@ -1,16 +1,28 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
 import re
 import sys
-import gzip
-import pysam
+import zlib
+import heapq
 import argparse
 import itertools
 from pypgen.misc import helpers
+from pypgen.misc import writers
+from pypgen.misc import progress
+from pypgen.misc.runstats import RunStats
+from pypgen.parser import BCF
+from pypgen.parser.intervals import merge_intervals, load_mask, line_position
 from pypgen.fstats import fstats
+from pypgen.fstats import resampling
+from pypgen.fstats import backends
+from pypgen.fstats.accumulators import HsHtAccumulator
 from collections import OrderedDict, defaultdict
 
+numpy = helpers.lazy_import('numpy')
+pysam = helpers.lazy_import('pysam')
+
 
 def default_args():
     """Parse sys.argv"""
@@ -23,11 +35,22 @@ def default_args():
 
     parser.add_argument('-o', '--output',
                         nargs='?',
-                        type=argparse.FileType('w'),
-                        default=sys.stdout, #helpers.Unbuffered(sys.stdout),  # forces consistent writing to STOUT
-                        help='Path to output csv file. \
+                        type=str,
+                        default=None,
+                        help='Path to output csv file (or directory if \
+                              --output-format is columnar). \
                               If path is not set, defaults to STDOUT.')
 
+    parser.add_argument('--output-format',
+                        default='csv',
+                        choices=writers.OUTPUT_FORMATS,
+                        help="Format of the output. 'csv' writes delimited text. \
+                              'columnar' writes a directory with one binary array \
+                              per column and a schema.json that can be memory \
+                              mapped with pypgen.misc.writers.load_columnar. \
+                              'bgzip' writes tab delimited, BGZF compressed text \
+                              and a tabix index (output path + .tbi).")
+
     parser.add_argument('-c', '--cores',
                         required=True,
                         type=int,
@@ -68,6 +91,15 @@ def default_args():
                         nargs='+',
                         help='Define a chromosomal region(s) to skip.')
 
+    parser.add_argument('--mask',
+                        default=None,
+                        type=str,
+                        metavar='BED',
+                        help='BED file of intervals to exclude (e.g., repeats or \
+                              regions of low mappability). Sites within them are \
+                              skipped before they are parsed, and windows that are \
+                              masked from start to stop are never read.')
+
     parser.add_argument('-p', '--populations',
                         nargs='+',
                         help='Names of populations and samples. \
@@ -82,6 +114,71 @@ def default_args():
                         default=5,
                         help="Minimum number of samples per population.")
 
+    parser.add_argument('--global',
+                        action="store_true",
+                        default=False,
+                        dest='global_stats',
+                        help="Also calculate global estimators across all populations \
+                              (k-population Hs, Ht, Gst, G'st, G''st and Dest). They are \
+                              reported in columns prefixed with 'global.'.")
+
+    parser.add_argument('--backend',
+                        default='auto',
+                        choices=backends.BACKENDS,
+                        help="Implementation of the allele counting and estimator \
+                              kernels. 'python' is the reference, 'numpy' works on \
+                              blocks of sites with array operations and 'numba' \
+                              compiles them (requires numba). 'auto' (default) uses \
+                              python for single sites (vcfSNVfstats) and, for blocks \
+                              of sites, numba if it is installed and the run covers \
+                              at least 100 Mb, and numpy otherwise. \
+                              Alleles above 3 are an error with every backend.")
+
+    parser.add_argument('--reader',
+                        default='auto',
+                        choices=BCF.READERS,
+                        help="How sites are read. 'text' parses VCF lines in Python. \
+                              'pysam' decodes records with htslib (pysam's VariantFile), \
+                              for the samples of the populations only, which is much \
+                              faster; BCF files need their .csi index for regions and \
+                              windows. 'auto' (default) uses pysam for BCF files and \
+                              text otherwise.")
+
+    parser.add_argument('--stats-report',
+                        default=None,
+                        type=str,
+                        metavar='PATH',
+                        help='Write the time spent in each stage (summed over the \
+                              workers), the number of sites seen and skipped (by \
+                              reason), windows emitted and bytes read to this \
+                              JSON file at the end of the run.')
+
+    parser.add_argument('--progress-interval',
+                        default=None,
+                        type=float,
+                        metavar='SECONDS',
+                        help='Write sites/s, windows/s, the percentage of the genome \
+                              done and an ETA to STDERR every SECONDS seconds. \
+                              0 turns progress reporting off. Default is 30 when \
+                              STDERR is a terminal or --progress-file is given, \
+                              and off otherwise.')
+
+    parser.add_argument('--progress-file',
+                        default=None,
+                        type=str,
+                        metavar='PATH',
+                        help='Also write the progress metrics as JSON to this file \
+                              (replaced at each report) for monitoring.')
+
+    parser.add_argument('--profile',
+                        default=None,
+                        type=str,
+                        metavar='PREFIX',
+                        help='Profile the workers (cProfile and sampled stacks) and \
+                              write the merged reports to PREFIX.pstats, PREFIX.txt \
+                              and PREFIX.collapsed (for flame graphs), and the \
+                              parent profile to PREFIX.parent.pstats.')
+
     parser.add_argument('-s', '--column-separator',
                         required=False,
                         type=str,
@@ -97,6 +194,19 @@ def default_args():
     return parser
 
 
+def chunk_args(path, **values):
+    """Arguments of calc_chunk_stats for calls outside the scripts
+    (e.g., tests and benchmarks): the defaults of default_args and of
+    vcfWindowedFstats without any of its optional outputs, updated
+    with values."""
+
+    args = default_args().parse_args(['-i', path, '-c', '1'])
+    args.__dict__.update(permutations=0, bootstrap=0, jackknife=None, summary=None,
+                         distance_matrix=None, seed=None, snv_output=None)
+    args.__dict__.update(values)
+    return args
+
+
 def process_snp_call(snp_call, ref, alt, IUPAC_ambiguities=False):
     """Process VCF genotype fields.
         The current version is very basic and
@@ -172,7 +282,10 @@ def process_snp_call(snp_call, ref, alt, IUPAC_ambiguities=False):
 def make_empty_vcf_ordered_dict(vcf_path):
     """Open VCF file and read in header line as Ordered Dict"""
 
-    vcf_file = gzip.open(vcf_path, 'rb')
+    if BCF.is_bcf(vcf_path):
+        return BCF.empty_vcf_ordered_dict(vcf_path)
+
+    vcf_file = helpers.open_text(vcf_path, read_ahead=False)
     header_dict = None
     for line in vcf_file:
         if line.startswith("#CHROM"):
@@ -188,12 +301,24 @@ def parse_populations_list(populations):
     populations_dict = {}
     for pop in populations:
         pop_name, sample_ids = pop.strip().split(":")
+        if pop_name == 'global':
+            raise ValueError("'global' can not be used as a population name, it labels "
+                             "the estimators across all populations (see --global)")
         sample_ids = sample_ids.split(",")
         populations_dict[pop_name] = sample_ids
 
     return populations_dict
 
 
+def warn_global_stats(args):
+    """With fewer than three populations --global adds no columns (the
+    estimators across all of them are those of the pair), so say so on
+    STDERR rather than leave it out silently."""
+
+    if args.global_stats and len(args.populations) < 3:
+        sys.stderr.write("--global adds no columns with fewer than three populations\n")
+
+
 def pairwise(iterable):
     """Generates paris of slices from iterator
        s -> (s0,s1), (s1,s2), (s2, s3), ..."""
@@ -203,17 +328,35 @@ def pairwise(iterable):
     return itertools.izip(a, b)
 
 
-def get_slice_indicies(vcf_bgzipped_file, regions, window_size, regions_to_skip=[]):
-    """Get slice information from VCF file that is tabix indexed file (bgzipped). """
+def header_lines(vcf_bgzipped_file):
+    """Header lines of a tabix indexed VCF or of a BCF (or of a VCF
+    without an index, bgzipped or not, read from the start of the file)."""
+
+    if BCF.is_bcf(vcf_bgzipped_file):
+        return BCF.header_lines(vcf_bgzipped_file)
 
-    # READ IN FILE HEADER
-    tbx = pysam.Tabixfile(vcf_bgzipped_file)  # TODO: create try statement to test that file is actually a VCF
+    if not os.path.exists(vcf_bgzipped_file + '.tbi') and not os.path.exists(vcf_bgzipped_file + '.csi'):
+        vcf_file = helpers.open_text(vcf_bgzipped_file, read_ahead=False)
+        lines = [line.rstrip('\r\n') for line in itertools.takewhile(lambda line: line.startswith('#'), vcf_file)]
+        vcf_file.close()
+        return lines
+
+    # TODO: create try statement to test that file is actually a VCF
+    tbx = pysam.Tabixfile(vcf_bgzipped_file)
+    lines = list(tbx.header)
+    tbx.close()
+    return lines
+
+
+def get_regions(vcf_bgzipped_file, regions, regions_to_skip=[]):
+    """(chrm, start, stop) of each region, or of each contig in the
+    header of a tabix indexed VCF if regions is None."""
 
     # PARSE LENGTH INFO FROM HEADER
 
     chrm_lengths = []
     chrm_lengths_dict = {}
-    for line in tbx.header:
+    for line in header_lines(vcf_bgzipped_file):
 
         if line.startswith("##contig="):
 
@@ -224,41 +367,125 @@ def get_slice_indicies(vcf_bgzipped_file, regions, window_size, regions_to_skip=
             chrm_length = int(chrm_length[0].strip('length=').strip('>'))
 
             if chrm_name in regions_to_skip:
-                print 'skipping', chrm_name
+                sys.stderr.write("skipping {}\n".format(chrm_name))
                 continue
 
             chrm_lengths.append((chrm_name, 1, chrm_length))
             chrm_lengths_dict[chrm_name] = chrm_length
 
     chrm_lengths = tuple(chrm_lengths)
-    tbx.close()
 
-    # GENERATE SLICES
+    if regions == None:
+        return chrm_lengths
+
+    parsed_regions = []
+    for r in regions:
+        split_region = re.split(r':|-', r)
+
+        if len(split_region) == 3:
+            chrm, start, stop = split_region
+        else:
+            chrm = split_region[0]
+            start, stop = 1, chrm_lengths_dict[chrm]
+
+        parsed_regions.append((chrm, int(start), int(stop)))
+
+    return tuple(parsed_regions)
+
+
+def region_windows(start, stop, window_size):
+    """(start, stop) of the windows of a region."""
+
     # current does not make overlapping slices.
+    slice_indicies = itertools.islice(xrange(start, stop + 1), 0, stop + 1, window_size)
 
-    if regions == None:
+    for count, s in enumerate(pairwise(slice_indicies)):
+        yield (s[0], s[1] - 1)  # subtract one to prevent 1 bp overlap
 
-        for chrm, start, stop in chrm_lengths:
 
-            slice_indicies = itertools.islice(xrange(start, stop + 1), 0, stop + 1, window_size)
+def get_slice_indicies(vcf_bgzipped_file, regions, window_size, regions_to_skip=[]):
+    """Get slice information from VCF file that is tabix indexed file (bgzipped). """
 
-            for count, s in enumerate(pairwise(slice_indicies)):
-                yield (chrm, s[0], s[1] - 1)  # subtract one to prevent 1 bp overlap
-    else:
-        for r in regions:
-            split_region = re.split(r':|-', r)
+    for chrm, start, stop in get_regions(vcf_bgzipped_file, regions, regions_to_skip):
+        for window_start, window_stop in region_windows(start, stop, window_size):
+            yield (chrm, window_start, window_stop)
 
-            if len(split_region) == 3:
-                chrm, start, stop = split_region
-            else:
-                chrm = split_region[0]
-                start, stop = 1, chrm_lengths_dict[chrm]
 
-            start, stop = int(start), int(stop)
+CHUNK_WINDOWS = 8   # windows of the largest size in a chunk, at most (see get_chunks)
+
+
+def least_common_multiple(values):
+    result = 1
+    for value in values:
+        a, b = result, value
+        while b:
+            a, b = b, a % b
+        result = result * value // a
+    return result
+
+
+def get_chunks(vcf_bgzipped_file, regions, window_sizes, regions_to_skip=[], mask=None):
+    """Split the regions into chunks that are read (and parsed) once for
+    windows of every size in window_sizes. Windows that are entirely
+    within the intervals of mask (an intervals.IntervalMask) are left
+    out, as are chunks without windows.
+
+    Yields (chrm, start, stop, windows, features) where windows holds a
+    list of the (start, stop) windows of each size, as made by
+    get_slice_indicies, and features is empty (see
+    intervals.get_feature_chunks). Chunks span at most CHUNK_WINDOWS
+    windows of the largest size, or the least common multiple of the
+    window sizes if that is less (then windows never cross from one
+    chunk to the next). Each window goes to the chunk holding its
+    start, so it may end past the chunk's stop (calc_chunk_stats reads
+    on to its end). The chunks' start to stop ranges do not overlap and
+    hold every site of the windows that is not masked."""
+
+    span = min(least_common_multiple(window_sizes), CHUNK_WINDOWS * max(window_sizes))
+
+    for chrm, start, stop in get_regions(vcf_bgzipped_file, regions, regions_to_skip):
+        counts = [len(xrange(start, stop + 1, window_size)) - 1 for window_size in window_sizes]
+
+        chunks = []
+        for chunk_start in xrange(start, stop + 1, span):
+            offset = chunk_start - start
+
+            # the windows that start within the chunk
+            firsts = [min(-(-offset // window_size), count) for window_size, count in zip(window_sizes, counts)]
+            if firsts == counts:
+                break   # past the last window of every size
+
+            windows = [[(start + k * window_size, start + (k + 1) * window_size - 1)
+                        for k in xrange(first, min(-(-(offset + span) // window_size), count))]
+                       for window_size, count, first in zip(window_sizes, counts, firsts)]
+
+            if mask is not None:
+                windows = [[window for window, covered in zip(size_windows, mask.covered(chrm, *zip(*size_windows)))
+                            if not covered] if size_windows else [] for size_windows in windows]
+
+                if not any(windows):
+                    continue
+
+                # start at the first window that is not masked, if it is all masked up to there
+                first = min(size_windows[0][0] for size_windows in windows if size_windows)
+                if first > chunk_start and mask.covered(chrm, [chunk_start], [first - 1])[0]:
+                    chunk_start = first
+
+            chunks.append((chunk_start, windows))
+
+        # each chunk stops where the next starts (the last at the end of
+        # the windows), less a masked end, as sites there are in windows
+        # that may start in an earlier chunk
+        region_stop = max(start + count * window_size - 1 for window_size, count in zip(window_sizes, counts))
+        for count, (chunk_start, windows) in enumerate(chunks):
+            chunk_stop = chunks[count + 1][0] - 1 if count + 1 < len(chunks) else region_stop
 
-            slice_indicies = itertools.islice(xrange(start, stop + 1), 0, stop + 1, window_size)
-            for count, s in enumerate(pairwise(slice_indicies)):
-                yield (chrm, s[0], s[1] - 1)   # subtract one to prevent 1 bp overlap
+            windows_stop = max(size_windows[-1][1] for size_windows in windows if size_windows)
+            if mask is not None and windows_stop < chunk_stop \
+                    and mask.covered(chrm, [windows_stop + 1], [chunk_stop])[0]:
+                chunk_stop = windows_stop
+
+            yield (chrm, chunk_start, chunk_stop, windows, [])
 
 
 def slice_vcf(vcf_bgzipped_file, chrm, start, stop):
@@ -274,6 +501,47 @@ def slice_vcf(vcf_bgzipped_file, chrm, start, stop):
         return tuple(row for row in vcf_slice)
 
 
+_tabix_files = {}   # open Tabixfiles of this process, by path
+
+BLOCK_SITES = 1024  # sites handed to the backend at once
+
+
+def iter_vcf_slice(vcf_bgzipped_file, chrm, start, stop):
+    """Yield the lines of a VCF between start and stop (1-based,
+    inclusive) as they are read, rather than building a tuple of the
+    whole slice. The Tabixfile is opened once per process and reused."""
+
+    tbx = _tabix_files.get(vcf_bgzipped_file)
+    if tbx is None:
+        tbx = pysam.Tabixfile(vcf_bgzipped_file)
+        _tabix_files[vcf_bgzipped_file] = tbx
+
+    try:
+        vcf_slice = tbx.fetch(chrm, start - 1, stop)
+    except ValueError:
+        return
+
+    for row in vcf_slice:
+        yield row
+
+
+def iter_vcf_ranges(vcf_bgzipped_file, chrm, ranges):
+    """Yield the lines of each of the sorted, disjoint (start, stop)
+    ranges in turn. Records that start before their range (e.g.,
+    deletions that overlap it) are left out, so no site is read twice."""
+
+    for start, stop in ranges:
+        lines = iter_vcf_slice(vcf_bgzipped_file, chrm, start, stop)
+
+        for line in lines:
+            if int(line.split('\t', 2)[1]) >= start:
+                yield line
+                break
+
+        for line in lines:
+            yield line
+
+
 def parse_info_field(info_field):
 
     info_dict = {}
@@ -337,10 +605,16 @@ def get_population_sizes(vcfline, populations):
 
 
 def summarize_population_sizes(dict_of_sizes):
+    """Mean and stdev of the sample counts of each population. Sizes
+    can be lists or fstats.RunningStats."""
+
     results = {}
     for pop, sizes, in dict_of_sizes.iteritems():
-        results[pop + '.sample_count.mean'] = fstats._mean_(sizes)
-        results[pop + '.sample_count.stdev'] = fstats._stdev_(sizes)
+        if not isinstance(sizes, fstats.RunningStats):
+            sizes = fstats.RunningStats(sizes)
+
+        results[pop + '.sample_count.mean'] = sizes.mean()
+        results[pop + '.sample_count.stdev'] = sizes.stdev()
 
     return results
 
@@ -378,6 +652,23 @@ def format_output(chrm, start, stop, depth, stat_id, multilocus_f_statistics):
     return (line)
 
 
+def population_order(populations):
+    """Population names in the order calc_fstats pairs them, which sets
+    the orientation (and labels) of the population pairs."""
+
+    return sorted(populations.keys())
+
+
+def orient_f_statistics(f_statistics, population_names):
+    """Key the F-statistics of each pair (or of all populations) by
+    its populations in the order of population_names. Keys follow the
+    iteration order of the populations dict they were calculated from,
+    which can change when the dict is pickled (e.g., sent to a worker)."""
+
+    index = dict((pop, count) for count, pop in enumerate(population_names))
+    return dict((tuple(sorted(key, key=index.get)), values) for key, values in f_statistics.iteritems())
+
+
 def calc_allele_counts(populations, vcf_line_dict):
 
     #allele_counts = defaultdict({0:0.0,1:0.0,2:0.0,3:0.0,4:0.0})
@@ -389,7 +680,7 @@ def calc_allele_counts(populations, vcf_line_dict):
             if vcf_line_dict[sample_id] != None:
 
                 genotype = vcf_line_dict[sample_id]
-                genotype = genotype["GT"].split("/")   # TODO add phased logic
+                genotype = genotype["GT"].replace("|", "/").split("/")
 
                 if genotype == [".", "."]:
                     continue
@@ -397,39 +688,151 @@ def calc_allele_counts(populations, vcf_line_dict):
                 genotype = [int(item) for item in genotype]
 
                 for allele in genotype:
+                    if allele >= 4:
+                        raise ValueError(backends.ALLELES_ERROR.format(allele))
                     allele_counts[population][allele] += 1.0
 
     return allele_counts
 
-def calc_fstats(allele_counts):
 
-    # CALCULATE ALLELE FREQUENCIES
-    #allele_freqs_dict = populations.fromkeys(populations.keys(), None)
-    allele_freqs_dict = defaultdict(None)
+def check_allele_counts(allele_counts):
+    """Raise a ValueError if a population has alleles above 3, as every
+    backend does (see backends.check_alleles)."""
+
+    for counts in allele_counts.itervalues():
+        for allele, count in counts.iteritems():
+            if allele >= 4 and count != 0.0:
+                raise ValueError(backends.ALLELES_ERROR.format(allele))
+
+def calc_sample_allele_counts(samples, vcf_line_dict):
+    """Allele counts (alleles 0 to 3) of each sample at a site.
+    Missing genotypes have no alleles."""
+
+    sample_counts = []
+    for sample_id in samples:
+        counts = [0.0, 0.0, 0.0, 0.0]
+
+        if vcf_line_dict[sample_id] != None:
+            genotype = vcf_line_dict[sample_id]["GT"].replace("|", "/").split("/")
+
+            if genotype != [".", "."]:
+                for allele in genotype:
+                    if int(allele) >= 4:
+                        raise ValueError(backends.ALLELES_ERROR.format(allele))
+                    counts[int(allele)] += 1.0
+
+        sample_counts.append(counts)
+
+    return sample_counts
+
+
+def sample_genotypes(samples, vcf_line_dict, ploidy=2):
+    """Allele indices of each sample's genotype (as used by the
+    backends). Missing alleles and genotypes are -1."""
+
+    genotypes = []
+    for sample_id in samples:
+        alleles = [-1] * ploidy
+
+        if vcf_line_dict[sample_id] != None:
+            for count, allele in enumerate(re.split(r"/|\|", vcf_line_dict[sample_id]["GT"])[:ploidy]):
+                if allele != '.':
+                    alleles[count] = int(allele)
+
+        genotypes.append(alleles)
+
+    return genotypes
+
+
+def calc_permutation_tests(genotypes, samples, populations, multilocus_f_statistics, args, seed=None):
+    """Add permutation p-values for Gst and Dest of each population pair
+    to multilocus_f_statistics (as '<stat>.p_value').
+
+    genotypes are the window's sample allele counts (sites x samples x
+    alleles) with samples in the order of `samples`."""
+
+    genotypes = numpy.asarray(genotypes, dtype=float)
+    sample_index = dict((sample, count) for count, sample in enumerate(samples))
+
+    for key, values_dict in multilocus_f_statistics.iteritems():
+        if values_dict is None or len(key) != 2:
+            continue
+
+        pop1, pop2 = key
+        index = [sample_index[s] for s in populations[pop1] + populations[pop2]]
+
+        results = resampling.permutation_test(genotypes[:, index, :], len(populations[pop1]),
+                                              args.permutations, seed, args.permutation_batch,
+                                              args.permutation_threads)
+
+        for stat, (observed, p_value) in results.iteritems():
+            values_dict[stat + '.p_value'] = p_value
+
+
+def calc_fstats_with_backend(allele_counts, global_stats=False, backend='auto'):
+    """calc_fstats using one of the kernels in pypgen.fstats.backends."""
+
+    backend = backends.get_backend(backend, sites=1)
     populations = allele_counts.keys()
+    counts = [[[allele_counts[pop].get(allele, 0.0) for allele in range(4)] for pop in populations]]
 
-    for population in allele_counts.keys():
-        counts = allele_counts[population].values()
+    keys, Hs_est, Ht_est = backend.hs_ht(counts, global_stats)
+    estimates = backend.estimators(Hs_est, Ht_est, [len(key) for key in keys])
 
-        if sum(counts) == 0.0:
-            freqs = [0.0] * 4
+    pairwise_results = {}
+    for column, key in enumerate(keys):
+        values_dict = dict((stat, float(estimates[stat][0, column])) for stat in estimates)
+        values_dict['Hs_est'] = float(Hs_est[0, column])
+        values_dict['Ht_est'] = float(Ht_est[0, column])
+        pairwise_results[tuple(populations[i] for i in key)] = values_dict
+
+    return pairwise_results
+
+
+def calc_fstats(allele_counts, global_stats=False, backend='python'):
+    """Calculate F-statistics for every pair of populations at a site.
+
+    If global_stats is True the estimators across all populations are
+    added under a key holding every population name. They reuse the
+    allele frequencies and homozygosity matrix of the pairwise stats.
 
+    The code below is the 'python' backend, which 'auto' also uses for
+    a single site; other backends are run through
+    calc_fstats_with_backend."""
+
+    check_allele_counts(allele_counts)
+    if backends.get_backend(backend, sites=1).name != 'python':
+        return calc_fstats_with_backend(allele_counts, global_stats, backend)
+
+    # CALCULATE ALLELE FREQUENCIES AND PER POPULATION TERMS
+    # These are calculated once per site and shared by every
+    # pair that a population is part of.
+    populations = allele_counts.keys()
+    Ns = [sum(allele_counts[pop].values()) for pop in populations]
+
+    allele_freqs = []
+    for pop, N in zip(populations, Ns):
+        counts = allele_counts[pop].values()[:4]
+
+        if N == 0.0:
+            freqs = [0.0] * 4
         else:
-            freqs = [count / sum(counts) for count in counts]
+            freqs = [count / N for count in counts]
 
-        allele_freqs_dict[population] = freqs
+        allele_freqs.append(freqs + [0.0] * (4 - len(freqs)))
 
-    allele_freqs = allele_freqs_dict.values()
+    J = fstats.homozygosity_matrix(allele_freqs)
+    inverse_Ns = [1.0 / N if N != 0.0 else 0.0 for N in Ns]
 
     # CACULATE PAIRWISE F-STATISTICS
     pairwise_results = {}
+    n = 2
 
-    for population_pair in itertools.combinations(populations, 2):
+    for i, j in itertools.combinations(range(len(populations)), 2):
 
-        pop1, pop2 = population_pair
-        Ns = [sum(allele_counts[pop].values()) for pop in [pop1, pop2]]
+        population_pair = (populations[i], populations[j])
 
-        if 0 in Ns:
+        if Ns[i] == 0 or Ns[j] == 0:
             values = [float('NaN')] * 6
             values_dict = dict(zip(['Hs_est', 'Ht_est', 'Gst_est',
                                     'G_prime_st_est', 'G_double_prime_st_est',
@@ -440,18 +843,11 @@ def calc_fstats(allele_counts):
 
         else:
 
-            pop1 = allele_freqs_dict[pop1]
-            pop2 = allele_freqs_dict[pop2]
-
-            allele_freqs = [pop1, pop2]
-
-            n = float(len(Ns))
-            Ns_harm = fstats.harmonic_mean(Ns)
+            Ns_harm = n / (inverse_Ns[i] + inverse_Ns[j])
 
             # CALCULATE Hs AND Ht
-            n = 2
-            Hs_prime_est_ = fstats.Hs_prime_est(allele_freqs, n)
-            Ht_prime_est_ = fstats.Ht_prime_est(allele_freqs, n)
+            Hs_prime_est_ = fstats.pairwise_Hs_prime_est(J, i, j)
+            Ht_prime_est_ = fstats.pairwise_Ht_prime_est(J, i, j)
             Hs_est_ = fstats.Hs_est(Hs_prime_est_, Ns_harm)
             Ht_est_ = fstats.Ht_est(Ht_prime_est_, Hs_est_, Ns_harm, n)
 
@@ -471,6 +867,32 @@ def calc_fstats(allele_counts):
 
             pairwise_results[population_pair] = values_dict
 
+    # CALCULATE GLOBAL F-STATISTICS
+    if global_stats == True and len(populations) > 2:
+
+        if 0 in Ns:
+            values = [float('NaN')] * 6
+
+        else:
+            n = len(populations)
+            Ns_harm = fstats.harmonic_mean(Ns)
+
+            Hs_prime_est_ = fstats.global_Hs_prime_est(J)
+            Ht_prime_est_ = fstats.global_Ht_prime_est(J)
+            Hs_est_ = fstats.Hs_est(Hs_prime_est_, Ns_harm)
+            Ht_est_ = fstats.Ht_est(Ht_prime_est_, Hs_est_, Ns_harm, n)
+
+            Gst_est_ = fstats.Gst_est(Ht_est_, Hs_est_)
+            values = [Hs_est_, Ht_est_, Gst_est_,
+                      fstats.G_prime_st_est(Ht_est_, Hs_est_, Gst_est_, n),
+                      fstats.G_double_prime_st_est(Ht_est_, Hs_est_, n),
+                      fstats.D_est(Ht_est_, Hs_est_, n)]
+
+        pairwise_results[tuple(populations)] = dict(zip(['Hs_est', 'Ht_est', 'Gst_est',
+                                                         'G_prime_st_est', 'G_double_prime_st_est',
+                                                         'D_est'],
+                                                         values))
+
     return pairwise_results
 
 
@@ -494,7 +916,7 @@ def calc_multilocus_f_statistics(Hs_est_dict, Ht_est_dict):
             Ht_est_list_no_NaN = fstats.de_NaN_list(Ht_est_list)
             Hs_est_list_no_NaN = fstats.de_NaN_list(Hs_est_list)
 
-            n = 2  # Assumes pairs = paired population
+            n = len(key)  # pairs, or all populations for the global stats
             Gst_est = fstats.multilocus_Gst_est(Ht_est_list_no_NaN, Hs_est_list_no_NaN)
             G_prime_st_est = fstats.multilocus_G_prime_st_est(Ht_est_list_no_NaN, Hs_est_list_no_NaN, n)
             G_double_prime_st_est = fstats.multilocus_G_double_prime_st_est(Ht_est_list_no_NaN, Hs_est_list_no_NaN, n)
@@ -533,41 +955,148 @@ def update_Hs_and_Ht_dicts(f_statistics, Hs_est_dict, Ht_est_dict):
     return (Hs_est_dict, Ht_est_dict)
 
 
-def f_statistics_2_sorted_list(multilocus_f_statistics, order=[]):
+def update_accumulators(f_statistics, accumulators, keep_values=False):
+    """Add a site's Hs_est and Ht_est to the HsHtAccumulator of each
+    key in f_statistics, creating accumulators as keys appear."""
 
-    if len(order) == 0:
+    for key, values_dict in f_statistics.iteritems():
 
-        for pair in multilocus_f_statistics.keys():
-            joined_pair = '.'.join(pair)
-            for stat in multilocus_f_statistics[pair].keys():
-                order.append('.'.join((joined_pair, stat)))
+        accumulator = accumulators.get(key)
+        if accumulator is None:
+            accumulator = accumulators[key] = HsHtAccumulator(len(key), keep_values)
 
-        order.sort()
+        accumulator.update(values_dict['Hs_est'], values_dict['Ht_est'])
 
-    stats = []
-    for key in order:
-        key_parts = key.split(".")
+    return accumulators
 
-        if len(key_parts) == 3:
-            pop1, pop2, stat = key_parts
-        else:
-            pop1, pop2, stat, info = key_parts
 
-        if multilocus_f_statistics[(pop1, pop2)] == None:                # TO DO: figure out why this occurs
+def block_estimates(genotypes, sample_populations, n_populations, backend, global_stats=False):
+    """Allele counts, population keys, Hs_est, Ht_est and the per site
+    estimators of a block of sites (see ChunkScanner.flush)."""
+
+    counts = backend.count_alleles(genotypes, sample_populations, n_populations)
+    keys, Hs_est, Ht_est = backend.hs_ht(counts, global_stats)
+    estimates = backend.estimators(Hs_est, Ht_est, [len(key) for key in keys])
+    return counts, keys, Hs_est, Ht_est, estimates
+
+
+def update_accumulators_from_estimates(keys, Hs_est, Ht_est, estimates, population_names, accumulators,
+                                       keep_values=False):
+    """Add the block_estimates of a block of sites to the accumulators."""
+
+    for column, key in enumerate(keys):
+        n = len(key)
+        key = tuple(population_names[i] for i in key)
+
+        accumulator = accumulators.get(key)
+        if accumulator is None:
+            accumulator = accumulators[key] = HsHtAccumulator(n, keep_values)
+
+        accumulator.update_many(Hs_est[:, column], Ht_est[:, column],
+                                dict((stat, values[:, column]) for stat, values in estimates.iteritems()))
+
+    return accumulators
+
+
+def site_estimates(counts, keys, Hs_est, Ht_est, estimates, population_names):
+    """The allele counts and F-statistics of each site of a block (as
+    calc_allele_counts and calc_fstats) from its block_estimates."""
+
+    names = [tuple(population_names[i] for i in key) for key in keys]
+    columns = dict((stat, values.tolist()) for stat, values in estimates.iteritems())
+    columns['Hs_est'], columns['Ht_est'] = Hs_est.tolist(), Ht_est.tolist()
+
+    sites = []
+    for s, site_counts in enumerate(counts.tolist()):
+        allele_counts = dict((pop, dict(enumerate(pop_counts)))
+                             for pop, pop_counts in zip(population_names, site_counts))
+        f_statistics = dict((name, dict((stat, values[s][column]) for stat, values in columns.iteritems()))
+                            for column, name in enumerate(names))
+        sites.append((allele_counts, f_statistics))
+
+    return sites
+
+
+def multilocus_f_statistics_from_accumulators(accumulators):
+    """Same as calc_multilocus_f_statistics, from HsHtAccumulators."""
+
+    return dict((key, accumulator.estimates()) for key, accumulator in accumulators.iteritems())
+
+
+def f_statistics_label(key):
+    """Column label for a key of the F-statistics dicts: 'pop1.pop2'
+    for pairs and 'global' for the estimators across all populations."""
+
+    if len(key) > 2:
+        return 'global'
+    return '.'.join(key)
+
+
+def f_statistics_column(column):
+    """Column label of a (key, stat) of f_statistics_2_sorted_list,
+    e.g. 'pop1.pop2.Gst_est'."""
+
+    key, stat = column
+    return '.'.join((f_statistics_label(key), stat))
+
+
+def f_statistics_2_sorted_list(multilocus_f_statistics, order=[]):
+    """The values of multilocus_f_statistics in the order of `order`,
+    a list of (key, stat) columns, and the order. An empty order is
+    made from multilocus_f_statistics, sorted by column label."""
+
+    if len(order) == 0:
+        order = [(key, stat) for key, key_stats in multilocus_f_statistics.iteritems() for stat in key_stats]
+        order.sort(key=f_statistics_column)
+
+    stats = []
+    for key, stat in order:
+
+        if multilocus_f_statistics[key] == None:                # TO DO: figure out why this occurs
             stats.append(float('NaN'))
         else:
-            value = multilocus_f_statistics[(pop1, pop2)][stat]
+            value = multilocus_f_statistics[key][stat]
             stats.append(value)
 
     return (stats, order)
 
 
+def snv_row(chrm, pos, pop_size_stats, f_statistics, fixed_alleles, orders):
+    """Row of the per site output (as written by vcfSNVfstats): the
+    sample count of each population, the F-statistics of each pair and
+    whether each population is fixed. orders holds the column order of
+    these three groups and is set from the first site, so pass
+    [[], [], []] to start."""
+
+    pop_size_stats, orders[0] = pop_size_statistics_2_sorted_list(pop_size_stats, order=orders[0])
+    f_statistics, orders[1] = f_statistics_2_sorted_list(f_statistics, order=orders[1])
+    fixed_alleles, orders[2] = pop_size_statistics_2_sorted_list(fixed_alleles, order=orders[2])
+
+    return [chrm, pos] + pop_size_stats + f_statistics + fixed_alleles
+
+
+def snv_header(orders):
+    """Column labels of the rows made by snv_row."""
+
+    pop_size_order, fstat_order, fixed_alleles_order = orders
+    return ['chrom', 'pos'] + [pop + ".sample_count" for pop in pop_size_order] \
+        + [f_statistics_column(column) for column in fstat_order] \
+        + [pop + ".fixed" for pop in fixed_alleles_order]
+
+
+def is_fixed_site(vcf_line_dict):
+    """True if a biallelic site has an allele frequency (INFO AF) of
+    1.0. These sites carry no information and have no per site output."""
+
+    allele_frequency = vcf_line_dict["INFO"]["AF"]
+    return ',' not in allele_frequency and float(allele_frequency) == 1.0
+
+
 def process_header(tabix_file):
 
     chrm_lenghts_dict = {}
-    tabix_file = pysam.Tabixfile(tabix_file)
 
-    for line in tabix_file.header:
+    for line in header_lines(tabix_file):
 
         if line.startswith("##contig") == True:
             chrm, length = re.split(r"<ID=|,length=", line)[1:]
@@ -577,14 +1106,15 @@ def process_header(tabix_file):
     return chrm_lenghts_dict
 
 
-def generate_fstats_from_vcf_slices(slice_indicies, populations, header, args):
+def generate_fstats_from_vcf_slices(chunks, populations, header, args):
+    """Tasks of calc_chunk_stats for each chunk of get_chunks (or of
+    intervals.get_feature_chunks)."""
 
-    for count, si in enumerate(slice_indicies):
-        chrm, start, stop = si
+    for count, chunk in enumerate(chunks):
+        chrm, start, stop, windows, features = chunk
 
-        yield [slice_vcf(args.input, chrm, start, stop),
-               chrm, start, stop, populations, header,
-               args.min_samples]
+        # the workers read the slice themselves (see iter_vcf_slice)
+        yield [chrm, start, stop, windows, features, populations, header, args]
 
 
 def process_outgroup(vcf_line, populations):
@@ -633,70 +1163,445 @@ def vcf_line_to_snp_array(vcf_line_dict):
     pass
 
 
-def calc_slice_stats(data):
-    """Main function for caculating statistics.
+class WindowStats(object):
+    """Statistics of one window, updated as the sites of its chunk are
+    parsed (see ChunkScanner).
 
-       Make it easy to add more statistics.
-    """
+    Everything kept per window has a fixed size, however many sites
+    the window holds, except the per site values needed for the
+    bootstrap and the genotypes for the permutation tests. With a
+    block backend the per site estimates of the window's current block
+    wait in `segments` until the block has BLOCK_SITES sites or the
+    window ends, so blocks are the same as if the window was read on
+    its own. Features (see ChunkScanner) are windows with a name."""
 
-    tabix_slice, chrm, start, stop, populations, header, min_samples = data
+    def __init__(self, chrm, start, stop, name=None):
+        self.chrm, self.start, self.stop = chrm, start, stop
+        self.name = name
+        self.depth = fstats.RunningStats()
+        self.population_sizes = defaultdict(fstats.RunningStats)
+        self.accumulators = {}
+        self.snp_count = 0
+        self.genotypes = []      # only kept for the permutation tests
+        self.segments = []       # (Hs_est, Ht_est, estimates) of the current block
+        self.block_sites = 0
 
-    #progress_meter(starting_time, chrm, stop, bp_processed, total_bp_in_dataset)
+    def add_site(self, sizes, depth, sample_counts=None):
+        for pop, size in sizes.iteritems():
+            self.population_sizes[pop].update(size)
 
-    if tabix_slice == None or len(tabix_slice) == 0:  # skip empty alignments
-        return None
+        if sample_counts is not None:
+            self.genotypes.append(sample_counts)
 
-    else:
-        # Create lists to store values for final printing.
-        output_line = [chrm, start, stop]
-        total_depth = []
-        snp_wise_f_statistics = []
-        population_sizes = defaultdict(list)
+        self.depth.update(depth)
+        self.snp_count += 1
 
-        Hs_est_dict = {}
-        Ht_est_dict = {}
-        snp_count = 0
+    def update_block(self, keys, population_names, keep_values):
+        """Add the sites of the current block to the accumulators."""
 
-        for count, line in enumerate(tabix_slice):
+        if len(self.segments) == 0:
+            return
 
-            vcf_line_dict = parse_vcf_line(line, header)
+        if len(self.segments) == 1:
+            Hs_est, Ht_est, estimates = self.segments[0]
+        else:
+            Hs_est = numpy.concatenate([segment[0] for segment in self.segments])
+            Ht_est = numpy.concatenate([segment[1] for segment in self.segments])
+            estimates = dict((stat, numpy.concatenate([segment[2][stat] for segment in self.segments]))
+                             for stat in self.segments[0][2])
 
-            # CREATE FILTERS HERE:
-            if vcf_line_dict["FILTER"] != 'PASS':
-                continue
+        update_accumulators_from_estimates(keys, Hs_est, Ht_est, estimates, population_names,
+                                           self.accumulators, keep_values)
+        self.segments = []
+        self.block_sites = 0
 
-            # COUNT SAMPLES IN EACH POPULATION
-            for pop, size in get_population_sizes(vcf_line_dict, populations).iteritems():
-                population_sizes[pop].append(size)
+    def finish(self, populations, samples, args, run_stats, reduced=True):
+        """(chrm_start_stop, pop_size_statistics, fstats,
+        window_accumulators) of the window; see calc_slice_stats.
+        window_accumulators are only returned if the window is
+        reduced into the jackknife and summaries."""
 
-            # CALCULATE SNPWISE F-STATISTICS
-            allele_counts = calc_allele_counts(populations, vcf_line_dict)
-            f_statistics = calc_fstats(allele_counts)
+        chrm, start, stop = self.chrm, self.start, self.stop
+        accumulators = self.accumulators
+        chrm_start_stop = [chrm, start, stop] + ([self.name] if self.name is not None else []) \
+                          + [self.snp_count, self.depth.mean(), self.depth.stdev()]
 
-            # UPDATE Hs AND Ht DICTIIONARIES
-            Hs_est_dict, Ht_est_dict = update_Hs_and_Ht_dicts(f_statistics, Hs_est_dict, Ht_est_dict)
-            f_statistics['LOCATION'] = (chrm, start, stop)
-            snp_wise_f_statistics.append(f_statistics)
+        if self.snp_count == 0:  # skip empty alignments
+            run_stats.count('windows_skipped.empty')
+            return (chrm_start_stop, None, None, None)
 
-            total_depth.append(int(vcf_line_dict['INFO']["DP"]))
-            snp_count = count
+        run_stats.count('site_pairs_nan', sum(accumulator.nan_sites for accumulator in accumulators.itervalues()))
 
         # SUMMARIZE POPULATION WIDE STATISTICS
-        pop_size_statistics = summarize_population_sizes(population_sizes)
-        multilocus_f_statistics = calc_multilocus_f_statistics(Hs_est_dict, Ht_est_dict)
+        pop_size_statistics = summarize_population_sizes(self.population_sizes)
+        multilocus_f_statistics = multilocus_f_statistics_from_accumulators(accumulators)
+
+        seed = None
+        if args.seed is not None:   # reproducible and different for each window
+            seed = zlib.crc32("{}:{}:{}".format(args.seed, chrm, start)) & 0xffffffff
+
+        # PERMUTATION TESTS (SHUFFLING SAMPLES BETWEEN POPULATIONS)
+        if args.permutations > 0 and len(self.genotypes) > 0:
+            calc_permutation_tests(self.genotypes, samples, populations, multilocus_f_statistics, args, seed)
+
+        # BOOTSTRAP CONFIDENCE INTERVALS (RESAMPLING SITES)
+        if args.bootstrap > 0:
+
+            for key, values_dict in multilocus_f_statistics.iteritems():
+                if values_dict is None:
+                    continue
+
+                accumulator = accumulators[key]
+                intervals = resampling.bootstrap_ci(accumulator.Ht_values, accumulator.Hs_values, len(key),
+                                                    args.bootstrap, args.confidence, seed)
+                for stat, (low, high) in intervals.iteritems():
+                    values_dict[stat + '.ci_low'] = low
+                    values_dict[stat + '.ci_high'] = high
+
+        # ACCUMULATORS FOR THE BLOCK JACKKNIFE AND THE CHROMOSOME
+        # AND GENOME SUMMARIES (REDUCED BY THE PARENT PROCESS)
+        window_accumulators = None
+        if reduced and (args.jackknife is not None or args.summary is not None or args.distance_matrix is not None):
+            window_accumulators = accumulators
+            for accumulator in accumulators.itervalues():
+                accumulator.Hs_values = accumulator.Ht_values = None   # not needed beyond the window
+
+        run_stats.lap('multilocus')
 
         # SKIP SAMPLES WITH TOO MANY NANs
+        # (their sites still count towards the summaries)
 
         if len(multilocus_f_statistics.values()) == 0:
-            return None
+            run_stats.count('windows_skipped.empty')
+            return (chrm_start_stop, None, None, None)
 
         elif multilocus_f_statistics.values()[0] is None:
-            return None
+            run_stats.count('windows_skipped.nan_pair')
+            return (chrm_start_stop, None, None, window_accumulators)
 
         else:
-            # UPDATE OUTPUT LINE WITH DEPTH INFO
-            output_line += [snp_count, fstats._mean_(total_depth), fstats._stdev_(total_depth)]
+            return (chrm_start_stop, pop_size_statistics, multilocus_f_statistics, window_accumulators)
+
+
+class ChunkScanner(object):
+    """The windows of every size and the features of a chunk, updated
+    site by site as calc_chunk_stats reads the chunk.
+
+    Each site is counted, its allele counts and per site Hs and Ht
+    calculated once, and then added to the window of each size and
+    to every feature that holds it. Features may overlap or nest:
+    they are opened at their first site and closed (and their
+    statistics calculated) once a site is read past their end, so
+    only the features that hold the current site are kept.
+
+    With a block backend the sites wait in `block` until it is full or
+    the windows and features that hold them change (see flush).
+    `decoded` is True when sites come from BCF.SiteReader, which
+    decodes the genotypes of block_samples."""
+
+    def __init__(self, chrm, windows, features, populations, args, run_stats, decoded=False):
+        self.chrm = chrm
+        self.features = features
+        self.populations = populations
+        self.args = args
+        self.run_stats = run_stats
+        self.decoded = decoded
+
+        self.keep_values = args.bootstrap > 0
+        self.samples = [sample for pop in sorted(populations.keys()) for sample in populations[pop]]
+
+        # sites waiting to be processed by a (non 'python') backend
+        self.backend = backends.get_backend(args.backend)
+        self.population_names = population_order(populations)
+        self.block_samples = [sample for pop in self.population_names for sample in populations[pop]]
+        self.block_populations = [count for count, pop in enumerate(self.population_names)
+                                  for sample in populations[pop]]
+        self.block = []
+        self.block_keys = None
+
+        # per site output: (pos, population sizes, written) of each site
+        # used and its (allele counts, F-statistics)
+        self.snv_output = args.snv_output is not None
+        self.snv_sites = []
+        self.snv_estimates = []
+
+        # the open window of each size (None past its last window)
+        self.remaining = [iter(size_windows) for size_windows in windows]
+        self.window_results = [[] for size_windows in windows]
+        self.current = [None] * len(windows)
+
+        # the open features, by stop, and the next one to open
+        self.open_features = []   # heap of (stop, start, index, WindowStats)
+        self.next_feature = 0
+        self.feature_results = []
+
+        # the windows and features that hold the current site, and the
+        # start of the next window to open (windows may start after the
+        # chunk, see get_chunks)
+        self.active = []
+        self.next_start = None
+
+        for i in range(len(windows)):
+            self.open_window(i)
+
+    def update_active(self, pos):
+        self.active = [window for window in self.current if window is not None and window.start <= pos] \
+                      + [feature[3] for feature in self.open_features]
+        starts = [window.start for window in self.current if window is not None and window.start > pos]
+        self.next_start = min(starts) if starts else None
+
+    def open_window(self, i):
+        window = next(self.remaining[i], None)
+        self.current[i] = WindowStats(self.chrm, window[0], window[1]) if window is not None else None
+
+    def flush(self):
+        """Run the backend on the sites of `block`, which are in every
+        active window and feature."""
+
+        if len(self.block) == 0:
+            return
+
+        counts, keys, Hs_est, Ht_est, estimates = block_estimates(self.block, self.block_populations,
+                                                                  len(self.population_names), self.backend,
+                                                                  self.args.global_stats)
+        self.block_keys = keys
+        for window in self.active:
+            window.segments.append((Hs_est, Ht_est, estimates))
+
+        if self.snv_output:
+            self.snv_estimates.extend(site_estimates(counts, keys, Hs_est, Ht_est, estimates,
+                                                     self.population_names))
+        self.block = []
+
+    def close_window(self, i):
+        self.flush()
+        window = self.current[i]
+        window.update_block(self.block_keys, self.population_names, self.keep_values)
+        self.run_stats.lap('estimators')
+        self.window_results[i].append(window.finish(self.populations, self.samples, self.args, self.run_stats,
+                                                    reduced=i == 0))
+        self.open_window(i)
+
+    def open_features_to(self, pos):
+        # features that start at or before pos (those that end before
+        # it are closed without sites by close_features_before)
+        while self.next_feature < len(self.features) and self.features[self.next_feature][0] <= pos:
+            feature_start, feature_stop, name = self.features[self.next_feature]
+            heapq.heappush(self.open_features, (feature_stop, feature_start, self.next_feature,
+                                                WindowStats(self.chrm, feature_start, feature_stop, name)))
+            self.next_feature += 1
+
+    def close_features_before(self, pos):
+        while self.open_features and self.open_features[0][0] < pos:
+            feature_stop, feature_start, index, feature = heapq.heappop(self.open_features)
+            feature.update_block(self.block_keys, self.population_names, self.keep_values)
+            self.run_stats.lap('estimators')
+            self.feature_results.append((index, feature.finish(self.populations, self.samples, self.args,
+                                                               self.run_stats, reduced=False)))
+
+    def add_site(self, pos, vcf_line_dict, owned=True):
+        """Add a site that passed the filters to the windows and features
+        that hold it. Sites that are not `owned` (past the chunk's stop)
+        are not counted or written to the per site output."""
+
+        args, run_stats = self.args, self.run_stats
+
+        # CLOSE THE WINDOWS THAT END BEFORE THIS SITE
+        # AND OPEN AND CLOSE FEATURES
+        changed = False
+        for i in range(len(self.current)):
+            while self.current[i] is not None and pos > self.current[i].stop:
+                self.close_window(i)
+                changed = True
+
+        if self.next_start is not None and pos >= self.next_start:
+            self.flush()   # the block's sites are not in the windows opened here
+            changed = True
+
+        if (self.next_feature < len(self.features) and self.features[self.next_feature][0] <= pos) \
+                or (self.open_features and self.open_features[0][0] < pos):
+            self.flush()   # the block's sites are not in the features opened here
+            self.open_features_to(pos)
+            self.close_features_before(pos)
+            changed = True
+
+        if changed:
+            self.update_active(pos)
+
+        # COUNT SAMPLES IN EACH POPULATION
+        sizes = get_population_sizes(vcf_line_dict, self.populations)
+        depth = int(vcf_line_dict['INFO']["DP"])
+        sample_counts = calc_sample_allele_counts(self.samples, vcf_line_dict) if args.permutations > 0 else None
+        run_stats.count('sites_used', owned)
+
+        if self.snv_output:
+            self.snv_sites.append((pos, sizes, owned and not is_fixed_site(vcf_line_dict)))
+
+        for window in self.active:
+            window.add_site(sizes, depth, sample_counts)
+
+        if self.backend.name == 'python':
+            # CALCULATE SNPWISE F-STATISTICS AND UPDATE Hs AND Ht ACCUMULATORS
+            allele_counts = calc_allele_counts(self.populations, vcf_line_dict)
+            run_stats.lap('count_alleles')
+            f_statistics = orient_f_statistics(calc_fstats(allele_counts, args.global_stats),
+                                               self.population_names)
+
+            for window in self.active:
+                update_accumulators(f_statistics, window.accumulators, self.keep_values)
+
+            if self.snv_output:
+                self.snv_estimates.append((allele_counts, f_statistics))
+
+        else:
+            if self.decoded:
+                self.block.append(vcf_line_dict[BCF.GENOTYPES])   # decoded for block_samples
+            else:
+                self.block.append(sample_genotypes(self.block_samples, vcf_line_dict))
+            run_stats.lap('count_alleles')
+
+            for window in self.active:
+                window.block_sites += 1
+
+            full = [window for window in self.active if window.block_sites == BLOCK_SITES]
+            if full:
+                self.flush()
+                for window in full:
+                    window.update_block(self.block_keys, self.population_names, self.keep_values)
+
+        run_stats.lap('estimators')
+
+    def close(self, stop):
+        """Close every window and feature (the chunk ends at stop).
+        Returns (window_results, feature_results, sites) as
+        calc_chunk_stats."""
+
+        for i in range(len(self.current)):
+            while self.current[i] is not None:
+                self.close_window(i)
+        self.update_active(stop)
+
+        feature_results = self.feature_results
+        if self.features:
+            self.flush()
+            self.open_features_to(stop)
+            self.close_features_before(stop + 1)
+            feature_results = [result for index, result in sorted(self.feature_results)]
+
+        sites = []
+        if self.snv_output:
+            self.flush()   # sites past the last window of every size
+
+            for (pos, sizes, written), (allele_counts, f_statistics) in zip(self.snv_sites, self.snv_estimates):
+                if written:
+                    sites.append((pos, sizes, f_statistics, identify_fixed_populations(allele_counts)))
+            self.run_stats.lap('snv')
+
+        return self.window_results, feature_results, sites
+
+
+def calc_chunk_stats(data):
+    """Statistics of the windows of every size, or of the features, in
+    a chunk (see get_chunks and intervals.get_feature_chunks), reading
+    and parsing each site once and adding it to a ChunkScanner.
+
+    Returns (chrm, window_results, feature_results, sites, run_stats)
+    where window_results holds, for each window size, a list of
+    (chrm_start_stop, pop_size_statistics, fstats,
+    window_accumulators) of its windows and feature_results the same
+    of each feature, in the order of the chunk (chrm_start_stop then
+    holds the feature's name after its stop). Only windows of the
+    first size are reduced into the jackknife and summaries. With
+    args.snv_output set, sites holds (pos, population sizes,
+    F-statistics, fixed populations) of each site with per site output.
+
+    Windows may end past stop (see get_chunks): their sites are read
+    too, but they are counted in run_stats and written to sites by
+    the chunk whose start to stop holds them.
+    """
+
+    chrm, start, stop, windows, features, populations, header, args = data
+
+    run_stats = RunStats()
+    run_stats.start()
+
+    # BCF (or with --reader pysam, VCF) records are decoded by htslib
+    # for the samples of the populations only
+    decoded = BCF.uses_variant_file(args.input, args.reader)
+    scanner = ChunkScanner(chrm, windows, features, populations, args, run_stats, decoded)
+    scanner.update_active(start)
+
+    reader = BCF.open_site_reader(args.input, scanner.block_samples) if decoded else None
+
+    if features:
+        # only the features are read, not the gaps between them
+        ranges = merge_intervals(features)
+        lines = reader.fetch_ranges(chrm, ranges) if reader else iter_vcf_ranges(args.input, chrm, ranges)
+    else:
+        read_stop = max([stop] + [size_windows[-1][1] for size_windows in windows if size_windows])
+        lines = reader.fetch(chrm, start, read_stop) if reader else iter_vcf_slice(args.input, chrm, start, read_stop)
+
+    if args.mask is not None:
+        locate = BCF.record_position if reader is not None else line_position
+
+        def on_masked(masked):
+            masked = [item for item in masked if locate(item)[1] <= stop]
+            run_stats.count('sites_seen', len(masked))
+            run_stats.count('sites_skipped.mask', len(masked))
+            if reader is None:
+                run_stats.count('bytes_read', sum(len(line) + 1 for line in masked))
+
+        mask = load_mask(args.mask)
+        if reader is not None:
+            lines = mask.unmasked(lines, BCF.record_position, on_masked)
+        else:
+            lines = mask.unmasked_lines(lines, on_masked)
+
+    for line in lines:
+        run_stats.lap('fetch')
+
+        if reader is not None:
+            vcf_line_dict = reader.site(line)
+        else:
+            vcf_line_dict = parse_vcf_line(line, header)
+
+        # sites past stop are counted by the next chunk
+        pos = vcf_line_dict['POS']
+        owned = pos <= stop
+        if owned:
+            if reader is None:
+                run_stats.count('bytes_read', len(line) + 1)
+            run_stats.count('sites_seen')
+        run_stats.lap('parse')
+
+        # CREATE FILTERS HERE:
+        if vcf_line_dict["FILTER"] != 'PASS':
+            run_stats.count('sites_skipped.filter', owned)
+            continue
+
+        scanner.add_site(pos, vcf_line_dict, owned)
+
+    window_results, feature_results, sites = scanner.close(stop)
+
+    progress.report(sites=run_stats.counters['sites_seen'],
+                    windows=sum(len(results) for results in window_results) + len(feature_results),
+                    bp=stop - start + 1)
+
+    return (chrm, window_results, feature_results, sites, run_stats)
+
+
+def calc_slice_stats(data):
+    """Main function for caculating statistics.
+
+       Make it easy to add more statistics.
+
+       Returns (chrm_start_stop, pop_size_statistics, fstats,
+       window_accumulators, sites, run_stats) of the window from
+       start to stop (see calc_chunk_stats).
+    """
 
-            return ([chrm, start, stop, snp_count, fstats._mean_(total_depth), fstats._stdev_(total_depth)], \
-                 pop_size_statistics, multilocus_f_statistics)
+    chrm, start, stop, populations, header, args = data
 
+    chrm, window_results, feature_results, sites, run_stats = calc_chunk_stats(
+        [chrm, start, stop, [[(start, stop)]], [], populations, header, args])
+    return tuple(window_results[0][0]) + (sites, run_stats)
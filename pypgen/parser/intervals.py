@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Genomic intervals read from BED and GFF/GTF files.
+
+Features (genes, exons, ...) are kept per contig, sorted by start,
+as 1-based inclusive (start, stop, name) tuples, the coordinates used
+for windows. get_feature_chunks groups them for the workers, which
+stream each contig once and assign every site to all the features
+that hold it (see VCF.calc_chunk_stats).
+
+An IntervalMask holds intervals to exclude (repeats, low mappability,
+...) merged into sorted start and stop arrays per contig, so that
+batches of site positions and whole windows are looked up with
+numpy.searchsorted.
+"""
+
+import re
+from collections import OrderedDict
+from pypgen.misc.helpers import lazy_import, open_text
+
+numpy = lazy_import('numpy')
+
+
+FEATURE_CHUNK_SIZE = 1000000   # bp of features handed to a worker at once
+
+MASK_BATCH_SITES = 1024        # sites looked up in the mask at once
+
+GFF_EXTENSIONS = ('.gff', '.gff3', '.gtf')
+
+
+def read_bed(path):
+    """Yield (chrm, start, stop, name) of each interval of a BED file,
+    converted from 0-based half open to 1-based inclusive. Intervals
+    without a name are named chrm:start-stop."""
+
+    for line in open_text(path):
+        if line.startswith(('#', 'track', 'browser')) or line.strip() == '':
+            continue
+
+        parts = line.rstrip('\r\n').split('\t')
+        chrm, start, stop = parts[0], int(parts[1]) + 1, int(parts[2])
+
+        name = parts[3] if len(parts) > 3 and parts[3] != '' else None
+        yield (chrm, start, stop, name or "{}:{}-{}".format(chrm, start, stop))
+
+
+def gff_name(attributes):
+    """ID or Name (GFF3), or gene_id or transcript_id (GTF) of a
+    feature, or None."""
+
+    for key in ('ID', 'Name'):
+        match = re.search(r'(?:^|;)\s*' + key + r'=([^;]+)', attributes)
+        if match:
+            return match.group(1).strip()
+
+    for key in ('gene_id', 'transcript_id'):
+        match = re.search(key + r' "([^"]+)"', attributes)
+        if match:
+            return match.group(1)
+
+    return None
+
+
+def read_gff(path, feature_type=None):
+    """Yield (chrm, start, stop, name) of each feature of a GFF3 or GTF
+    file (1-based inclusive, as in the file). If feature_type is set
+    only features of that type (column 3, e.g. 'gene') are read."""
+
+    for line in open_text(path):
+        if line.startswith('##FASTA'):
+            break
+        if line.startswith('#') or line.strip() == '':
+            continue
+
+        parts = line.rstrip('\r\n').split('\t')
+        if feature_type is not None and parts[2] != feature_type:
+            continue
+
+        chrm, start, stop = parts[0], int(parts[3]), int(parts[4])
+        name = gff_name(parts[8]) if len(parts) > 8 else None
+        yield (chrm, start, stop, name or "{}:{}-{}".format(chrm, start, stop))
+
+
+def read_features(path, feature_type=None):
+    """Features of a BED or GFF/GTF file (chosen by the extension,
+    which may be followed by .gz)."""
+
+    extension = path[:-3] if path.endswith('.gz') else path
+    if extension.lower().endswith(GFF_EXTENSIONS):
+        return read_gff(path, feature_type)
+    return read_bed(path)
+
+
+def features_by_contig(features, contigs_to_skip=()):
+    """Group (chrm, start, stop, name) features by contig, in the order
+    the contigs first appear, each sorted by start (then stop)."""
+
+    contigs = OrderedDict()
+    for chrm, start, stop, name in features:
+        if chrm in contigs_to_skip:
+            continue
+        contigs.setdefault(chrm, []).append((start, stop, name))
+
+    for chrm_features in contigs.itervalues():
+        chrm_features.sort()
+
+    return contigs
+
+
+def merge_intervals(intervals):
+    """Disjoint (start, stop) ranges covering intervals sorted by start
+    (features or any tuples starting with start and stop)."""
+
+    merged = []
+    for interval in intervals:
+        start, stop = interval[0], interval[1]
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+
+    return [tuple(interval) for interval in merged]
+
+
+def get_feature_chunks(contigs, chunk_size=FEATURE_CHUNK_SIZE):
+    """Split the features of each contig (see features_by_contig) into
+    chunks for calc_chunk_stats. A chunk ends at a gap between
+    features once it spans chunk_size bp, so no feature (and no site)
+    is split between chunks.
+
+    Yields (chrm, start, stop, windows, features) with no windows."""
+
+    for chrm, chrm_features in contigs.iteritems():
+        chunk = []
+        chunk_stop = None
+
+        for feature in chrm_features:
+            start, stop = feature[0], feature[1]
+
+            if chunk and start > chunk_stop and chunk_stop - chunk[0][0] + 1 >= chunk_size:
+                yield (chrm, chunk[0][0], chunk_stop, [], chunk)
+                chunk = []
+
+            chunk_stop = stop if not chunk else max(chunk_stop, stop)
+            chunk.append(feature)
+
+        if chunk:
+            yield (chrm, chunk[0][0], chunk_stop, [], chunk)
+
+
+def read_mask(path):
+    """(starts, stops) lists of the intervals of each contig of a BED
+    file, 1-based inclusive and in the order of the file. Leaner than
+    read_bed for the hundreds of thousands of intervals of a mask."""
+
+    contigs = OrderedDict()
+    for line in open_text(path):
+        if line.startswith(('#', 'track', 'browser')) or line.strip() == '':
+            continue
+
+        parts = line.split('\t', 3)
+        starts, stops = contigs.setdefault(parts[0], ([], []))
+        starts.append(int(parts[1]) + 1)
+        stops.append(int(parts[2]))
+
+    return contigs
+
+
+def merge_interval_arrays(starts, stops):
+    """merge_intervals of (unsorted) start and stop arrays."""
+
+    order = numpy.lexsort((stops, starts))
+    starts, stops = starts[order], stops[order]
+
+    # an interval starts a new merged one unless it overlaps or abuts
+    # one of the intervals before it
+    reach = numpy.maximum.accumulate(stops)
+    first = numpy.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > reach[:-1] + 1
+
+    last = numpy.append(numpy.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+
+class IntervalMask(object):
+    """Masked positions of each contig, as the sorted starts and stops
+    (1-based, inclusive) of disjoint intervals.
+
+        mask = IntervalMask(read_mask('repeats.bed'))"""
+
+    def __init__(self, contigs):
+        self.starts = {}
+        self.stops = {}
+
+        for chrm, (starts, stops) in contigs.iteritems():
+            if len(starts) == 0:
+                continue
+
+            self.starts[chrm], self.stops[chrm] = merge_interval_arrays(numpy.asarray(starts, dtype=numpy.int64),
+                                                                        numpy.asarray(stops, dtype=numpy.int64))
+
+    def interval_count(self):
+        return sum(len(starts) for starts in self.starts.itervalues())
+
+    def masked(self, chrm, positions):
+        """Boolean array, True for each of positions that is masked."""
+
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        starts = self.starts.get(chrm)
+        if starts is None:
+            return numpy.zeros(len(positions), dtype=bool)
+
+        # the last interval that starts at or before each position
+        index = numpy.searchsorted(starts, positions, side='right') - 1
+        return (index >= 0) & (positions <= self.stops[chrm][numpy.maximum(index, 0)])
+
+    def covered(self, chrm, starts, stops):
+        """Boolean array, True for each (start, stop) that is masked
+        from start to stop (intervals are merged, so it must lie
+        within a single one)."""
+
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        stops = numpy.asarray(stops, dtype=numpy.int64)
+        mask_starts = self.starts.get(chrm)
+        if mask_starts is None:
+            return numpy.zeros(len(starts), dtype=bool)
+
+        index = numpy.searchsorted(mask_starts, starts, side='right') - 1
+        return (index >= 0) & (stops <= self.stops[chrm][numpy.maximum(index, 0)])
+
+    def unmasked_lines(self, lines, on_masked=None, batch_size=MASK_BATCH_SITES):
+        """Yield the VCF lines (and header lines) whose POS is not
+        masked, looking positions up batch_size sites at a time so
+        that masked sites are never parsed. on_masked is called with
+        each batch's list of the lines left out."""
+
+        return self.unmasked(lines, line_position, on_masked, batch_size)
+
+    def unmasked(self, items, locate, on_masked=None, batch_size=MASK_BATCH_SITES):
+        """unmasked_lines of any items (e.g., pysam records) sorted by
+        position. locate(item) gives its (chrm, pos), or None for items
+        that are always kept."""
+
+        batch = []
+        for item in items:
+            position = locate(item)
+            if position is None:
+                for kept in self._unmasked_batch(batch, on_masked):
+                    yield kept
+                batch = []
+                yield item
+                continue
+
+            batch.append((item, position))
+            if len(batch) == batch_size:
+                for kept in self._unmasked_batch(batch, on_masked):
+                    yield kept
+                batch = []
+
+        for kept in self._unmasked_batch(batch, on_masked):
+            yield kept
+
+    def _unmasked_batch(self, batch, on_masked):
+        if len(batch) == 0:
+            return []
+
+        positions = numpy.array([pos for item, (chrm, pos) in batch], dtype=numpy.int64)
+        masked = numpy.zeros(len(batch), dtype=bool)
+
+        # runs of items on the same contig (the file is sorted)
+        run_start = 0
+        for i in xrange(1, len(batch) + 1):
+            if i == len(batch) or batch[i][1][0] != batch[run_start][1][0]:
+                masked[run_start:i] = self.masked(batch[run_start][1][0], positions[run_start:i])
+                run_start = i
+
+        if not masked.any():
+            return [item for item, position in batch]
+
+        if on_masked is not None:
+            on_masked([item for (item, position), skip in zip(batch, masked) if skip])
+        return [item for (item, position), skip in zip(batch, masked) if not skip]
+
+
+def line_position(line):
+    """(chrm, pos) of a VCF line, or None for header lines."""
+
+    if line.startswith('#'):
+        return None
+
+    parts = line.split('\t', 2)
+    return (parts[0], int(parts[1]))
+
+
+_masks = {}   # masks loaded by this process (and the workers it forks), by path
+
+
+def load_mask(path):
+    """IntervalMask of the intervals of a BED file, read once per
+    process."""
+
+    mask = _masks.get(path)
+    if mask is None:
+        mask = IntervalMask(read_mask(path))
+        _masks[path] = mask
+    return mask
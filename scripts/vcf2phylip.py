@@ -25,7 +25,6 @@ The author may be contacted at ngcrawford@gmail.com
 import os
 import re
 import sys
-import gzip
 import pysam
 import shlex
 import random
@@ -34,7 +33,9 @@ import itertools
 import numpy as np
 from subprocess import Popen, PIPE
 from collections import namedtuple
+from pypgen.misc import helpers
 from pypgen.parser import VCF
+from pypgen.parser import BCF
 
 def get_args():
     """Parse sys.argv"""
@@ -216,10 +217,25 @@ def slice_vcf(vcf, chrm, start, stop):
     vcf = Popen(cli_parts, stdin=PIPE, stderr=PIPE, stdout=PIPE).communicate()[0]
     return vcf
 
+def bcf_slice_rows(bcf_file, chrm, start, stop):
+    """Rows of a BCF slice as the split lines of a VCF (with only the
+    GT of each sample), decoded by pysam."""
+
+    reader = BCF.SiteReader(bcf_file, list(pysam.VariantFile(bcf_file).header.samples))
+    for record in reader.fetch(chrm, start + 1, stop):
+        site = reader.site(record)
+        calls = [site[sample]['GT'] if site[sample] is not None else './.' for sample in reader.samples]
+        yield [site['CHROM'], str(site['POS']), site['ID'], site['REF'], site['ALT'], str(site['QUAL']),
+               site['FILTER'], '.', site['FORMAT']] + calls
+
+
 def process_vcf_slice(tabix_file, chrm, start, stop, position_data):
 
-    tbx = pysam.Tabixfile(tabix_file)
-    tbx_lines = tbx.fetch(chrm, start, stop)
+    if BCF.is_bcf(tabix_file):
+        tbx_lines = bcf_slice_rows(tabix_file, chrm, start, stop)
+    else:
+        tbx = pysam.Tabixfile(tabix_file)
+        tbx_lines = (line.strip().split("\t") for line in tbx.fetch(chrm, start, stop))
 
     numb_of_seqs = len(position_data._fields[9:])
     alignment = np.zeros((stop-start,numb_of_seqs), np.string0)
@@ -229,8 +245,9 @@ def process_vcf_slice(tabix_file, chrm, start, stop, position_data):
     if tbx_lines == None:
         return 'error'
 
-    for line in tbx_lines:
-        current_base = position_data._make(line.strip().split("\t"))
+    current_base = None
+    for row in tbx_lines:
+        current_base = position_data._make(row)
         base_calls = callSNPs(current_base, numb_of_seqs)
         current_data.append(base_calls.copy())
 
@@ -270,9 +287,12 @@ def main():
     start, stop = int(start), int(stop)
     
     # OPEN VCF
-    vcf_file = gzip.open(args.input[0],'rb')
-    position_data, chrm_data = makeDataTuple(vcf_file)
-    vcf_file.close()
+    if BCF.is_bcf(args.input[0]):
+        position_data, chrm_data = makeDataTuple(line + "\n" for line in BCF.header_lines(args.input[0]))
+    else:
+        vcf_file = helpers.open_text(args.input[0], read_ahead=False)   # only the header is read
+        position_data, chrm_data = makeDataTuple(vcf_file)
+        vcf_file.close()
 
     oneliner = process_vcf_slice(args.input[0], chrm, start, stop, position_data)
     oneliner = oneliner2phylip(oneliner)
@@ -3,15 +3,54 @@
 
 import os
 import sys
+import math
+import json
 sys.path.insert(0, os.path.abspath('..'))  # Seriously?! This is fucking ugly.
 
 
+import shutil
+import tempfile
 import unittest
+import numpy
 import pypgen
 from pypgen.parser import VCF
+from pypgen.parser import BCF
+from pypgen.parser import intervals
+from pypgen.fstats import fstats
+from pypgen.fstats import resampling
+from pypgen.fstats import accumulators
+from pypgen.fstats import backends
+from pypgen.misc import bgzf
+from pypgen.misc import mapped
+from pypgen.misc import sharedmem
+from pypgen.misc import writers
+from pypgen.misc import simulate
+from pypgen.misc.runstats import RunStats
+from pypgen.misc import progress
+from pypgen.misc import profiling
 from pypgen.misc.helpers import *
 from collections import OrderedDict
 
+
+
+class StatsAssertions(object):
+    """assertStatsAlmostEqual for the TestCases of F-statistics."""
+
+    def assertStatsAlmostEqual(self, expected, observed, places=12):
+        """Compare (nested dicts of) estimates to 12 decimal places, as
+        the order of floating point operations differs between
+        implementations. NaNs must be NaN in both."""
+
+        self.assertEqual(sorted(expected.keys()), sorted(observed.keys()))
+        for key, value in expected.items():
+            if isinstance(value, dict):
+                self.assertStatsAlmostEqual(value, observed[key], places)
+            elif math.isnan(value):
+                self.assertTrue(math.isnan(observed[key]))
+            else:
+                self.assertAlmostEqual(value, observed[key], places)
+
+
 class TestSlicing(unittest.TestCase):
 
     def setUp(self):
@@ -187,7 +226,7 @@ class TestGenoTypeParsing(unittest.TestCase):
         self.assertEqual(diff, None)
 
 
-class TestFstatsCalculations(unittest.TestCase):
+class TestFstatsCalculations(StatsAssertions, unittest.TestCase):
 
     def setUp(self):
         self.trivial_allele_counts = {'pop1': {0: 2.0, 1: 8.0, },
@@ -200,7 +239,7 @@ class TestFstatsCalculations(unittest.TestCase):
 
     def test_calc_fstats_trivial_allele_counts(self):
         f_statistics = VCF.calc_fstats(self.trivial_allele_counts)
-        self.assertEqual(
+        self.assertStatsAlmostEqual(
             {('pop2', 'pop1'):
                 {'G_prime_st_est': 0.6803049722304385,
                 'D_est': 0.517460317460318,
@@ -221,6 +260,166 @@ class TestFstatsCalculations(unittest.TestCase):
             'Ht_est': 0.48648648648648646},
             f_statistics[('pachi', 'outgroups')])
 
+    def test_calc_fstats_global_matches_k_population_estimators(self):
+        f_statistics = VCF.calc_fstats(self.normal_allele_counts, global_stats=True)
+        populations = tuple(self.normal_allele_counts.keys())
+        self.assertTrue(populations in f_statistics)
+
+        allele_freqs = [[c / 20.0 for c in self.normal_allele_counts[pop].values()] for pop in populations]
+        allele_freqs[populations.index('outgroups')] = [1.0, 0.0, 0.0, 0.0, 0.0]
+
+        n = len(populations)
+        harm_mean = fstats.harmonic_mean([20.0, 20.0, 20.0, 4.0])
+        Hs_est = fstats.Hs_est(fstats.Hs_prime_est(allele_freqs, n), harm_mean)
+        Ht_est = fstats.Ht_est(fstats.Ht_prime_est(allele_freqs, n), Hs_est, harm_mean, n)
+
+        self.assertAlmostEqual(f_statistics[populations]['Hs_est'], Hs_est, 12)
+        self.assertAlmostEqual(f_statistics[populations]['Ht_est'], Ht_est, 12)
+        self.assertAlmostEqual(f_statistics[populations]['D_est'], fstats.D_est(Ht_est, Hs_est, n), 12)
+
+    def test_f_statistics_2_sorted_list_labels(self):
+        multilocus_f_statistics = {('pop1', 'pop2'): {'Gst_est': 0.5, 'Gst_est.stdev': 0.1},
+                                   ('pop1', 'pop2', 'pop3'): {'Gst_est': 0.25, 'Gst_est.stdev': 0.2}}
+
+        stats, order = VCF.f_statistics_2_sorted_list(multilocus_f_statistics, order=[])
+        self.assertEqual(map(VCF.f_statistics_column, order), ['global.Gst_est', 'global.Gst_est.stdev',
+                                                               'pop1.pop2.Gst_est', 'pop1.pop2.Gst_est.stdev'])
+        self.assertEqual(stats, [0.25, 0.2, 0.5, 0.1])
+
+        # the columns are keys, not labels, so names may hold dots
+        f_statistics = VCF.calc_fstats({'cy.do': {0: 2.0, 1: 8.0}, 'me.po': {0: 8.0, 1: 2.0}})
+        stats, order = VCF.f_statistics_2_sorted_list(f_statistics, order=[])
+        pair = order[0][0]
+        self.assertEqual(sorted(pair), ['cy.do', 'me.po'])
+        self.assertEqual(VCF.snv_header([[], order, []])[2], '.'.join(pair) + '.D_est')
+        self.assertEqual(stats[0], f_statistics[pair]['D_est'])
+
+        self.assertRaises(ValueError, VCF.parse_populations_list, ['global:s1,s2', 'pop2:s3'])
+
+
+class TestRunningStats(unittest.TestCase):
+
+    def setUp(self):
+        self.values = [0.3, 1.2, float('NaN'), 4.0, 2.5, 0.7, 3.3]
+
+    def test_matches_list_functions(self):
+        stats = fstats.RunningStats(self.values)
+
+        self.assertEqual(stats.count, 6)
+        self.assertEqual(stats.nan_count, 1)
+        self.assertAlmostEqual(stats.mean(), fstats._mean_(self.values), 12)
+        self.assertAlmostEqual(stats.stdev(), fstats._stdev_(self.values), 12)
+
+    def test_merge_matches_single_pass(self):
+        whole = fstats.RunningStats(self.values)
+        merged = fstats.RunningStats(self.values[:3]).merge(fstats.RunningStats(self.values[3:]))
+        merged.merge(fstats.RunningStats())
+
+        self.assertEqual((whole.count, whole.nan_count), (merged.count, merged.nan_count))
+        for method in ('mean', 'variance', 'total', 'total_sq'):
+            self.assertAlmostEqual(getattr(whole, method)(), getattr(merged, method)(), 12)
+
+    def test_empty(self):
+        stats = fstats.RunningStats([float('NaN')])
+        self.assertTrue(math.isnan(stats.mean()))
+        self.assertTrue(math.isnan(stats.variance()))
+
+
+class TestBackends(StatsAssertions, unittest.TestCase):
+    """Every available backend must reproduce the golden values."""
+
+    def setUp(self):
+        self.backends = ['python', 'numpy']
+        if backends.numba_available():
+            self.backends.append('numba')
+
+        self.trivial_allele_counts = {'pop1': {0: 2.0, 1: 8.0, },
+                                      'pop2': {0: 8.0, 1: 2.0, }}
+
+        self.normal_allele_counts = {'melpo': {0: 18.0, 1: 2.0, 2: 0.0, 3: 0.0, 4: 0.0},
+                                     'cydno': {0: 16.0, 1: 4.0, 2: 0.0, 3: 0.0, 4: 0.0},
+                                     'pachi': {0: 4.0, 1: 16.0, 2: 0.0, 3: 0.0, 4: 0.0},
+                                     'outgroups': {0: 4.0, 1: 0.0, 2: 0.0, 3: 0.0, 4: 0.0}}
+
+    def test_trivial_allele_counts(self):
+        for backend in self.backends:
+            f_statistics = VCF.calc_fstats(self.trivial_allele_counts, backend=backend)
+            self.assertStatsAlmostEqual(
+                {('pop2', 'pop1'):
+                    {'G_prime_st_est': 0.6803049722304385,
+                    'D_est': 0.517460317460318,
+                    'G_double_prime_st_est': 0.7609710550887027,
+                    'Gst_est': 0.33747412008281613,
+                    'Hs_est': 0.3368421052631577,
+                    'Ht_est': 0.508421052631579}},
+                f_statistics)
+
+    def test_normal_allele_counts(self):
+        for backend in self.backends:
+            f_statistics = VCF.calc_fstats(self.normal_allele_counts, backend=backend)
+            self.assertStatsAlmostEqual(
+                {'G_prime_st_est': 0.9140159767610748,
+                'D_est': 0.7581699346405228,
+                'G_double_prime_st_est': 0.9477124183006534,
+                'Gst_est': 0.6444444444444445,
+                'Hs_est': 0.1729729729729729,
+                'Ht_est': 0.48648648648648646},
+                f_statistics[('pachi', 'outgroups')])
+
+    def test_global_and_missing_populations_match_python(self):
+        allele_counts = dict(self.normal_allele_counts)
+        allele_counts['outgroups'] = {0: 0.0, 1: 0.0, 2: 0.0, 3: 0.0}
+        for counts in (self.normal_allele_counts, allele_counts):
+            expected = VCF.calc_fstats(counts, global_stats=True)
+            for backend in self.backends:
+                self.assertStatsAlmostEqual(expected, VCF.calc_fstats(counts, True, backend))
+
+    def test_global_Hs_and_Ht_excel_example(self):
+        """Three population example in data/excel_example/Nei_Gst_Calculations.xlsx"""
+
+        allele_freqs = [[[0.3674, 0.6122, 0.0204, 0.0],
+                         [0.3415, 0.6402, 0.0183, 0.0],
+                         [0.1415, 0.8378, 0.0135, 0.0]]]
+
+        for backend in self.backends:
+            keys, Hs_prime, Ht_prime, Ns = backends.get_backend(backend).hs_ht_prime_from_frequencies(
+                allele_freqs, [[100.0, 100.0, 100.0]], True)
+            self.assertEqual(keys[-1], (0, 1, 2))
+            self.assertAlmostEqual(Hs_prime[0, -1], 0.41362857333333336, 12)
+            self.assertAlmostEqual(Ht_prime[0, -1], 0.43390655111111121, 12)
+
+    def test_count_alleles(self):
+        genotypes = numpy.random.RandomState(1).randint(-1, 4, size=(50, 12, 2))
+        sample_populations = [0] * 5 + [1] * 5 + [-1, 2]
+
+        expected = backends.get_backend('python').count_alleles(genotypes, sample_populations, 3)
+        self.assertEqual(expected[:, 0, :].sum(), (genotypes[:, :5] >= 0).sum())
+
+        for backend in self.backends:
+            counts = backends.get_backend(backend).count_alleles(genotypes, sample_populations, 3)
+            self.assertTrue((counts == expected).all())
+
+    def test_alleles_above_three_are_refused(self):
+        genotypes = [[[0, 1], [0, 4], [1, 1], [-1, -1]]]
+        allele_counts = {'pop1': {0: 2.0, 1: 1.0, 4: 1.0},
+                         'pop2': {0: 0.0, 1: 2.0}}
+        vcf_line = {'s1': {'GT': '0/1'}, 's2': {'GT': '0/4'}}
+
+        for backend in self.backends + ['auto']:
+            self.assertRaises(ValueError, backends.get_backend(backend).count_alleles, genotypes, [0, 0, 1, 1], 2)
+            self.assertRaises(ValueError, VCF.calc_fstats, allele_counts, False, backend)
+
+        self.assertRaises(ValueError, VCF.calc_allele_counts, {'pop1': ['s1', 's2']}, vcf_line)
+        self.assertRaises(ValueError, VCF.calc_sample_allele_counts, ['s1', 's2'], vcf_line)
+
+    def test_auto_uses_python_for_single_sites(self):
+        self.assertEqual(backends.get_backend('auto', sites=1).name, 'python')
+        self.assertNotEqual(backends.get_backend('auto', sites=backends.AUTO_BLOCK_SITES).name, 'python')
+
+        self.assertEqual(backends.run_backend('auto', 10001), 'numpy')
+        self.assertEqual(backends.run_backend('auto', backends.AUTO_NUMBA_BP), 'auto')
+        self.assertEqual(backends.run_backend('numba', 10001), 'numba')
+
 
 class TestMultilocusFstatsCalculations(unittest.TestCase):
     def setUp(self):
@@ -271,5 +470,984 @@ class TestMultilocusFstatsCalculations(unittest.TestCase):
         'D_est': 0.6488650338184054}}, ml_stats)
 
 
+class TestAccumulators(StatsAssertions, unittest.TestCase):
+
+    def setUp(self):
+        self.Hs_est = [0.0, 0.1403846153846153, 0.3, 0.2, 0.1]
+        self.Ht_est = [0.14891304347826081, 0.052536231884058045, 0.5, 0.5, 0.1]
+
+    def accumulate(self, Hs_est, Ht_est):
+        accumulator = accumulators.HsHtAccumulator(2)
+        for Hs, Ht in zip(Hs_est, Ht_est):
+            accumulator.update(Hs, Ht)
+        return accumulator
+
+    def test_estimates_match_calc_multilocus_f_statistics(self):
+        ml_stats = VCF.calc_multilocus_f_statistics({('pop1', 'pop2'): self.Hs_est},
+                                                    {('pop1', 'pop2'): self.Ht_est})
+        accumulator = self.accumulate(self.Hs_est, self.Ht_est)
+        self.assertStatsAlmostEqual(ml_stats[('pop1', 'pop2')], accumulator.estimates())
+
+    def test_merge_matches_single_pass(self):
+        whole = self.accumulate(self.Hs_est, self.Ht_est)
+        merged = self.accumulate(self.Hs_est[:2], self.Ht_est[:2])
+        merged.merge(self.accumulate(self.Hs_est[2:], self.Ht_est[2:]))
+
+        self.assertEqual(whole.sites, merged.sites)
+        self.assertStatsAlmostEqual(whole.estimates(), merged.estimates())
+
+    def test_sums_match_window_sums(self):
+        accumulator = self.accumulate(self.Hs_est, self.Ht_est)
+        expected = resampling.window_sums(self.Ht_est, self.Hs_est, 2)
+        for e, o in zip(expected, accumulator.sums()):
+            self.assertAlmostEqual(e, o, 12)
+
+    def test_NaN_sites(self):
+        accumulator = self.accumulate([float('NaN'), 0.3, 0.2], [float('NaN'), 0.5, 0.5])
+        estimates = accumulator.estimates()
+
+        self.assertEqual(accumulator.sites, 2)
+        self.assertAlmostEqual(estimates['Gst_est'], 0.5, 12)
+        self.assertTrue(math.isnan(estimates['D_est']))   # as multilocus_D_est
+
+        empty = self.accumulate([float('NaN')], [float('NaN')])
+        self.assertEqual(empty.estimates(), None)
+
+    def test_summary_reduces_windows_exactly(self):
+        key = ('pop1', 'pop2')
+        summary = accumulators.MultilocusSummary()
+        summary.add('Chr01', {key: self.accumulate(self.Hs_est[:2], self.Ht_est[:2])})
+        summary.add('Chr01', {key: self.accumulate(self.Hs_est[2:3], self.Ht_est[2:3])})
+        summary.add('Chr02', {key: self.accumulate(self.Hs_est[3:], self.Ht_est[3:])})
+
+        levels = list(summary.levels())
+        self.assertEqual([(level, chrm) for level, chrm, acc in levels],
+                         [('chromosome', 'Chr01'), ('chromosome', 'Chr02'), ('genome', 'all')])
+        self.assertEqual(levels[0][2][key].sites, 3)
+
+        whole = self.accumulate(self.Hs_est, self.Ht_est)
+        self.assertStatsAlmostEqual(whole.estimates(), summary.genome()[key].estimates())
+
+    def test_distance_matrices(self):
+        accs = {('pop1', 'pop2'): self.accumulate(self.Hs_est, self.Ht_est)}
+        matrices = accumulators.distance_matrices(accs, ['pop1', 'pop2', 'pop3'])
+        Gst = accs[('pop1', 'pop2')].estimates()['Gst_est']
+
+        self.assertEqual(matrices['Gst_est'][0, 1], Gst)
+        self.assertEqual(matrices['Gst_est'][1, 0], Gst)
+        self.assertEqual(matrices['Gst_est'][2, 2], 0.0)
+        self.assertTrue(math.isnan(matrices['Gst_est'][0, 2]))
+
+
+class TestResampling(unittest.TestCase):
+
+    def setUp(self):
+        self.Hs_est = [0.3, 0.2]
+        self.Ht_est = [0.5, 0.5]
+
+    def test_multilocus_estimates_match_multilocus_f_statistics(self):
+        ml_stats = VCF.calc_multilocus_f_statistics({('pop1', 'pop2'): self.Hs_est},
+                                                    {('pop1', 'pop2'): self.Ht_est})[('pop1', 'pop2')]
+        estimates = resampling.multilocus_estimates(self.Ht_est, self.Hs_est, 2)
+
+        for stat in resampling.ESTIMATORS:
+            self.assertAlmostEqual(estimates[stat][0], ml_stats[stat], 12)
+
+    def test_bootstrap_ci_of_identical_loci(self):
+        intervals = resampling.bootstrap_ci([0.5] * 10, [0.3] * 10, 2, replicates=100, seed=1)
+        low, high = intervals['Gst_est']
+        self.assertAlmostEqual(low, 0.4, 12)
+        self.assertAlmostEqual(high, 0.4, 12)
+
+    def test_bootstrap_ci_brackets_estimate(self):
+        random_state = numpy.random.RandomState(0)
+        Hs_est = random_state.uniform(0.1, 0.3, 200)
+        Ht_est = Hs_est + random_state.uniform(0.0, 0.2, 200)
+
+        estimate = resampling.multilocus_estimates(Ht_est, Hs_est, 2)
+        intervals = resampling.bootstrap_ci(Ht_est, Hs_est, 2, replicates=500, seed=1, batch_size=64)
+        for stat in resampling.ESTIMATORS:
+            low, high = intervals[stat]
+            self.assertTrue(low < estimate[stat][0] < high)
+
+    def test_block_jackknife_estimate_pools_windows(self):
+        windows = [(self.Ht_est, self.Hs_est), ([0.4, 0.6, 0.5], [0.1, 0.2, 0.3])]
+        sums = [resampling.window_sums(Ht, Hs, 2) for Ht, Hs in windows]
+        results = resampling.block_jackknife(sums, 2)
+
+        pooled = resampling.multilocus_estimates([0.5, 0.5, 0.4, 0.6, 0.5], [0.3, 0.2, 0.1, 0.2, 0.3], 2)
+        for stat in resampling.ESTIMATORS:
+            self.assertAlmostEqual(results[stat][0], pooled[stat][0], 12)
+            self.assertTrue(results[stat][1] > 0.0)
+
+    def test_permutation_test_observed_statistic(self):
+        # two loci, pop A = first three samples
+        genotypes = [[[2, 0, 0, 0], [2, 0, 0, 0], [1, 1, 0, 0], [0, 2, 0, 0], [1, 1, 0, 0]],
+                     [[1, 1, 0, 0], [2, 0, 0, 0], [0, 0, 0, 0], [0, 2, 0, 0], [0, 2, 0, 0]]]
+
+        Hs_est_list, Ht_est_list = [], []
+        for site in genotypes:
+            allele_counts = {'A': dict(enumerate(numpy.sum(site[:3], axis=0, dtype=float).tolist())),
+                             'B': dict(enumerate(numpy.sum(site[3:], axis=0, dtype=float).tolist()))}
+            f_statistics = VCF.calc_fstats(allele_counts).values()[0]
+            Hs_est_list.append(f_statistics['Hs_est'])
+            Ht_est_list.append(f_statistics['Ht_est'])
+
+        ml_stats = VCF.calc_multilocus_f_statistics({('A', 'B'): Hs_est_list}, {('A', 'B'): Ht_est_list})
+        results = resampling.permutation_test(genotypes, 3, permutations=10, seed=1)
+
+        self.assertAlmostEqual(results['Gst_est'][0], ml_stats[('A', 'B')]['Gst_est'], 12)
+        self.assertAlmostEqual(results['D_est'][0], ml_stats[('A', 'B')]['D_est'], 12)
+
+    def test_permutation_test_p_values(self):
+        fixed_differences = [[[2, 0, 0, 0]] * 10 + [[0, 2, 0, 0]] * 10] * 20
+        results = resampling.permutation_test(fixed_differences, 10, permutations=199, seed=1, batch_size=50)
+        self.assertEqual(results['Gst_est'][1], 1 / 200.0)
+
+        random_state = numpy.random.RandomState(2)
+        alleles = random_state.randint(0, 2, size=(30, 16, 2))
+        genotypes = numpy.zeros((30, 16, 4))
+        for allele in range(2):
+            genotypes[:, :, allele] = (alleles == allele).sum(axis=2)
+
+        threaded = resampling.permutation_test(genotypes, 8, permutations=200, seed=3, batch_size=30, threads=3)
+        serial = resampling.permutation_test(genotypes, 8, permutations=200, seed=3, batch_size=30)
+        self.assertEqual(threaded, serial)
+        self.assertTrue(threaded['Gst_est'][1] > 0.01)
+
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.header = ['chrom', 'chromStart', 'chromEnd', 'snp_count', 'pop1.pop2.Gst_est']
+        self.rows = [['Chr01', 1, 1000, 54, 0.25],
+                     ['Chr01', 1001, 2000, 101, float('NaN')],
+                     ['Chr02', 1, 1000, 3, 0.5]]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_columnar_round_trip(self):
+        path = os.path.join(self.tmp_dir, 'results')
+        writer = writers.ColumnarWriter(path, buffer_size=2)
+        writer.write_header(self.header)
+        for row in self.rows:
+            writer.write_row(row)
+        writer.close()
+
+        columns = writers.load_columnar(path)
+        self.assertEqual(columns.keys(), self.header)
+        self.assertEqual(list(columns['chrom']), ['Chr01', 'Chr01', 'Chr02'])
+        self.assertEqual(list(columns['chromStart']), [1, 1001, 1])
+        self.assertEqual(columns['snp_count'].dtype.str, '<i8')
+        self.assertEqual(columns['pop1.pop2.Gst_est'][0], 0.25)
+        self.assertTrue(math.isnan(columns['pop1.pop2.Gst_est'][1]))
+
+    def test_columnar_partial_results_are_loadable(self):
+        path = os.path.join(self.tmp_dir, 'results')
+        writer = writers.ColumnarWriter(path, buffer_size=2)
+        writer.write_header(self.header)
+        for row in self.rows:
+            writer.write_row(row)
+
+        columns = writers.load_columnar(path)
+        self.assertEqual(len(columns['chromEnd']), 2)
+
+    def test_columnar_int_column_promoted_to_float(self):
+        path = os.path.join(self.tmp_dir, 'results')
+        writer = writers.ColumnarWriter(path, buffer_size=1)
+        writer.write_header(['name', 'value'])
+        for row in [['x', 1], ['y', 1.5], ['z', float('NaN')]]:
+            writer.write_row(row)
+        writer.close()
+
+        columns = writers.load_columnar(path)
+        self.assertEqual(columns['value'].dtype.str, '<f8')
+        self.assertEqual(list(columns['value'][:2]), [1.0, 1.5])
+        self.assertTrue(math.isnan(columns['value'][2]))
+
+    def test_csv_writer(self):
+        path = os.path.join(self.tmp_dir, 'results.csv')
+        writer = writers.open_writer(path, 'csv', sep='\t')
+        writer.write_header(self.header)
+        writer.write_row(self.rows[0])
+        writer.close()
+
+        self.assertEqual(open(path).read(),
+            'chrom\tchromStart\tchromEnd\tsnp_count\tpop1.pop2.Gst_est\n'
+            'Chr01\t1\t1000\t54\t0.25\n')
+
+    def test_tabix_writer_region_queries(self):
+        import pysam
+        path = os.path.join(self.tmp_dir, 'results.gz')
+        writer = writers.open_writer(path, 'bgzip', tabix_columns=(1, 2, 3))
+        writer.write_header(self.header)
+
+        rows = []
+        for chrm in ['Chr01', 'Chr02']:
+            for start in xrange(1, 2000001, 100):       # spans many BGZF blocks
+                row = [chrm, start, start + 99, 10, 0.5]
+                writer.write_row(row)
+                rows.append(row)
+        writer.close()
+
+        tbx = pysam.Tabixfile(path)
+        fetched = [line.split("\t") for line in tbx.fetch('Chr02', 1499999, 1500250)]
+        self.assertEqual([(f[0], int(f[1])) for f in fetched],
+                         [('Chr02', 1499901), ('Chr02', 1500001), ('Chr02', 1500101), ('Chr02', 1500201)])
+        self.assertEqual(len(list(tbx.fetch('Chr01'))), 20000)
+
+    def test_tabix_writer_without_header(self):
+        import gzip
+        import struct
+        import pysam
+        path = os.path.join(self.tmp_dir, 'results.gz')
+        writer = writers.open_writer(path, 'bgzip', tabix_columns=(1, 2, 3))
+        for row in self.rows:
+            writer.write_row(row)
+        writer.close()
+
+        self.assertEqual([line.split("\t")[1] for line in pysam.Tabixfile(path).fetch('Chr01')], ['1', '1001'])
+
+        # n_ref, format, col_seq, col_beg, col_end, meta, skip
+        index = gzip.open(path + '.tbi').read()
+        self.assertEqual(struct.unpack('<7i', index[4:32])[6], 0)   # the first row is not a header
+
+    def test_tabix_writer_rejects_unsorted_rows(self):
+        path = os.path.join(self.tmp_dir, 'results.gz')
+        writer = writers.open_writer(path, 'bgzip', tabix_columns=(1, 2, 3))
+        writer.write_row(self.rows[1])
+        self.assertRaises(ValueError, writer.write_row, self.rows[0])
+        writer.close()
+
+
+class TestBgzfReader(unittest.TestCase):
+
+    def setUp(self):
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lines_match_gzip(self):
+        import gzip
+        expected = list(gzip.open(self.bgzip_path, 'rb'))
+
+        for threads in (1, 3):
+            for blocks_per_task in (1, 2, 16):
+                reader = bgzf.BgzfReader(self.bgzip_path, threads, blocks_per_task)
+                self.assertEqual(list(reader), expected)
+                reader.close()
+
+    def test_lines_spanning_blocks(self):
+        path = os.path.join(self.tmp_dir, 'long.gz')
+        lines = ["{}\t{}\n".format(count, 'A' * (count * 7919 % 150000)) for count in xrange(40)]
+        lines.append('no newline')
+
+        writer = bgzf.BgzfWriter(path)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+
+        self.assertEqual(list(bgzf.BgzfReader(path, threads=2, blocks_per_task=1)), lines)
+
+    def test_open_bgzf_reads_plain_gzip(self):
+        import gzip
+        path = os.path.join(self.tmp_dir, 'plain.gz')
+        fout = gzip.open(path, 'wb')
+        fout.write("a\nb\n")
+        fout.close()
+
+        self.assertFalse(bgzf.is_bgzf(path))
+        self.assertTrue(bgzf.is_bgzf(self.bgzip_path))
+        self.assertEqual(list(bgzf.open_bgzf(path)), ["a\n", "b\n"])
+
+    def test_header_reads_without_read_ahead(self):
+        import gzip
+        fin = open_text(self.bgzip_path, read_ahead=False)
+        self.assertTrue(isinstance(fin, gzip.GzipFile))
+        self.assertEqual(fin.readline(), next(iter(bgzf.open_bgzf(self.bgzip_path))))
+        fin.close()
+
+        self.assertEqual(VCF.make_empty_vcf_ordered_dict(self.bgzip_path).keys()[:2], ['CHROM', 'POS'])
+
+    def test_corrupt_block(self):
+        path = os.path.join(self.tmp_dir, 'corrupt.gz')
+        data = bytearray(bgzf.compress_block("chr1\t1\n" * 100))
+        data[-5] ^= 0xff   # the CRC of the uncompressed data
+        open(path, 'wb').write(str(data) + bgzf.EOF_BLOCK)
+
+        self.assertRaises(IOError, list, bgzf.BgzfReader(path, threads=2))
+
+    def test_split_ranges_hold_every_line_once(self):
+        import gzip
+        path = os.path.join(self.tmp_dir, 'long.gz')
+        lines = ["{}\t{}\n".format(count, 'A' * (count * 7919 % 150000)) for count in xrange(40)]
+
+        writer = bgzf.BgzfWriter(path)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+
+        for vcf_path, expected in [(self.bgzip_path, list(gzip.open(self.bgzip_path, 'rb'))), (path, lines)]:
+            for parts in (1, 2, 5, 100):
+                ranges = bgzf.split_ranges(vcf_path, parts)
+                self.assertTrue(1 <= len(ranges) <= parts)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], None)
+
+                found = []
+                for start, stop in ranges:
+                    found.extend(bgzf.BgzfReader(vcf_path, threads=1, start=start, stop=stop))
+                self.assertEqual(found, expected)
+
+    def test_header_lines_without_index(self):
+        path = os.path.join(self.tmp_dir, 'example.vcf.gz')
+        shutil.copy(self.bgzip_path, path)
+
+        self.assertEqual(VCF.header_lines(path), VCF.header_lines(self.bgzip_path))
+
+    def test_close_before_the_end(self):
+        import threading
+        threads = threading.active_count()
+
+        reader = bgzf.BgzfReader(self.bgzip_path, threads=3, blocks_per_task=1)
+        self.assertTrue(reader.next().startswith('##'))
+        reader.close()
+        self.assertEqual(threading.active_count(), threads)
+
+
+class TestMappedLines(unittest.TestCase):
+
+    def setUp(self):
+        import gzip
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vcf_path = os.path.join(self.tmp_dir, 'example.vcf')
+        self.lines = list(gzip.open(os.path.join(module_dir, "data/example.vcf.gz"), 'rb'))
+        open(self.vcf_path, 'wb').write("".join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_newline_index(self):
+        index = mapped.newline_index(self.vcf_path, chunk_bytes=1000)
+        data = open(self.vcf_path, 'rb').read()
+        self.assertEqual(list(index), [count for count, char in enumerate(data) if char == '\n'])
+
+    def test_split_lines_hold_every_line_once(self):
+        for parts in (1, 2, 7, 10000):
+            ranges = mapped.split_lines(self.vcf_path, parts)
+            self.assertTrue(1 <= len(ranges) <= min(parts, len(self.lines)))
+
+            found = []
+            for start, stop in ranges:
+                found.extend(mapped.mapped_lines(self.vcf_path, start, stop))
+            self.assertEqual(found, self.lines)
+
+    def test_line_endings_as_universal_newlines(self):
+        path = os.path.join(self.tmp_dir, 'crlf.txt')
+        open(path, 'wb').write("a\r\nbb\r\nccc")
+
+        found = []
+        for start, stop in mapped.split_lines(path, 3):
+            found.extend(mapped.mapped_lines(path, start, stop))
+        self.assertEqual(found, list(open(path, 'rU')))
+
+        empty = os.path.join(self.tmp_dir, 'empty.txt')
+        open(empty, 'wb').close()
+        self.assertEqual(list(mapped.mapped_lines(empty)), [])
+
+
+def _put_in_arena(arena, queue):
+    queue.put(arena.put(numpy.arange(12, dtype=numpy.int32).reshape(3, 4)))
+
+
+class TestSharedMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.arena = sharedmem._arena
+
+    def tearDown(self):
+        sharedmem._arena = self.arena
+
+    def test_arrays_written_by_a_worker(self):
+        import multiprocessing
+        arena = sharedmem.Arena(2, buffer_bytes=1024)
+        queue = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_put_in_arena, args=(arena, queue))
+        worker.start()
+        descriptor = queue.get()
+        worker.join()
+
+        self.assertEqual(descriptor[1:], ('<i4', (3, 4)))
+        self.assertEqual(arena.view(descriptor).tolist(), numpy.arange(12).reshape(3, 4).tolist())
+        self.assertEqual(list(arena.used), [1, 0])
+
+        arena.release(descriptor)
+        self.assertEqual(list(arena.used), [0, 0])
+
+    def test_buffers_are_reused(self):
+        arena = sharedmem.Arena(2, buffer_bytes=64)
+        first = arena.put(numpy.ones(8))
+        second = arena.put(numpy.ones(8))
+        self.assertEqual(arena.put(numpy.ones(8)), None)    # every buffer is in use
+        self.assertEqual(arena.put(numpy.ones(9)), None)    # too big
+
+        arena.release(first)
+        self.assertEqual(arena.put(numpy.zeros(8))[0], first[0])
+        self.assertEqual(arena.view(second).tolist(), [1.0] * 8)
+
+    def test_pack_rows_keeps_types(self):
+        sharedmem.create_arena(1, buffer_bytes=1024)
+        rows = [[0, 1001, 10, 0.25, float('NaN'), 1],
+                [1, 1002, 9, 0.5, 0.125, 0]]
+
+        packed = sharedmem.pack_rows(rows)
+        self.assertEqual(packed[0], 'shared')
+        unpacked = sharedmem.unpack_rows(packed)
+
+        self.assertEqual([map(type, row) for row in unpacked], [map(type, row) for row in rows])
+        self.assertEqual(repr(unpacked), repr(rows))
+        self.assertEqual(list(sharedmem._arena.used), [0] * sharedmem.BUFFERS_PER_CORE)
+
+        # columns with both ints and floats are sent as they are
+        mixed = [[0, 1.5], [1, 2]]
+        self.assertEqual(sharedmem.pack_rows(mixed), ('rows', mixed))
+        sharedmem._arena = None
+        self.assertEqual(sharedmem.pack_rows(rows), ('rows', rows))
+
+
+class TestSNVOutput(unittest.TestCase):
+
+    def setUp(self):
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+        self.populations = ['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640',
+                            'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689',
+                            'pachi:p516,p517,p518,p519,p520,p591,p596,p690,p694,p696']
+
+    def test_sites_from_window_pass(self):
+        import copy
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        populations = VCF.parse_populations_list(self.populations)
+
+        expected = []
+        for line in VCF.iter_vcf_slice(self.bgzip_path, 'Chr01', 1, 5000):
+            vcf_line = VCF.parse_vcf_line(line, copy.deepcopy(header))
+            if vcf_line['FILTER'] == 'PASS' and not VCF.is_fixed_site(vcf_line):
+                allele_counts = VCF.calc_allele_counts(populations, vcf_line)
+                f_statistics = VCF.calc_fstats(allele_counts, True)
+                expected.append((vcf_line['POS'], VCF.orient_f_statistics(f_statistics,
+                                                                           VCF.population_order(populations))))
+
+        self.assertTrue(len(expected) > 10)
+
+        for backend in ['python', 'numpy']:
+            args = VCF.chunk_args(self.bgzip_path, global_stats=True, backend=backend, snv_output='-',
+                               populations=self.populations)
+            sites = VCF.calc_slice_stats(['Chr01', 1, 5000, populations, header, args])[4]
+            self.assertEqual([site[0] for site in sites], [pos for pos, f_statistics in expected])
+
+            orders = [[], [], []]
+            for (pos, sizes, f_statistics, fixed), (expected_pos, expected_f_statistics) in zip(sites, expected):
+                self.assertEqual(sorted(f_statistics), sorted(expected_f_statistics))
+                for key, values in expected_f_statistics.iteritems():
+                    for stat, value in values.iteritems():
+                        if not math.isnan(value):
+                            self.assertAlmostEqual(f_statistics[key][stat], value)
+
+                row = VCF.snv_row('Chr01', pos, sizes, f_statistics, fixed, orders)
+                self.assertEqual(len(row), len(VCF.snv_header(orders)))
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+
+    def test_chunks_hold_the_windows_of_each_size(self):
+        window_sizes = [700, 1000, 5000]
+        chunks = list(VCF.get_chunks(self.bgzip_path, ['Chr01:1-20001'], window_sizes))
+        self.assertEqual([chunk[:3] for chunk in chunks], [('Chr01', 1, 20000)])   # spans lcm = 35000 bp
+
+        for i, window_size in enumerate(window_sizes):
+            windows = [(chrm, start, stop) for chrm, chunk_start, chunk_stop, chunk_windows, features in chunks
+                       for start, stop in chunk_windows[i]]
+            self.assertEqual(windows, list(VCF.get_slice_indicies(self.bgzip_path, ['Chr01:1-20001'], window_size)))
+
+            for chrm, chunk_start, chunk_stop, chunk_windows, features in chunks:
+                for start, stop in chunk_windows[i]:
+                    self.assertTrue(chunk_start <= start and stop <= chunk_stop)
+
+    def test_chunks_are_capped_for_sizes_that_do_not_divide(self):
+        window_sizes = [499, 500]
+        chunks = list(VCF.get_chunks(self.bgzip_path, ['Chr01:1-20001'], window_sizes))
+        self.assertEqual([chunk[1:3] for chunk in chunks],   # 8 * 500 bp rather than lcm = 249500 bp
+                         [(1, 4000), (4001, 8000), (8001, 12000), (12001, 16000), (16001, 20000)])
+
+        for i, window_size in enumerate(window_sizes):
+            windows = [(chrm, start, stop) for chrm, chunk_start, chunk_stop, chunk_windows, features in chunks
+                       for start, stop in chunk_windows[i]]
+            self.assertEqual(windows, list(VCF.get_slice_indicies(self.bgzip_path, ['Chr01:1-20001'], window_size)))
+
+        # windows that end past the chunk are read to their end, but
+        # its sites are only counted by the chunk holding them
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        populations = VCF.parse_populations_list(['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640',
+                                                  'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689'])
+        args = VCF.chunk_args(self.bgzip_path, backend='numpy')
+
+        chrm, window_results, feature_results, sites, run_stats = VCF.calc_chunk_stats(
+            list(chunks[1]) + [populations, header, args])
+        self.assertEqual(run_stats.counters['sites_seen'],
+                         len(list(VCF.iter_vcf_slice(self.bgzip_path, 'Chr01', 4001, 8000))))
+
+        self.assertEqual(window_results[0][0][0][1:3], [4492, 4990])   # starts after the chunk's start
+        self.assertEqual(window_results[0][-1][0][1:3], [7985, 8483])  # ends past the chunk's stop
+        for results in window_results:
+            for result in results:
+                single = VCF.calc_slice_stats(['Chr01', result[0][1], result[0][2], populations, header, args])
+                self.assertEqual(result[0][:4], single[0][:4])
+                if single[2] is None:
+                    self.assertEqual(result[2], None)   # no sites
+                    continue
+
+                for pair, f_statistics in single[2].iteritems():
+                    for stat, value in f_statistics.iteritems():
+                        if not math.isnan(value):
+                            self.assertEqual(result[2][pair][stat], value)
+
+    def test_windows_of_each_size_match_single_windows(self):
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        populations = VCF.parse_populations_list(['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640',
+                                                  'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689'])
+        windows = [[(1, 1000), (1001, 2000), (2001, 3000)], [(1, 1500), (1501, 3000)]]
+
+        block_sites = VCF.BLOCK_SITES
+        VCF.BLOCK_SITES = 7   # blocks that cross the windows of the other size
+        try:
+            for backend in ['python', 'numpy']:
+                args = VCF.chunk_args(self.bgzip_path, backend=backend)
+
+                chrm, window_results, feature_results, sites, run_stats = VCF.calc_chunk_stats(
+                    ['Chr01', 1, 3000, windows, [], populations, header, args])
+                self.assertEqual(run_stats.counters['sites_seen'],
+                                 len(list(VCF.iter_vcf_slice(self.bgzip_path, 'Chr01', 1, 3000))))
+
+                for size_windows, results in zip(windows, window_results):
+                    self.assertEqual(len(results), len(size_windows))
+
+                    for (start, stop), result in zip(size_windows, results):
+                        single = VCF.calc_slice_stats(['Chr01', start, stop, populations, header, args])
+                        self.assertEqual(result[0], single[0])
+                        self.assertEqual(result[2], single[2])
+        finally:
+            VCF.BLOCK_SITES = block_sites
+
+
+class TestFeatures(unittest.TestCase):
+
+    def setUp(self):
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_bed_and_gff(self):
+        bed = os.path.join(self.tmp_dir, 'features.bed')
+        with open(bed, 'w') as fout:
+            fout.write("track name=genes\nChr01\t0\t3000\tgeneA\nChr01\t2500\t9000\n")
+        self.assertEqual(list(intervals.read_features(bed)),
+                         [('Chr01', 1, 3000, 'geneA'), ('Chr01', 2501, 9000, 'Chr01:2501-9000')])
+
+        gff = os.path.join(self.tmp_dir, 'features.gff3')
+        with open(gff, 'w') as fout:
+            fout.write("##gff-version 3\n"
+                       "Chr01\tsrc\tgene\t1\t3000\t.\t+\t.\tID=geneA;Name=A\n"
+                       "Chr01\tsrc\texon\t1001\t1500\t.\t+\t.\tParent=geneA\n"
+                       "##FASTA\n>Chr01\nACGT\n")
+        self.assertEqual(list(intervals.read_features(gff)),
+                         [('Chr01', 1, 3000, 'geneA'), ('Chr01', 1001, 1500, 'Chr01:1001-1500')])
+        self.assertEqual(list(intervals.read_features(gff, 'exon')), [('Chr01', 1001, 1500, 'Chr01:1001-1500')])
+
+    def test_feature_chunks_split_at_gaps(self):
+        contigs = intervals.features_by_contig([('Chr01', 500, 900, 'b'), ('Chr01', 1, 1000, 'a'),
+                                                ('Chr01', 5000, 5100, 'c'), ('Chr02', 1, 10, 'd'),
+                                                ('Chr03', 1, 10, 'e')], contigs_to_skip=['Chr03'])
+        self.assertEqual(contigs.keys(), ['Chr01', 'Chr02'])
+        self.assertEqual(intervals.merge_intervals(contigs['Chr01']), [(1, 1000), (5000, 5100)])
+
+        chunks = list(intervals.get_feature_chunks(contigs, chunk_size=600))
+        self.assertEqual([chunk[:3] for chunk in chunks], [('Chr01', 1, 1000), ('Chr01', 5000, 5100),
+                                                           ('Chr02', 1, 10)])
+        self.assertEqual([len(chunk[4]) for chunk in chunks], [2, 1, 1])
+
+    def test_overlapping_features_match_single_windows(self):
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        populations = VCF.parse_populations_list(['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640',
+                                                  'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689'])
+        features = [(1, 3000, 'geneA'), (1001, 1500, 'exon1'), (2501, 5000, 'geneB'), (7001, 7002, 'empty')]
+
+        block_sites = VCF.BLOCK_SITES
+        VCF.BLOCK_SITES = 7   # blocks that cross the features
+        try:
+            for backend in ['python', 'numpy']:
+                args = VCF.chunk_args(self.bgzip_path, backend=backend)
+
+                chrm, window_results, feature_results, sites, run_stats = VCF.calc_chunk_stats(
+                    ['Chr01', 1, 7002, [], features, populations, header, args])
+                self.assertEqual(window_results, [])
+                self.assertEqual([result[0][3] for result in feature_results], ['geneA', 'exon1', 'geneB', 'empty'])
+
+                # the sites of the overlapping features are read once
+                self.assertEqual(run_stats.counters['sites_seen'],
+                                 len(list(VCF.iter_vcf_slice(self.bgzip_path, 'Chr01', 1, 5000)))
+                                 + len(list(VCF.iter_vcf_ranges(self.bgzip_path, 'Chr01', [(7001, 7002)]))))
+
+                for (start, stop, name), result in zip(features, feature_results):
+                    single = VCF.calc_slice_stats(['Chr01', start, stop, populations, header, args])
+                    self.assertEqual(map(repr, result[0][:3] + result[0][4:]), map(repr, single[0]))
+                    self.assertEqual(sorted(result[2] or []), sorted(single[2] or []))
+
+                    for key, values in (single[2] or {}).iteritems():
+                        for stat, value in values.iteritems():
+                            if math.isnan(value):
+                                self.assertTrue(math.isnan(result[2][key][stat]))
+                            else:
+                                self.assertEqual(result[2][key][stat], value)
+        finally:
+            VCF.BLOCK_SITES = block_sites
+
+
+class TestMask(unittest.TestCase):
+
+    def setUp(self):
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # 1-based: 1001-1200, 1150-1300 (merged), 2001-3000 and 5001-6000 on Chr01
+        self.bed = os.path.join(self.tmp_dir, 'mask.bed')
+        with open(self.bed, 'w') as fout:
+            fout.write("Chr01\t1149\t1300\nChr01\t1000\t1200\nChr01\t2000\t3000\n"
+                       "Chr01\t5000\t6000\nChr02\t0\t10\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_masked_positions_and_windows(self):
+        mask = intervals.IntervalMask(intervals.read_mask(self.bed))
+        self.assertEqual(mask.interval_count(), 4)
+
+        self.assertEqual(list(mask.masked('Chr01', [1, 1000, 1001, 1250, 1300, 1301, 3000, 6001])),
+                         [False, False, True, True, True, False, True, False])
+        self.assertEqual(list(mask.masked('Chr03', [1, 2])), [False, False])
+
+        self.assertEqual(list(mask.covered('Chr01', [1001, 2001, 2001, 4001], [1300, 3000, 3001, 5000])),
+                         [True, True, False, False])
+
+        lines = ["#CHROM\tPOS\n", "Chr01\t999\tx\n", "Chr01\t1001\tx\n", "Chr02\t5\tx\n", "Chr02\t11\tx\n"]
+        skipped = []
+        self.assertEqual(list(mask.unmasked_lines(lines, skipped.extend, batch_size=2)),
+                         ["#CHROM\tPOS\n", "Chr01\t999\tx\n", "Chr02\t11\tx\n"])
+        self.assertEqual(skipped, ["Chr01\t1001\tx\n", "Chr02\t5\tx\n"])
+
+    def test_masked_windows_are_not_read(self):
+        mask = intervals.load_mask(self.bed)
+        chunks = list(VCF.get_chunks(self.bgzip_path, ['Chr01:1-6001'], [1000], mask=mask))
+        self.assertEqual([chunk[:3] for chunk in chunks], [('Chr01', 1, 1000), ('Chr01', 1001, 2000),
+                                                           ('Chr01', 3001, 4000), ('Chr01', 4001, 5000)])
+
+        # chunks start at their first window that is not masked
+        chunks = list(VCF.get_chunks(self.bgzip_path, ['Chr01:1-6001'], [1000, 3000], mask=mask))
+        self.assertEqual(chunks[0][:4], ('Chr01', 1, 3000, [[(1, 1000), (1001, 2000)], [(1, 3000)]]))
+        self.assertEqual(chunks[1][:4], ('Chr01', 3001, 6000, [[(3001, 4000), (4001, 5000)], [(3001, 6000)]]))
+
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        populations = VCF.parse_populations_list(['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640',
+                                                  'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689'])
+        args = VCF.chunk_args(self.bgzip_path, backend='numpy', mask=self.bed)
+        chrm, window_results, feature_results, sites, run_stats = VCF.calc_chunk_stats(
+            list(chunks[0]) + [populations, header, args])
+
+        positions = []
+        for line in VCF.iter_vcf_slice(self.bgzip_path, 'Chr01', 1, 3000):
+            vcf_line = VCF.parse_vcf_line(line, header)
+            if vcf_line['FILTER'] == 'PASS':
+                positions.append(vcf_line['POS'])
+
+        unmasked = [pos for pos, masked in zip(positions, mask.masked('Chr01', positions)) if not masked]
+        self.assertTrue(0 < len(unmasked) < len(positions))
+        self.assertEqual(run_stats.counters['sites_used'], len(unmasked))
+        self.assertEqual([result[0][3] for result in window_results[0]],
+                         [sum(1 for pos in unmasked if pos <= 1000), sum(1 for pos in unmasked if 1001 <= pos <= 2000)])
+
+
+class TestBCF(unittest.TestCase):
+
+    def setUp(self):
+        import pysam
+        import pysam.bcftools
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.bcf_path = os.path.join(self.tmp_dir, 'example.bcf')
+        vcf = pysam.VariantFile(self.bgzip_path)
+        bcf = pysam.VariantFile(self.bcf_path, 'wb', header=vcf.header)
+        for record in vcf:
+            bcf.write(record)
+        bcf.close()
+        pysam.bcftools.index(self.bcf_path)
+
+        self.populations = VCF.parse_populations_list(
+            ['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640', 'outgroups:h665,i02-210',
+             'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_readers(self):
+        self.assertTrue(BCF.is_bcf(self.bcf_path))
+        self.assertFalse(BCF.is_bcf(self.bgzip_path))
+        self.assertTrue(BCF.uses_variant_file(self.bcf_path))
+        self.assertFalse(BCF.uses_variant_file(self.bgzip_path))
+        self.assertTrue(BCF.uses_variant_file(self.bgzip_path, 'pysam'))
+        self.assertRaises(ValueError, BCF.uses_variant_file, self.bcf_path, 'text')
+
+        self.assertEqual(VCF.make_empty_vcf_ordered_dict(self.bcf_path).keys(),
+                         VCF.make_empty_vcf_ordered_dict(self.bgzip_path).keys())
+        self.assertEqual(VCF.get_regions(self.bcf_path, None), VCF.get_regions(self.bgzip_path, None))
+
+    def test_sites_match_parsed_lines(self):
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        samples = [sample for pop in VCF.population_order(self.populations) for sample in self.populations[pop]]
+        reader = BCF.SiteReader(self.bcf_path, samples)
+
+        lines = list(VCF.iter_vcf_slice(self.bgzip_path, 'Chr01', 1, 3000))
+        records = list(reader.fetch('Chr01', 1, 3000))
+        self.assertEqual(len(records), len(lines))
+
+        for line, record in zip(lines, records):
+            vcf_line = VCF.parse_vcf_line(line, header)
+            site = reader.site(record)
+
+            for key in ['CHROM', 'POS', 'REF', 'ALT', 'FILTER']:
+                self.assertEqual(site[key], vcf_line[key])
+            self.assertEqual(int(site['INFO']['DP']), int(vcf_line['INFO']['DP']))
+            self.assertEqual(VCF.is_fixed_site(site), VCF.is_fixed_site(vcf_line))
+
+            self.assertEqual(VCF.get_population_sizes(site, self.populations),
+                             VCF.get_population_sizes(vcf_line, self.populations))
+            self.assertEqual(VCF.calc_allele_counts(self.populations, site),
+                             VCF.calc_allele_counts(self.populations, vcf_line))
+            self.assertEqual(site[BCF.GENOTYPES], VCF.sample_genotypes(samples, vcf_line))
+
+    def test_fetch_needs_an_index(self):
+        reader = BCF.SiteReader(self.bcf_path, ['c511'])
+        self.assertEqual(list(reader.fetch('ChrX', 1, 3000)), [])   # not in the file
+
+        unindexed = os.path.join(self.tmp_dir, 'unindexed.bcf')
+        shutil.copy(self.bcf_path, unindexed)
+        reader = BCF.SiteReader(unindexed, ['c511'])
+        self.assertEqual(len(list(reader.records())), len(list(BCF.SiteReader(self.bcf_path, ['c511']).records())))
+        self.assertRaises(IOError, reader.fetch, 'Chr01', 1, 3000)
+
+    def test_windows_match_text(self):
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+
+        for backend in ['python', 'numpy']:
+            results = []
+            for path in [self.bgzip_path, self.bcf_path]:
+                args = VCF.chunk_args(path, global_stats=True, backend=backend)
+                results.append(VCF.calc_slice_stats(['Chr01', 1, 5000, self.populations, header, args]))
+
+            text, bcf = results
+            self.assertEqual(text[0], bcf[0])
+            self.assertEqual(repr(text[2]), repr(bcf[2]))
+            del text[5].counters['bytes_read']   # not counted for records
+            self.assertEqual(text[5].counters, bcf[5].counters)
+
+
+class TestSimulate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = simulate.simulate_vcf(os.path.join(self.tmp_dir, 'sim.vcf'), samples=12,
+                                          populations=3, contigs=2, contig_length=[20000, 10000],
+                                          snp_density=0.01, multiallelic=0.2, phased=0.5,
+                                          indels=0.1, seed=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_indexed_and_sorted(self):
+        import pysam
+        tbx = pysam.Tabixfile(self.path)
+        self.assertEqual(sorted(tbx.contigs), ['chr1', 'chr2'])
+
+        positions = [int(line.split("\t")[1]) for line in tbx.fetch('chr1')]
+        self.assertEqual(positions, sorted(positions))
+        self.assertTrue(100 < len(positions) < 300)
+        self.assertTrue(all(5001 <= p <= 6000 for p in
+                            [int(line.split("\t")[1]) for line in tbx.fetch('chr1', 5000, 6000)]))
+
+    def test_lines_parse(self):
+        import pysam
+        populations = VCF.parse_populations_list(simulate.population_args(12, 3))
+        self.assertEqual([len(populations[pop]) for pop in sorted(populations)], [4, 4, 4])
+
+        vcf_line = VCF.make_empty_vcf_ordered_dict(self.path)
+        self.assertEqual(vcf_line.keys()[9:], simulate.sample_names(12))
+
+        for line in pysam.Tabixfile(self.path).fetch('chr2'):
+            vcf_line = VCF.parse_vcf_line(line, vcf_line)
+            n_alleles = len(vcf_line['ALT'].split(',')) + 1
+            counts = VCF.calc_allele_counts(populations, vcf_line)
+
+            called = sum(1 for sample in simulate.sample_names(12) if vcf_line[sample] is not None)
+            self.assertEqual(sum(sum(c.values()) for c in counts.values()), 2 * called)
+            self.assertEqual(int(vcf_line['INFO']['AN']), 2 * called)
+
+            for sample in simulate.sample_names(12):
+                if vcf_line[sample] is not None:
+                    self.assertEqual(len(vcf_line[sample]['AD']), n_alleles)
+                    self.assertEqual(len(vcf_line[sample]['PL']), n_alleles * (n_alleles + 1) / 2)
+
+
+class TestRunStats(unittest.TestCase):
+
+    def setUp(self):
+        module_dir = os.path.dirname(pypgen.__file__)
+        self.bgzip_path = os.path.join(module_dir, "data/example.vcf.gz")
+
+    def test_merge(self):
+        a, b = RunStats(), RunStats()
+        a.start()
+        a.lap('parse')
+        a.count('sites_seen', 3)
+        b.add_time('parse', 2.0, laps=4)
+        b.count('sites_seen')
+        b.count('windows_emitted')
+
+        a.merge(b)
+        self.assertEqual(a.laps['parse'], 5)
+        self.assertTrue(a.seconds['parse'] >= 2.0)
+        self.assertEqual(a.as_dict()['counters'], {'sites_seen': 4, 'windows_emitted': 1})
+
+    def test_slice_counters(self):
+        header = VCF.make_empty_vcf_ordered_dict(self.bgzip_path)
+        populations = VCF.parse_populations_list(['cydno:c511,c512,c513,c514,c515,c563,c614,c630,c639,c640',
+                                                  'melpo:m523,m524,m525,m589,m675,m676,m682,m683,m687,m689'])
+        args = VCF.chunk_args(self.bgzip_path, backend='python')
+
+        result = VCF.calc_slice_stats(['Chr01', 1, 10000000, populations, header, args])
+        chrm_start_stop, slice_stats = result[0], result[-1]
+        counters = slice_stats.counters
+
+        self.assertEqual(counters['sites_seen'], 464)
+        self.assertEqual(counters['sites_seen'] - counters['sites_skipped.filter'], counters['sites_used'])
+        self.assertEqual(counters['sites_used'], chrm_start_stop[3])
+        self.assertEqual(slice_stats.laps['parse'], 464)
+
+        empty = VCF.calc_slice_stats(['Chr02', 1, 1000, populations, header, args])
+        self.assertEqual(empty[1], None)
+        self.assertEqual(empty[-1].counters['windows_skipped.empty'], 1)
+
+
+class TestProgress(unittest.TestCase):
+
+    def test_monitor_metrics_and_report(self):
+        import Queue
+        import StringIO
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'progress.json')
+        stream = StringIO.StringIO()
+
+        queue = Queue.Queue()
+        monitor = progress.ProgressMonitor(queue, total_bp=1000, interval=3600, path=path, stream=stream)
+
+        reporter = progress.Reporter(queue)
+        reporter.add(sites=10, windows=1, bp=100)
+        reporter.add(sites=5, chrm='Chr01', pos=150)
+        reporter.flush()
+        monitor.drain(timeout=1)
+
+        metrics = monitor.metrics()
+        self.assertEqual((metrics['sites'], metrics['windows']), (15, 1))
+        self.assertAlmostEqual(metrics['percent_done'], 25.0)
+
+        monitor.close(sites=20, windows=2)
+        self.assertTrue('20 sites' in stream.getvalue())
+        self.assertEqual(json.load(open(path))['percent_done'], 100.0)
+        shutil.rmtree(tmp_dir)
+
+    def test_resolve_interval(self):
+        import StringIO
+        stream = StringIO.StringIO()   # not a terminal
+
+        self.assertEqual(progress.resolve_interval(None, stream=stream), 0.0)
+        self.assertEqual(progress.resolve_interval(None, 'progress.json', stream), progress.DEFAULT_INTERVAL)
+        self.assertEqual(progress.resolve_interval(5.0, stream=stream), 5.0)
+        self.assertEqual(progress.resolve_interval(0.0, 'progress.json', stream), 0.0)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_merge_worker_profiles(self):
+        tmp_dir = tempfile.mkdtemp()
+        prefix = os.path.join(tmp_dir, 'profile')
+        profiler = profiling.PoolProfiler(prefix)
+
+        for name in range(2):   # as done by each worker of the pool
+            worker = profiling.WorkerProfiler(profiler.directory)
+            result = worker.run(lambda n: sum(math.sqrt(i) for i in xrange(n)), 300000)
+            worker.dump(name)
+
+        self.assertEqual(profiler.write(), 2)
+        self.assertTrue(result > 0)
+
+        for suffix in ['.pstats', '.parent.pstats', '.txt', '.collapsed']:
+            self.assertTrue(os.path.exists(prefix + suffix))
+
+        self.assertTrue('Merged profile of 2 worker(s)' in open(prefix + '.txt').read())
+        for line in open(prefix + '.collapsed'):
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('<lambda>'))
+            self.assertTrue(int(count) > 0)
+
+        self.assertFalse(os.path.exists(profiler.directory))
+        shutil.rmtree(tmp_dir)
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_heavy_modules_are_imported_on_first_use(self):
+        import subprocess
+        code = "\n".join(["import sys",
+                          "from pypgen.parser import VCF",
+                          "from pypgen.fstats import fstats, backends, resampling, accumulators",
+                          "from pypgen.misc import helpers, writers, progress, profiling, runstats",
+                          "VCF.default_args().parse_args(['-i', 'x.vcf.gz', '-p', 'a:s1', '-c', '2', '-r', 'Chr01:1-10001'])",
+                          "helpers.float_2_string(0.5, 4)",
+                          "print ' '.join(m for m in ('numpy', 'pysam', 'numba') if m in sys.modules)"])
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(pypgen.__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.strip(), '')
+
+        lazy = lazy_import('this_module_is_not_imported_by_anything')
+        self.assertRaises(ImportError, getattr, lazy, 'attribute')
+        self.assertTrue(lazy_import('numpy').zeros is numpy.zeros)
+
+
 if __name__ == '__main__':
     unittest.main()